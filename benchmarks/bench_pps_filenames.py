@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the parsing of PPS file names with trollsift and with the precompiled parsers.
+
+Usage: python benchmarks/bench_pps_filenames.py [number of file names]
+"""
+
+import sys
+import time
+
+from trollsift.parser import parse
+
+from nwcsafpps_runner.pps_filenames import (PPS_OUT_PATTERN, PPS_OUT_PATTERN_MULTIPLE, PPS_STAT_PATTERN,
+                                            parse_pps_filename)
+
+PRODUCTS = ['CMA', 'CMAPROB', 'CT', 'CTTH', 'CPP', 'PC']
+
+
+def create_filenames(number):
+    """Create file names of VIIRS granules, one third of them statistics files."""
+    filenames = []
+    for idx in range(number):
+        product = PRODUCTS[idx % len(PRODUCTS)]
+        orbit = 50000 + idx // len(PRODUCTS)
+        minute = idx % 60
+        name = "S_NWC_{}_npp_{:05d}_20210305T07{:02d}000Z_20210305T07{:02d}325Z".format(product, orbit, minute, minute)
+        filenames.append(name + ('_statistics.xml' if idx % 3 == 0 else '.nc'))
+    return filenames
+
+
+def parse_with_trollsift(filename):
+    """Parse the way publish_pps_files used to."""
+    try:
+        try:
+            metadata = parse(PPS_OUT_PATTERN, filename)
+        except ValueError:
+            metadata = parse(PPS_OUT_PATTERN_MULTIPLE, filename)
+    except ValueError:
+        metadata = parse(PPS_STAT_PATTERN, filename)
+    return metadata['start_time'], metadata['end_time']
+
+
+def parse_with_registry(filename):
+    """Parse with the precompiled parsers."""
+    info = parse_pps_filename(filename)
+    return info.start_time, info.end_time
+
+
+def run(func, filenames):
+    """Parse all the *filenames*, return the time taken and the results."""
+    start = time.perf_counter()
+    results = [func(filename) for filename in filenames]
+    return time.perf_counter() - start, results
+
+
+if __name__ == "__main__":
+    filenames = create_filenames(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
+    trollsift_time, expected = run(parse_with_trollsift, filenames)
+    registry_time, results = run(parse_with_registry, filenames)
+    assert results == expected
+    print("%d file names" % len(filenames))
+    print("trollsift: %.3f s (%.1f us per file)" % (trollsift_time, 1e6 * trollsift_time / len(filenames)))
+    print("registry:  %.3f s (%.1f us per file)" % (registry_time, 1e6 * registry_time / len(filenames)))
+    print("speedup:   %.1fx" % (trollsift_time / registry_time))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Event loop based runner core.
+
+Message intake, scene assembly, supervision of the PPS subprocesses, time outs
+and publishing are all handled in one asyncio event loop. The number of
+threads stays the same no matter how many scenes are being processed.
+"""
+
+import asyncio
+import logging
+import os
+import shlex
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from posttroll.publisher import Publish
+
+from nwcsafpps_runner.publish_and_listen import FileListener, create_message_deduplicator
+from nwcsafpps_runner.scene_log import create_scene_log
+from nwcsafpps_runner.scene_store import create_scene_store, replay_journal
+from nwcsafpps_runner.utils import get_sceneid, message_uid
+
+LOG = logging.getLogger(__name__)
+
+
+class LoopQueue(object):
+    """Thread safe *put* onto an asyncio queue, used by the FileListener thread."""
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+class LoopPublishQueue(object):
+    """Queue like object sending the messages put on it with the publisher owned by the event loop."""
+
+    def __init__(self, loop, publisher):
+        self.loop = loop
+        self.publisher = publisher
+
+    def put(self, msg):
+        self.loop.call_soon_threadsafe(self.publisher.send, msg)
+
+    def send(self, msg):
+        self.put(msg)
+
+
+def use_pidfd_child_watcher():
+    """Reap the subprocesses without a thread per process, where supported.
+
+    Before python 3.12 the default child watcher starts one thread per
+    subprocess, so the pidfd based watcher is installed instead. From python
+    3.12 asyncio uses pidfds by itself. Return True if the subprocesses are
+    reaped without extra threads.
+    """
+    if sys.version_info >= (3, 12):
+        return True
+    if not hasattr(asyncio, 'PidfdChildWatcher'):
+        LOG.info("No pidfd child watcher, each subprocess is reaped in a thread of its own")
+        return False
+    try:
+        watcher = asyncio.PidfdChildWatcher()
+        asyncio.set_child_watcher(watcher)
+    except (OSError, RuntimeError, NotImplementedError):
+        LOG.info("The pidfd child watcher is not available, each subprocess is reaped in a thread of its own")
+        return False
+    return True
+
+
+async def log_stream(stream, log_func):
+    """Log the output of a subprocess line by line."""
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        log_func(line.decode('utf-8', 'replace').strip())
+
+
+class AsyncPPSRunner(object):
+    """Run PPS on the incoming scenes in one event loop.
+
+    The runner specific parts are given as callables:
+
+    - *create_scene(msg, files4pps, options)* returns the scene to process or None
+    - *prepare_nwp()* prepares the NWP data (blocking, run in a dedicated thread)
+    - *create_commands(scene, options)* returns the list of PPS commands to run in sequence
+    - *post_process(scene, publish_q, msg, options)* does what is needed after PPS,
+      e.g. publishing (blocking, run in a fixed size thread pool)
+    """
+
+    def __init__(self, options, create_scene, prepare_nwp, create_commands, post_process,
+                 runner_name='pps_runner'):
+        self.options = options
+        self.create_scene = create_scene
+        self.prepare_nwp = prepare_nwp
+        self.create_commands = create_commands
+        self.post_process = post_process
+        self.runner_name = runner_name
+        self.max_jobs = int(options.get('number_of_threads', 5))
+        self.timeout = int(options.get('maximum_pps_processing_time_in_minutes', 20)) * 60.0
+        self.files4pps = create_scene_store(options)
+        self.jobs = set()
+        self.tasks = set()
+        self.publish_q = None
+        self._semaphore = None
+        self._nwp_executor = ThreadPoolExecutor(max_workers=1)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+
+    def run(self):
+        """Run the event loop until the listener stops."""
+        use_pidfd_child_watcher()
+        try:
+            asyncio.run(self._listen_and_process())
+        finally:
+            self._nwp_executor.shutdown()
+            self._executor.shutdown()
+
+    async def _listen_and_process(self):
+        loop = asyncio.get_running_loop()
+        listener_q = asyncio.Queue()
+        with Publish(self.runner_name, 0, self.options['publish_topic']) as publisher:
+            self.publish_q = LoopPublishQueue(loop, publisher)
+            replay_journal(self.files4pps, self.handle_message)
+            listen_thread = FileListener(LoopQueue(loop, listener_q), self.options['subscribe_topics'],
+                                         deduplicator=create_message_deduplicator(self.options))
+            listen_thread.start()
+            try:
+                await self.process_messages(listener_q)
+            finally:
+                listen_thread.stop()
+
+    async def process_messages(self, listener_q):
+        """Assemble the scenes from the incoming messages and start the processing of the ready ones.
+
+        Return when a None is received, once all the started jobs are finished.
+        """
+        while True:
+            msg = await listener_q.get()
+            if msg is None:
+                break
+            self.handle_message(msg)
+
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+    def handle_message(self, msg):
+        """Add the message to its scene, and start processing the scene if it is ready."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+        scene = self.create_scene(msg, self.files4pps, self.options)
+        if scene:
+            self.start_job(scene, msg)
+
+    def start_job(self, scene, msg):
+        """Start processing the scene, unless it is already being processed."""
+        job_id = message_uid(msg)
+        if job_id in self.jobs:
+            LOG.info("Job with id %s already running!", str(job_id))
+            self.files4pps.scene_dropped(self._get_sceneid(msg))
+            return
+
+        self.jobs.add(job_id)
+        task = asyncio.ensure_future(self.run_job(job_id, scene, msg))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        LOG.debug("Number of jobs currently running or waiting: %d", len(self.jobs))
+
+    async def run_job(self, job_id, scene, msg):
+        """Prepare the NWP data, run PPS on the scene and do the post processing."""
+        loop = asyncio.get_running_loop()
+        try:
+            async with self._semaphore:
+                LOG.info("Starting pps runner for scene %s", str(scene))
+                job_start_time = datetime.utcnow()
+                await loop.run_in_executor(self._nwp_executor, self.prepare_nwp)
+                scene_log = create_scene_log(self.options, scene)
+                returncode = 0
+                try:
+                    for cmd in self.create_commands(scene, self.options):
+                        returncode = await self.run_command(cmd, scene, scene_log) or returncode
+                finally:
+                    if scene_log is not None:
+                        await loop.run_in_executor(self._executor, scene_log.close, returncode)
+                LOG.info("Ready with PPS level-2 processing on scene: " + str(scene))
+                await loop.run_in_executor(self._executor, self.post_process,
+                                           scene, self.publish_q, msg, self.options)
+                LOG.info("PPS on scene %s finished. It took: %s", str(scene), str(datetime.utcnow() - job_start_time))
+        except Exception:
+            LOG.exception('Failed in pps job...')
+        finally:
+            self.jobs.discard(job_id)
+            self.files4pps.scene_done(self._get_sceneid(msg))
+
+    @staticmethod
+    def _get_sceneid(msg):
+        return get_sceneid(msg.data['platform_name'], int(msg.data['orbit_number']), msg.data.get('start_time'))
+
+    async def run_command(self, cmd, scene, scene_log=None):
+        """Run one command in a shell, logging its output, and kill it if it takes too long.
+
+        With a *scene_log* the output is written by the process to the log file
+        of the scene. Return the exit code of the process.
+        """
+        if not isinstance(cmd, str):
+            cmd = shlex.join(cmd)
+        LOG.debug("Run command: " + cmd)
+        if scene_log is None:
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE,
+                                                         stderr=asyncio.subprocess.PIPE, start_new_session=True)
+            waiting = asyncio.gather(log_stream(proc.stdout, LOG.info),
+                                     log_stream(proc.stderr, LOG.info),
+                                     proc.wait())
+        else:
+            proc = await asyncio.create_subprocess_shell(cmd, stdout=scene_log.open(),
+                                                         stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+            waiting = proc.wait()
+        try:
+            await asyncio.wait_for(waiting, self.timeout)
+        except asyncio.TimeoutError:
+            # Kill the shell with the processes it started, which keep the pipes open otherwise
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            LOG.info("Process timed out and pre-maturely terminated. Scene: " + str(scene))
+            await proc.wait()
+
+        return proc.returncode
@@ -64,6 +64,8 @@ def get_config_init_cfg(configfile, service=MODE):
 
     options['subscribe_topics'] = subscribe_topics
     options['number_of_threads'] = int(options.get('number_of_threads', 5))
+    if options.get('pending_jobs_high_water_mark') is not None:
+        options['pending_jobs_high_water_mark'] = int(options['pending_jobs_high_water_mark'])
     options['maximum_pps_processing_time_in_minutes'] = int(options.get('maximum_pps_processing_time_in_minutes', 20))
     options['servername'] = options.get('servername', socket.gethostname())
     options['station'] = options.get('station', 'unknown')
@@ -108,6 +110,8 @@ def get_config_yaml(configfile, service=MODE, procenv=''):
         options['subscribe_topics'] = subscribe_topics
 
     options['number_of_threads'] = int(options.get('number_of_threads', 5))
+    if options.get('pending_jobs_high_water_mark') is not None:
+        options['pending_jobs_high_water_mark'] = int(options['pending_jobs_high_water_mark'])
     options['maximum_pps_processing_time_in_minutes'] = int(options.get('maximum_pps_processing_time_in_minutes', 20))
     options['servername'] = options.get('servername', socket.gethostname())
     options['station'] = options.get('station', 'unknown')
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lock between processes on a lock file.
+
+The lock is an flock on the lock file. Waiting processes block in the kernel
+and wake up as soon as the lock is released (or poll for it every
+POLL_INTERVAL seconds when waiting with a timeout), so if the holder releases
+the lock right after renaming its output into place, the waiters see the
+output (almost) immediately. The lock file holds the host name and pid of the holder, which
+is used to report lock files left behind by crashed processes.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import socket
+import time
+
+LOG = logging.getLogger(__name__)
+
+#: Seconds between the attempts to take the lock, when waiting with a timeout
+POLL_INTERVAL = 0.05
+
+
+def _flock(fd, timeout):
+    """Lock *fd*, waiting at most *timeout* seconds (forever if None). Return True if locked."""
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (IOError, OSError) as err:
+        if err.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+    if timeout is not None and timeout <= 0:
+        return False
+    if timeout is None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return True
+
+    # flock can not time out, so poll until the deadline
+    deadline = time.monotonic() + timeout
+    while True:
+        time.sleep(min(POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        if time.monotonic() >= deadline:
+            return False
+
+
+class FileLock(object):
+    """Exclusive lock between processes, on the file *path*."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, timeout=None):
+        """Acquire the lock, waiting at most *timeout* seconds (forever if None).
+
+        Return False if the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                if not _flock(fd, remaining):
+                    os.close(fd)
+                    return False
+            except Exception:
+                os.close(fd)
+                raise
+            # The holder may have removed the lock file while we waited,
+            # then our lock is on a file nobody else will see:
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except OSError:
+                current = False
+            if current:
+                break
+            os.close(fd)
+
+        self._fd = fd
+        self._take_over(fd)
+        return True
+
+    def _take_over(self, fd):
+        previous = os.pread(fd, 1024, 0).decode('utf-8', 'replace').strip()
+        if previous:
+            LOG.warning("Stale lock file %s left by %s, taking it over", self.path, previous)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, "{} {:d} {:f}\n".format(socket.gethostname(), os.getpid(), time.time()).encode(), 0)
+
+    def release(self, remove=True):
+        """Release the lock, and remove the lock file if *remove* is True."""
+        if self._fd is None:
+            return
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                LOG.debug("Lock file %s already removed", self.path)
+        else:
+            os.ftruncate(self._fd, 0)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    @property
+    def locked(self):
+        """Check if the lock is held by this object."""
+        return self._fd is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
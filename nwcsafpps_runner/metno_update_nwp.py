@@ -23,14 +23,21 @@
 """Metno version of preparing the ECMWF nwp data for PPS
 """
 
+import itertools
 import logging
 import tempfile
-from glob import glob
 import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import numpy as np
 import eccodes as ecc
 
+from nwcsafpps_runner.file_lock import FileLock
+from nwcsafpps_runner.nwp_cache import NwpCacheTimeout, content_key, create_nwp_cache
+from nwcsafpps_runner.nwp_inventory import get_inventory, get_inventory_filename, STATUS_DONE
+from nwcsafpps_runner.nwp_requirements import get_required_keys
+
 LOG = logging.getLogger(__name__)
 
 
@@ -42,42 +49,273 @@ class NoOptionError:
     pass
 
 
-def product(*args, **kwds):
-    # product('ABCD', 'xy') --> Ax Ay Bx By Cx Cy Dx Dy
-    # product(range(2), repeat=3) --> 000 001 010 011 100 101 110 111
-    pools = list(map(tuple, args)) * kwds.get('repeat', 1)
-    result = [[]]
-    for pool in pools:
-        result = [x + [y] for x in result for y in pool]
-    for prod in result:
-        yield tuple(prod)
-
-
-def copy_needed_field(gid, fout):
-    """Copy the needed field"""
-
-    nx = ecc.codes_get(gid, 'Ni')
-    ny = ecc.codes_get(gid, 'Nj')
-    first_lat = ecc.codes_get(gid, 'latitudeOfFirstGridPointInDegrees')
-    north_south_step = ecc.codes_get(gid, 'jDirectionIncrementInDegrees')
-
-    filter_north = 0
-    new_ny = int((first_lat - filter_north)/north_south_step) + 1
-
-    values = ecc.codes_get_values(gid)
-    values_r = np.reshape(values, (ny, nx))
-
-    new_values = values_r[:new_ny, :]
-
-    clone_id = ecc.codes_clone(gid)
+#: The ECMWF parameters (paramId) copied at all levels, if nothing else is configured
+DEFAULT_ECMWF_PARAMETERS = [172, 129, 235, 167, 168, 137, 130, 131, 132, 133, 134, 157]
+
+#: Default latitude band kept when cropping the ECMWF fields
+DEFAULT_CROP_NORTH = 90.0
+DEFAULT_CROP_SOUTH = 0.0
+
+#: Keys of the grid geometry, the crop window is computed once for each geometry
+GEOMETRY_KEYS = ['Ni', 'Nj', 'latitudeOfFirstGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees',
+                 'iDirectionIncrementInDegrees', 'jDirectionIncrementInDegrees',
+                 'iScansNegatively', 'jScansPositively']
+
+CropWindow = namedtuple('CropWindow', ['row_start', 'row_end', 'col_start', 'col_end', 'keys'])
+CropWindow.__doc__ = """Rows and columns of a grid to keep, and the grid keys to set on the cropped field."""
+
+
+def _index_range(first, step, low, high, size):
+    """Get the [start, end) indices of the grid points first + i * step within [low, high]."""
+    if step < 0:
+        first, step = -first, -step
+        low, high = -high, -low
+    start = max(int(np.ceil(round((low - first) / step, 6))), 0)
+    end = min(int(np.floor(round((high - first) / step, 6))) + 1, size)
+    return start, max(end, start)
+
+
+class FieldCropper(object):
+    """Crop the fields on a regular lat/lon grid to a bounding box.
+
+    The latitude band is given by *north* and *south*. The longitudes are
+    only cropped if both *west* and *east* are given, in the same convention
+    as the grid and without crossing its edge. If *float32* is True the values
+    are decoded as 32 bit floats, to reduce the memory needed.
+    """
+
+    def __init__(self, north=DEFAULT_CROP_NORTH, south=DEFAULT_CROP_SOUTH, west=None, east=None, float32=False):
+        self.north = north
+        self.south = south
+        self.west = west
+        self.east = east
+        self.float32 = float32
+        self._windows = {}
+
+    def settings(self):
+        """Get a description of the cropping, which the output depends on."""
+        return "crop:{} {} {} {} {}".format(self.north, self.south, self.west, self.east, self.float32)
+
+    def get_window(self, gid):
+        """Get the crop window of the grid of the field, computed once per grid geometry."""
+        geometry = tuple(ecc.codes_get(gid, key) for key in GEOMETRY_KEYS)
+        if geometry not in self._windows:
+            self._windows[geometry] = self._compute_window(*geometry)
+        return self._windows[geometry]
+
+    def _compute_window(self, nx, ny, first_lat, first_lon, west_east_step, north_south_step,
+                        i_scans_negatively, j_scans_positively):
+        lat_step = north_south_step if j_scans_positively else -north_south_step
+        row_start, row_end = _index_range(first_lat, lat_step, self.south, self.north, ny)
+        keys = {}
+        if (row_start, row_end) != (0, ny):
+            keys['Nj'] = row_end - row_start
+            keys['latitudeOfFirstGridPointInDegrees'] = first_lat + row_start * lat_step
+            keys['latitudeOfLastGridPointInDegrees'] = first_lat + (row_end - 1) * lat_step
+
+        col_start, col_end = 0, nx
+        if self.west is not None and self.east is not None and not i_scans_negatively:
+            col_start, col_end = _index_range(first_lon, west_east_step, self.west, self.east, nx)
+        if (col_start, col_end) != (0, nx):
+            keys['Ni'] = col_end - col_start
+            keys['longitudeOfFirstGridPointInDegrees'] = first_lon + col_start * west_east_step
+            keys['longitudeOfLastGridPointInDegrees'] = first_lon + (col_end - 1) * west_east_step
+
+        return CropWindow(row_start, row_end, col_start, col_end, keys)
+
+    def _get_values(self, gid):
+        if self.float32:
+            try:
+                return ecc.codes_get_values(gid, ktype=np.float32)
+            except TypeError:
+                LOG.debug("This eccodes version can not decode to float32")
+        return ecc.codes_get_values(gid)
+
+    def crop(self, gid):
+        """Crop the field in place."""
+        window = self.get_window(gid)
+        if not window.keys:
+            return
+        nx = ecc.codes_get(gid, 'Ni')
+        ny = ecc.codes_get(gid, 'Nj')
+        values = self._get_values(gid).reshape((ny, nx))
+        # A view, only copied by ravel if the columns are cropped:
+        new_values = values[window.row_start:window.row_end, window.col_start:window.col_end]
+        for key in ['Ni', 'Nj']:
+            if key in window.keys:
+                ecc.codes_set(gid, key, window.keys[key])
+        for key, value in window.keys.items():
+            if key not in ['Ni', 'Nj']:
+                ecc.codes_set(gid, key, value)
+        ecc.codes_set_values(gid, new_values.ravel())
+
+    def crop_message(self, message):
+        """Crop the field of a GRIB message (bytes) and return the new message."""
+        gid = ecc.codes_new_from_message(message)
+        try:
+            self.crop(gid)
+            return ecc.codes_get_message(gid)
+        finally:
+            ecc.codes_release(gid)
+
+    def crop_messages(self, messages, nworkers=1):
+        """Crop the GRIB *messages* using up to *nworkers* processes, and yield the new messages in order."""
+        if nworkers <= 1:
+            for message in messages:
+                yield self.crop_message(message)
+            return
+
+        with ProcessPoolExecutor(max_workers=nworkers) as executor:
+            pending = deque()
+            for message in messages:
+                pending.append(executor.submit(self.crop_message, message))
+                # Limit the number of messages held in memory:
+                if len(pending) >= 2 * nworkers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def create_field_cropper(options):
+    """Create the field cropper from the configuration."""
+    def _get(name, default):
+        value = options.get(name)
+        return default if value is None else float(value)
+
+    return FieldCropper(north=_get('ecmwf_crop_north', DEFAULT_CROP_NORTH),
+                        south=_get('ecmwf_crop_south', DEFAULT_CROP_SOUTH),
+                        west=_get('ecmwf_crop_west', None),
+                        east=_get('ecmwf_crop_east', None),
+                        float32=options.get('ecmwf_crop_float32', False))
+
+
+def copy_needed_field(gid, fout, cropper=None):
+    """Crop the field (in place) and write it to *fout*."""
+    (cropper or FieldCropper()).crop(gid)
+    ecc.codes_write(gid, fout)
+
+
+def _get_index_values(iid, key):
+    return set(int(value) for value in ecc.codes_index_get(iid, key) if value != 'undef')
+
+
+class IndexQueryPlanner(object):
+    """Plan which (paramId, level) to select from an eccodes index of the NWP data.
+
+    If *fields* is given, only those (paramId, level) are selected. Otherwise
+    all available levels of the *parameters* (paramId) are.
+    """
+
+    def __init__(self, parameters=None, fields=None):
+        self.parameters = set(parameters or DEFAULT_ECMWF_PARAMETERS)
+        self.fields = set(fields) if fields else None
+
+    def settings(self):
+        """Get a description of the selected fields, which the output depends on."""
+        if self.fields is None:
+            return "parameters:{}".format(sorted(self.parameters))
+        return "fields:{}".format(sorted(self.fields))
+
+    def plan(self, iid):
+        """Get the sorted list of (paramId, level) to select from the index."""
+        params = _get_index_values(iid, 'paramId')
+        levels = _get_index_values(iid, 'level')
+        if self.fields is None:
+            missing = self.parameters - params
+            if missing:
+                LOG.warning("Parameters missing in the NWP data: %s", str(sorted(missing)))
+            return sorted(itertools.product(self.parameters & params, levels))
+
+        selections = sorted(field for field in self.fields if field[0] in params and field[1] in levels)
+        missing = self.fields.difference(selections)
+        if missing:
+            LOG.warning("Fields (paramId, level) missing in the NWP data: %s", str(sorted(missing)))
+        return selections
+
+
+def create_query_planner(options):
+    """Create the query planner from the configuration.
+
+    If *ecmwf_fields_from_requirements* is set, the mandatory fields of the
+    PPS requirements file are selected, otherwise the *ecmwf_parameters*.
+    """
+    if options.get('ecmwf_fields_from_requirements'):
+        try:
+            return IndexQueryPlanner(fields=get_required_keys(options['pps_nwp_requirements']))
+        except (IOError, OSError, KeyError, ValueError):
+            LOG.exception("Failed getting the required fields, use the configured parameters")
+    return IndexQueryPlanner(parameters=options.get('ecmwf_parameters'))
+
+
+def read_needed_fields(iid, planner):
+    """Get the fields needed by PPS from the index.
+
+    Only the (paramId, level) planned are selected. The GRIB handles are
+    released when the next one is requested.
+    """
+    for param, level in planner.plan(iid):
+        ecc.codes_index_select(iid, 'paramId', param)
+        ecc.codes_index_select(iid, 'level', level)
+
+        found = False
+        while 1:
+            gid = ecc.codes_new_from_index(iid)
+            if gid is None:
+                break
 
-    ecc.codes_set(clone_id, 'latitudeOfLastGridPointInDegrees', (filter_north))
-    ecc.codes_set(clone_id, 'Nj', new_ny)
+            found = True
+            try:
+                LOG.debug("Doing param: %d", param)
+                yield gid
+            finally:
+                ecc.codes_release(gid)
+
+        if not found and planner.fields is not None:
+            LOG.warning("Field (paramId, level) missing in the NWP data: %s", str((param, level)))
+
+
+def parse_ecmwf_filename(parser, filename):
+    """Get the analysis time and forecast time from the name of an ECMWF file.
+
+    Return None if the file name does not match the *parser* pattern.
+    """
+    if not parser.validate(os.path.basename(filename)):
+        LOG.error("Parser validate on filename: {} failed.".format(filename))
+        return None
+    res = parser.parse("{}".format(os.path.basename(filename)))
+
+    time_now = datetime.utcnow()
+    if 'analysis_time' in res:
+        if res['analysis_time'].year == 1900:
+            # This is tricky. Filename is missing year in name
+            # Need to guess the year from a compination of year now
+            # and month now and month of the analysis time taken from the filename
+            # If the month now is 1(January) and the analysis month is 12,
+            # then the time has passed New Year, but the NWP analysis time is previous year.
+            if time_now.month == 1 and res['analysis_time'].month == 12:
+                analysis_year = time_now.year-1
+            else:
+                analysis_year = time_now.year
+
+            res['analysis_time'] = res['analysis_time'].replace(year=analysis_year)
+    else:
+        LOG.error("Can not parse analysis_time in file name. Check config and filename timestamp")
+        return None
+
+    if 'forecast_time' in res:
+        if res['forecast_time'].year == 1900:
+            # See above for explanation
+            if res['analysis_time'].month == 12 and res['forecast_time'].month == 1:
+                forecast_year = res['analysis_time'].year+1
+            else:
+                forecast_year = res['analysis_time'].year
 
-    ecc.codes_set_values(clone_id, new_values.flatten())
+            res['forecast_time'] = res['forecast_time'].replace(year=forecast_year)
+    else:
+        LOG.error("Can not parse forecast_time in file name. Check config and filename timestamp")
+        return None
 
-    ecc.codes_write(clone_id, fout)
-    ecc.codes_release(clone_id)
+    return {'analysis_time': res['analysis_time'], 'forecast_time': res['forecast_time']}
 
 
 def update_nwp(params):
@@ -90,62 +328,42 @@ def update_nwp(params):
         ecmwf_path = ecmwf_path.replace("storeB", "storeA")
         LOG.warning("Need to replace storeB with storeA for ecmwf_path: {}".format(str(ecmwf_path)))
 
-    filelist = glob(os.path.join(ecmwf_path,  params['options']['ecmwf_prefix'] + "*"))
+    if params['options']['ecmwf_file_name_sift'] is None:
+        LOG.error("Not sift pattern given. Can not parse input NWP files")
+        return
+
+    inventory = get_inventory(get_inventory_filename(params['options']))
+    try:
+        _update_nwp(params, ecmwf_path, inventory)
+    finally:
+        inventory.save()
+
+
+def _update_nwp(params, ecmwf_path, inventory):
+    from trollsift import Parser, compose
+    parser = Parser(params['options']['ecmwf_file_name_sift'])
+    cropper = create_field_cropper(params['options'])
+    planner = create_query_planner(params['options'])
+    nwp_cache = create_nwp_cache(params['options'])
+    lock_timeout = params['options'].get('nwp_lock_timeout')
+    if lock_timeout is not None:
+        lock_timeout = float(lock_timeout)
+    nworkers = int(params['options'].get('ecmwf_crop_workers', 1))
+    filelist = inventory.scan(ecmwf_path, params['options']['ecmwf_prefix'],
+                              lambda filename: parse_ecmwf_filename(parser, filename))
 
     if len(filelist) == 0:
         LOG.info("Found no input files! dir = " +
                  str(os.path.join(ecmwf_path,  params['options']['ecmwf_prefix'] + "*")))
         return
 
-    from trollsift import Parser, compose
-    filelist.sort()
-    for filename in filelist:
-        if params['options']['ecmwf_file_name_sift'] is not None:
-            try:
-                parser = Parser(params['options']['ecmwf_file_name_sift'])
-            except NoOptionError as noe:
-                LOG.error("NoOptionError {}".format(noe))
-                continue
-            if not parser.validate(os.path.basename(filename)):
-                LOG.error("Parser validate on filename: {} failed.".format(filename))
-                continue
-            res = parser.parse("{}".format(os.path.basename(filename)))
-
-            time_now = datetime.utcnow()
-            if 'analysis_time' in res:
-                if res['analysis_time'].year == 1900:
-                    # This is tricky. Filename is missing year in name
-                    # Need to guess the year from a compination of year now
-                    # and month now and month of the analysis time taken from the filename
-                    # If the month now is 1(January) and the analysis month is 12,
-                    # then the time has passed New Year, but the NWP analysis time is previous year.
-                    if time_now.month == 1 and res['analysis_time'].month == 12:
-                        analysis_year = time_now.year-1
-                    else:
-                        analysis_year = time_now.year
-
-                    res['analysis_time'] = res['analysis_time'].replace(year=analysis_year)
-            else:
-                LOG.error("Can not parse analysis_time in file name. Check config and filename timestamp")
-
-            if 'forecast_time' in res:
-                if res['forecast_time'].year == 1900:
-                    # See above for explanation
-                    if res['analysis_time'].month == 12 and res['forecast_time'].month == 1:
-                        forecast_year = res['analysis_time'].year+1
-                    else:
-                        forecast_year = res['analysis_time'].year
-
-                    res['forecast_time'] = res['forecast_time'].replace(year=forecast_year)
-            else:
-                LOG.error("Can not parse forecast_time in file name. Check config and filename timestamp")
-
-            forecast_time = res['forecast_time']
-            analysis_time = res['analysis_time']
-            step_delta = forecast_time - analysis_time
-            step = "{:03d}H{:02d}M".format(int(step_delta.days*24 + step_delta.seconds/3600), 0)
-        else:
-            LOG.error("Not sift pattern given. Can not parse input NWP files")
+    for filename, fileinfo in filelist:
+        if fileinfo is None:
+            continue
+        forecast_time = fileinfo['forecast_time']
+        analysis_time = fileinfo['analysis_time']
+        step_delta = forecast_time - analysis_time
+        step = "{:03d}H{:02d}M".format(int(step_delta.days*24 + step_delta.seconds/3600), 0)
 
         if analysis_time < params['starttime']:
             # LOG.debug("skip analysis time {} older than search time {}".format(analysis_time, params['starttime']))
@@ -175,88 +393,99 @@ def update_nwp(params):
         except Exception as e:
             LOG.error("Joining outdir with output for nwp failed with: {}".format(e))
 
-        LOG.info("Result file: {}".format(result_file))
         if os.path.exists(result_file):
-            LOG.info("File: " + str(result_file) + " already there...")
+            # Done entries are made again only if their result file was removed
+            if inventory.get_status(filename) != STATUS_DONE:
+                LOG.info("File: " + str(result_file) + " already there...")
+                inventory.set_status(filename, STATUS_DONE)
             continue
+        LOG.info("Result file: {}".format(result_file))
 
-        import fcntl
-        import errno
-        import time
-        rfl = open(_result_file_lock, 'w+')
-        # do some locking
-        while True:
-            try:
-                fcntl.flock(rfl, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                LOG.debug("1Got lock for NWP outfile: {}".format(result_file))
-                break
-            except IOError as e:
-                if e.errno != errno.EAGAIN:
-                    raise
-                else:
-                    LOG.debug("Waiting for lock ... {}".format(result_file))
-                    time.sleep(1)
-
-        if os.path.exists(result_file):
-            LOG.info("File: " + str(result_file) + " already there...")
-            # Need to release the lock
-            fcntl.flock(rfl, fcntl.LOCK_UN)
-            rfl.close()
+        lock = FileLock(_result_file_lock)
+        LOG.debug("Waiting for lock ... {}".format(result_file))
+        if not lock.acquire(timeout=lock_timeout):
+            LOG.warning("Timed out waiting for the lock on NWP outfile: {}".format(result_file))
             continue
+        LOG.debug("Got lock for NWP outfile: {}".format(result_file))
 
-        fout = open(_result_file, 'wb')
         try:
+            if os.path.exists(result_file):
+                # The process holding the lock before us made it
+                LOG.info("File: " + str(result_file) + " already there...")
+                inventory.set_status(filename, STATUS_DONE)
+                continue
 
-            # Do the static fields
-            # Note: field not in the filename variable, but a configured filename for static fields
-            static_filename = params['options']['ecmwf_static_surface']
-            if not os.path.exists(static_filename):
-                static_filename = static_filename.replace("storeB", "storeA")
-                LOG.warning("Need to replace storeB with storeA")
-
-            index_vals = []
-            index_keys = ['paramId', 'level']
-            LOG.debug("Start building index")
-            LOG.debug("Handeling file: %s", filename)
-            iid = ecc.codes_index_new_from_file(filename, index_keys)
-            filename_n1s = filename.replace('N2D', 'N1S')
-            LOG.debug("Add to index %s", filename_n1s)
-            ecc.codes_index_add_file(iid, filename_n1s)
-            LOG.debug("Add to index %s", static_filename)
-            ecc.codes_index_add_file(iid, static_filename)
-            LOG.debug("Done index")
-            for key in index_keys:
-                key_vals = ecc.codes_index_get(iid, key)
-                key_vals = tuple(x for x in key_vals if x != 'undef')
-                index_vals.append(key_vals)
-
-            for prod in product(*index_vals):
-                for i in range(len(index_keys)):
-                    ecc.codes_index_select(iid, index_keys[i], prod[i])
-
-                while 1:
-                    gid = ecc.codes_new_from_index(iid)
-                    if gid is None:
-                        break
-
-                    param = ecc.codes_get(gid, index_keys[0])
-                    parameters = [172, 129, 235, 167, 168, 137, 130, 131, 132, 133, 134, 157]
-                    if param in parameters:
-                        LOG.debug("Doing param: %d", param)
-                        copy_needed_field(gid, fout)
-
-                    ecc.codes_release(gid)
-            ecc.codes_index_release(iid)
-
-            fout.close()
-            os.rename(_result_file, result_file)
-
-        except WrongLengthError as wle:
-            LOG.error("Something wrong with the data: %s", wle)
-            raise
-
-        # In the end release the lock
-        fcntl.flock(rfl, fcntl.LOCK_UN)
-        rfl.close()
-        os.remove(_result_file_lock)
+            if nwp_cache is not None:
+                if not _fetch_from_shared_cache(nwp_cache, params, filename, result_file,
+                                                _result_file, cropper, planner, nworkers):
+                    continue
+            else:
+                _make_nwp_file(params, filename, _result_file, cropper, planner, nworkers)
+                os.rename(_result_file, result_file)
+            inventory.set_status(filename, STATUS_DONE)
+        finally:
+            # Release the lock right after the rename, waiting processes wake up at once
+            lock.release()
     return
+
+
+def _get_static_filename(options):
+    # Note: field not in the filename variable, but a configured filename for static fields
+    static_filename = options['ecmwf_static_surface']
+    if not os.path.exists(static_filename):
+        static_filename = static_filename.replace("storeB", "storeA")
+        LOG.warning("Need to replace storeB with storeA")
+    return static_filename
+
+
+def _fetch_from_shared_cache(nwp_cache, params, filename, result_file, _result_file, cropper, planner, nworkers):
+    """Get the NWP file from the shared cache, making it if this host is elected to.
+
+    Return True if the file was made.
+    """
+    settings = "{} {}".format(cropper.settings(), planner.settings())
+    key = content_key([filename, filename.replace('N2D', 'N1S'), _get_static_filename(params['options'])],
+                      settings)
+    try:
+        return nwp_cache.fetch(key, result_file,
+                               lambda path: _make_nwp_file(params, filename, path, cropper, planner, nworkers))
+    except NwpCacheTimeout:
+        LOG.warning("No NWP file from the shared cache, make it here: %s", result_file)
+        _make_nwp_file(params, filename, _result_file, cropper, planner, nworkers)
+        os.rename(_result_file, result_file)
+        return True
+
+
+def _make_nwp_file(params, filename, _result_file, cropper, planner, nworkers):
+    """Write the cropped fields needed by PPS to *_result_file*."""
+    fout = open(_result_file, 'wb')
+    try:
+
+        # Do the static fields
+        static_filename = _get_static_filename(params['options'])
+
+        index_keys = ['paramId', 'level']
+        LOG.debug("Start building index")
+        LOG.debug("Handeling file: %s", filename)
+        iid = ecc.codes_index_new_from_file(filename, index_keys)
+        filename_n1s = filename.replace('N2D', 'N1S')
+        LOG.debug("Add to index %s", filename_n1s)
+        ecc.codes_index_add_file(iid, filename_n1s)
+        LOG.debug("Add to index %s", static_filename)
+        ecc.codes_index_add_file(iid, static_filename)
+        LOG.debug("Done index")
+
+        fields = read_needed_fields(iid, planner)
+        if nworkers > 1:
+            for message in cropper.crop_messages((ecc.codes_get_message(gid) for gid in fields), nworkers):
+                fout.write(message)
+        else:
+            for gid in fields:
+                copy_needed_field(gid, fout, cropper)
+        ecc.codes_index_release(iid)
+
+        fout.close()
+
+    except WrongLengthError as wle:
+        LOG.error("Something wrong with the data: %s", wle)
+        raise
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Assemble the NWP files for PPS in-process.
+
+The GRIB messages of the input files are located by reading the message
+headers with eccodes. The messages are then copied to the output file by the
+kernel (copy_file_range or sendfile) without passing through python, and the
+list of fields written is returned for checking against the PPS requirements.
+"""
+
+import errno
+import logging
+import os
+from collections import namedtuple
+
+try:
+    import eccodes as ecc
+except ImportError:
+    ecc = None
+
+LOG = logging.getLogger(__name__)
+
+#: Errors meaning that a kernel side copy is not supported between the two files
+_COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+#: Bytes read at a time when the copy can not be done by the kernel
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+GribMessage = namedtuple('GribMessage', ['field', 'grid_type', 'offset', 'length'])
+GribMessage.__doc__ = """Location and field description ("paramId name level typeOfLevel") of a GRIB message."""
+
+
+def read_grib_index(filename):
+    """Get the field description, grid type, offset and length of each GRIB message in a file.
+
+    Only the message headers are read.
+    """
+    messages = []
+    with open(filename, 'rb') as fpt:
+        while True:
+            gid = ecc.codes_grib_new_from_file(fpt, headers_only=True)
+            if gid is None:
+                break
+            try:
+                field = "%s %s %s %s" % (ecc.codes_get(gid, 'paramId'),
+                                         ecc.codes_get(gid, 'name'),
+                                         ecc.codes_get(gid, 'level'),
+                                         ecc.codes_get(gid, 'typeOfLevel'))
+                messages.append(GribMessage(field, ecc.codes_get(gid, 'gridType'),
+                                            int(ecc.codes_get(gid, 'offset')),
+                                            int(ecc.codes_get(gid, 'totalLength'))))
+            finally:
+                ecc.codes_release(gid)
+    return messages
+
+
+def _copy_chunk(fd_in, fd_out, offset, count):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(fd_in, fd_out, count, offset)
+        except OSError as err:
+            if err.errno not in _COPY_FALLBACK_ERRORS:
+                raise
+    try:
+        return os.sendfile(fd_out, fd_in, offset, count)
+    except OSError as err:
+        if err.errno not in _COPY_FALLBACK_ERRORS:
+            raise
+    return os.write(fd_out, os.pread(fd_in, min(count, _COPY_CHUNK_SIZE), offset))
+
+
+def copy_range(fd_in, fd_out, offset, length):
+    """Copy *length* bytes from *offset* in *fd_in* to the current position of *fd_out*."""
+    end = offset + length
+    while offset < end:
+        copied = _copy_chunk(fd_in, fd_out, offset, end - offset)
+        if copied == 0:
+            raise IOError("Unexpected end of file when copying GRIB data")
+        offset += copied
+
+
+def _merge_ranges(messages):
+    """Merge the consecutive messages into larger ranges to copy."""
+    ranges = []
+    for msg in messages:
+        if ranges and ranges[-1][0] + ranges[-1][1] == msg.offset:
+            ranges[-1][1] += msg.length
+        else:
+            ranges.append([msg.offset, msg.length])
+    return ranges
+
+
+def assemble_nwp_file(output_filename, input_files):
+    """Write the GRIB messages of the *input_files* to *output_filename*, in one pass.
+
+    The *input_files* is a list of (filename, grid_type) tuples. If a grid
+    type is given only the messages on that grid type are copied from the
+    file, otherwise the whole file. Return the list of the fields written
+    ("paramId name level typeOfLevel").
+    """
+    fields = []
+    fd_out = os.open(output_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for filename, grid_type in input_files:
+            messages = read_grib_index(filename)
+            if grid_type is not None:
+                messages = [msg for msg in messages if msg.grid_type == grid_type]
+            LOG.debug("Copy %d GRIB messages from %s", len(messages), filename)
+            fd_in = os.open(filename, os.O_RDONLY)
+            try:
+                for offset, length in _merge_ranges(messages):
+                    copy_range(fd_in, fd_out, offset, length)
+            finally:
+                os.close(fd_in)
+            fields.extend(msg.field for msg in messages)
+    finally:
+        os.close(fd_out)
+    return fields
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of prepared NWP files shared by several hosts.
+
+The prepared files are stored in a directory on a filesystem shared by the
+runner hosts, under a key computed from the content of the input files. One
+host is elected to produce each file by creating a lease file, the other hosts
+wait for the file and hard link it into their own NWP directory. The producer
+renews its lease while it works. A lease that is not renewed within the lease
+timeout is considered left by a crashed host, and is taken over. The files
+older than the maximum age are removed from the cache after each production.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+#: Default seconds before a lease is considered stale
+DEFAULT_LEASE_TIMEOUT = 900
+#: Default seconds between checks for the file produced by another host
+DEFAULT_POLL_INTERVAL = 2.0
+#: Default seconds a file is kept in the cache
+DEFAULT_MAX_AGE = 2 * 24 * 3600
+#: Bytes read at once when hashing the input files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class NwpCacheTimeout(Exception):
+    """The file was not produced by the elected host in time."""
+
+
+def content_key(filenames, settings=''):
+    """Compute the cache key of the output made from the input *filenames* with the given *settings*.
+
+    The key is a hash of the settings and of the whole content of each file,
+    so that it is the same on all hosts and changes with any correction of
+    the input.
+    """
+    digest = hashlib.sha256(settings.encode())
+    for filename in filenames:
+        with open(filename, 'rb') as fpt:
+            digest.update(str(os.fstat(fpt.fileno()).st_size).encode())
+            for block in iter(lambda: fpt.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _owner():
+    return "{} {:d} {:d}".format(socket.gethostname(), os.getpid(), threading.get_ident())
+
+
+def _unique_suffix():
+    return "{}.{:d}.{:d}".format(socket.gethostname(), os.getpid(), threading.get_ident())
+
+
+def link_or_copy(src, dest):
+    """Hard link *src* to *dest* (atomically replacing it), or copy it if it can not be linked."""
+    tmp_dest = "{}.{}.tmp".format(dest, _unique_suffix())
+    try:
+        os.link(src, tmp_dest)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        shutil.copyfile(src, tmp_dest)
+    os.rename(tmp_dest, dest)
+
+
+class SharedNwpCache(object):
+    """Cache of NWP files in *cache_dir*, shared by several hosts."""
+
+    def __init__(self, cache_dir, lease_timeout=DEFAULT_LEASE_TIMEOUT, poll_interval=DEFAULT_POLL_INTERVAL,
+                 wait_timeout=None, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self.max_age = max_age
+
+    def path(self, key):
+        """Get the path of the cached file."""
+        return os.path.join(self.cache_dir, key + '.grib')
+
+    def _lease_path(self, key):
+        return os.path.join(self.cache_dir, key + '.lease')
+
+    def _try_lease(self, key):
+        """Try to become the producer of the file. Return True if elected."""
+        lease = self._lease_path(key)
+        try:
+            fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            self._remove_stale_lease(lease)
+            return False
+        with os.fdopen(fd, 'w') as fpt:
+            fpt.write(_owner() + '\n')
+        return True
+
+    def _remove_stale_lease(self, lease):
+        try:
+            age = time.time() - os.stat(lease).st_mtime
+        except OSError:
+            return
+        if age < self.lease_timeout:
+            return
+        # Move the lease away before removing it, so that only one host removes it
+        stale = "{}.{}.stale".format(lease, _unique_suffix())
+        try:
+            os.rename(lease, stale)
+        except OSError:
+            return
+        if time.time() - os.stat(stale).st_mtime < self.lease_timeout:
+            # Another host took over the lease in the meantime, give it back
+            os.rename(stale, lease)
+            return
+        with open(stale, 'r') as fpt:
+            LOG.warning("Removing the stale NWP cache lease of %s", fpt.read().strip())
+        os.remove(stale)
+
+    def renew(self, key):
+        """Renew the lease of the file being produced."""
+        os.utime(self._lease_path(key))
+
+    def _owns_lease(self, key, owner):
+        try:
+            with open(self._lease_path(key), 'r') as fpt:
+                return fpt.read().strip() == owner
+        except FileNotFoundError:
+            return False
+
+    def _keep_lease(self, key, owner, done):
+        while not done.wait(self.lease_timeout / 3.0):
+            try:
+                if not self._owns_lease(key, owner):
+                    LOG.warning("The NWP cache lease of %s was taken over by another host", key)
+                    return
+                self.renew(key)
+            except OSError:
+                LOG.warning("Failed renewing the NWP cache lease of %s", key)
+
+    def _release_lease(self, key, owner):
+        """Remove the lease, unless another host took it over in the meantime."""
+        try:
+            if self._owns_lease(key, owner):
+                os.remove(self._lease_path(key))
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self, now=None):
+        """Remove the files older than the maximum age from the cache.
+
+        The files already linked into the NWP directories of the hosts are kept
+        there. Return the number of files removed.
+        """
+        if self.max_age is None:
+            return 0
+        now = time.time() if now is None else now
+        removed = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime > self.max_age:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            LOG.info("Removed %d old files from the NWP cache %s", removed, self.cache_dir)
+        return removed
+
+    def fetch(self, key, dest, produce):
+        """Get the file *key* from the cache into *dest*, producing it if no other host does.
+
+        The *produce* function is called with the path to write the file to,
+        if this host is elected producer. Return True if *dest* was created,
+        False if the production failed. Raise NwpCacheTimeout if another host
+        did not produce the file within the wait timeout.
+        """
+        cached = self.path(key)
+        deadline = None if self.wait_timeout is None else time.monotonic() + self.wait_timeout
+        while True:
+            if os.path.exists(cached):
+                LOG.info("Use the NWP file %s from the shared cache", cached)
+                try:
+                    link_or_copy(cached, dest)
+                    return True
+                except FileNotFoundError:
+                    # Removed by the cleanup of another host in the meantime
+                    continue
+
+            if self._try_lease(key):
+                return self._produce(key, cached, dest, produce)
+
+            if deadline is not None and time.monotonic() > deadline:
+                raise NwpCacheTimeout("NWP file %s not produced in time" % cached)
+            LOG.debug("Wait for another host producing %s", cached)
+            time.sleep(self.poll_interval)
+
+    def _produce(self, key, cached, dest, produce):
+        tmp_cached = "{}.{}.tmp".format(cached, _unique_suffix())
+        owner = _owner()
+        done = threading.Event()
+        renewer = threading.Thread(target=self._keep_lease, args=(key, owner, done), daemon=True)
+        renewer.start()
+        try:
+            if not os.path.exists(cached):
+                produce(tmp_cached)
+                if not os.path.exists(tmp_cached):
+                    return False
+                os.rename(tmp_cached, cached)
+            link_or_copy(cached, dest)
+        finally:
+            done.set()
+            renewer.join()
+            if os.path.exists(tmp_cached):
+                os.remove(tmp_cached)
+            self._release_lease(key, owner)
+        self.cleanup()
+        return True
+
+
+def create_nwp_cache(options):
+    """Create the shared NWP cache from the configuration, or None if not configured."""
+    cache_dir = options.get('nwp_shared_cache_dir')
+    if not cache_dir:
+        return None
+    wait_timeout = options.get('nwp_shared_cache_wait_timeout')
+    return SharedNwpCache(cache_dir,
+                          lease_timeout=float(options.get('nwp_shared_cache_lease_timeout', DEFAULT_LEASE_TIMEOUT)),
+                          poll_interval=float(options.get('nwp_shared_cache_poll_interval', DEFAULT_POLL_INTERVAL)),
+                          wait_timeout=None if wait_timeout is None else float(wait_timeout),
+                          max_age=float(options.get('nwp_shared_cache_max_age', DEFAULT_MAX_AGE)))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent inventory of the NWP input files.
+
+The information parsed from the NWP file names (analysis time, forecast step,
+...) is kept on disk together with the size and modification time of each
+file, so that only new or changed files need to be parsed again.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+LOG = logging.getLogger(__name__)
+
+#: Name of the inventory file (in the NWP output directory) if none is configured
+DEFAULT_INVENTORY_FILENAME = '.nwp_input_inventory.json'
+
+#: The file has not yet been prepared
+STATUS_NEW = 'new'
+#: The NWP file for PPS has been prepared from this file
+STATUS_DONE = 'done'
+#: The preparation failed
+STATUS_FAILED = 'failed'
+#: The NWP file prepared from this file lacked fields required by PPS
+STATUS_INCOMPLETE = 'incomplete'
+#: The file name could not be parsed
+STATUS_INVALID = 'invalid'
+
+_INVENTORIES = {}
+_INVENTORIES_LOCK = threading.Lock()
+
+
+def _encode(obj):
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.strptime(obj['__datetime__'], '%Y-%m-%dT%H:%M:%S.%f')
+    return obj
+
+
+class NwpInventory(object):
+    """Inventory of NWP input files, keyed by file name, size and modification time.
+
+    If *filename* is None the inventory is only kept in memory.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self._dirty = False
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Read the inventory from disk."""
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as fpt:
+                self.entries = json.load(fpt, object_hook=_decode)
+        except (IOError, OSError, ValueError):
+            LOG.warning("Failed reading the NWP inventory %s, starting a new one", self.filename)
+            self.entries = {}
+
+    def save(self):
+        """Write the inventory to disk, if anything changed."""
+        with self._lock:
+            if self.filename is None or not self._dirty:
+                return
+            try:
+                fd, tmp_filename = tempfile.mkstemp(prefix='.nwp_inventory',
+                                                    dir=os.path.dirname(self.filename) or '.')
+                with os.fdopen(fd, 'w') as fpt:
+                    json.dump(self.entries, fpt, default=_encode)
+                os.rename(tmp_filename, self.filename)
+                self._dirty = False
+            except (IOError, OSError):
+                LOG.exception("Failed writing the NWP inventory %s", self.filename)
+
+    def scan(self, directory, prefix, parse_func):
+        """Get the files in *directory* starting with *prefix*, and their parsed information.
+
+        The *parse_func* is called with the full path of the new or changed
+        files only, and returns a dictionary of information (or None if the
+        file name could not be parsed). Return a sorted list of (path,
+        information) tuples, where the information is None for the files
+        that could not be parsed.
+        """
+        found = {}
+        with self._lock:
+            try:
+                dir_entries = list(os.scandir(directory))
+            except OSError:
+                LOG.warning("Failed listing the NWP input directory %s", str(directory))
+                dir_entries = []
+
+            for dir_entry in dir_entries:
+                if not dir_entry.name.startswith(prefix):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                record = self.entries.get(dir_entry.path)
+                if record is None or record['size'] != stat.st_size or record['mtime'] != stat.st_mtime_ns:
+                    info = parse_func(dir_entry.path)
+                    record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'info': info,
+                              'status': STATUS_NEW if info is not None else STATUS_INVALID}
+                    self.entries[dir_entry.path] = record
+                    self._dirty = True
+                found[dir_entry.path] = record
+
+            self._forget_removed_files(directory, prefix, found)
+
+        return [(path, found[path]['info']) for path in sorted(found)]
+
+    def _forget_removed_files(self, directory, prefix, found):
+        for path in list(self.entries):
+            if path not in found and os.path.dirname(path) == os.path.normpath(directory) and \
+                    os.path.basename(path).startswith(prefix):
+                del self.entries[path]
+                self._dirty = True
+
+    def get_status(self, path):
+        """Get the processing status of the file, or None if it is not in the inventory."""
+        with self._lock:
+            record = self.entries.get(path)
+            return record and record['status']
+
+    def set_status(self, path, status):
+        """Set the processing status of a file already in the inventory."""
+        with self._lock:
+            record = self.entries.get(path)
+            if record is not None and record['status'] != status:
+                record['status'] = status
+                self._dirty = True
+
+
+def get_inventory(filename=None):
+    """Get the inventory stored in *filename*, shared by all the callers in this process."""
+    with _INVENTORIES_LOCK:
+        if filename not in _INVENTORIES:
+            _INVENTORIES[filename] = NwpInventory(filename)
+        return _INVENTORIES[filename]
+
+
+def get_inventory_filename(options):
+    """Get the path of the inventory file from the configuration.
+
+    The *nwp_inventory_file* option is used if set, otherwise a hidden file in
+    the *nwp_outdir*.
+    """
+    filename = options.get('nwp_inventory_file')
+    if filename:
+        return filename
+    if options.get('nwp_outdir'):
+        return os.path.join(options['nwp_outdir'], DEFAULT_INVENTORY_FILENAME)
+    return None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The NWP fields required by PPS.
+
+The mandatory fields are the lines starting with "M" in the PPS NWP
+requirements file, e.g. "M 235 Skin temperature 0 surface". The file is read
+once and kept in memory until it is modified.
+"""
+
+import logging
+import os
+import threading
+from collections import namedtuple
+
+LOG = logging.getLogger(__name__)
+
+_REQUIREMENTS_CACHE = {}
+_REQUIREMENTS_LOCK = threading.Lock()
+
+
+class NwpContentReport(namedtuple('NwpContentReport', ['gribfile', 'missing', 'checked'])):
+    """Result of checking the fields of an NWP file against the PPS requirements.
+
+    *missing* is the set of mandatory fields not in the file, and *checked* is
+    False if the requirements could not be read.
+    """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """Check if the file has all the mandatory fields."""
+        return not self.missing
+
+
+def read_requirements(filename):
+    """Read the set of mandatory fields ("paramId name level typeOfLevel") from the requirements file."""
+    with open(filename, 'r') as fpt:
+        return frozenset(line[1:].strip() for line in fpt if line.startswith('M'))
+
+
+def get_requirements(filename):
+    """Get the set of mandatory fields, reading the requirements file only if it changed."""
+    stat = os.stat(filename)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _REQUIREMENTS_LOCK:
+        cached = _REQUIREMENTS_CACHE.get(filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    fields = read_requirements(filename)
+    with _REQUIREMENTS_LOCK:
+        _REQUIREMENTS_CACHE[filename] = (key, fields)
+    return fields
+
+
+def get_required_keys(filename):
+    """Get the set of (paramId, level) of the mandatory fields."""
+    keys = set()
+    for field in get_requirements(filename):
+        items = field.split()
+        keys.add((int(items[0]), int(items[-2])))
+    return keys
+
+
+def check_fields(fields, requirements_filename, gribfile=None):
+    """Check the *fields* of the NWP file *gribfile* against the mandatory fields.
+
+    Return a NwpContentReport.
+    """
+    try:
+        required = get_requirements(requirements_filename)
+    except (IOError, OSError, TypeError):
+        LOG.exception("Failed reading nwp-requirements file: %s", requirements_filename)
+        return NwpContentReport(gribfile, frozenset(), False)
+    return NwpContentReport(gribfile, required.difference(fields), True)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Background preparation of the NWP data for PPS.
+
+The NWP data are prepared by a background thread whenever new files arrive in
+the NWP input directories (or at a regular interval), instead of before every
+scene. Concurrent requests for preparation are served by one single run
+(single-flight), and the scene jobs only need to check that no new NWP input
+is waiting to be prepared.
+"""
+
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+#: Default seconds between checks of the NWP input directories
+DEFAULT_SCAN_INTERVAL = 60
+#: Default seconds between preparation runs, even if no new input has been detected
+DEFAULT_REFRESH_INTERVAL = 3600
+#: Default seconds a scene job waits for the NWP preparation before running PPS anyway
+DEFAULT_WAIT_TIMEOUT = 600
+
+#: Configuration options holding NWP input directories to watch
+NWP_INPUT_PATH_OPTIONS = ['nhsf_path', 'nhsp_path', 'ecmwf_path']
+
+
+class _Flight(object):
+    """One ongoing preparation run."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.success = False
+
+
+class NwpPreparationService(threading.Thread):
+    """Run the NWP preparation in the background.
+
+    The *prepare_func* is called (without arguments) when a change is detected
+    in any of the *watch_paths* directories, and at least every
+    *refresh_interval* seconds. Changes in the *output_paths* directories made
+    during a preparation run are its own writes, and do not trigger a new run.
+    """
+
+    def __init__(self, prepare_func, watch_paths=None, scan_interval=DEFAULT_SCAN_INTERVAL,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL, output_paths=None):
+        threading.Thread.__init__(self, name="NwpPreparation")
+        self.daemon = True
+        self.loop = True
+        self.prepare_func = prepare_func
+        self.watch_paths = [path for path in (watch_paths or []) if path]
+        self.output_paths = set(os.path.realpath(path) for path in (output_paths or []) if path)
+        self.scan_interval = scan_interval
+        self.refresh_interval = refresh_interval
+        self.generation = 0
+        self.prepared_generation = None
+        self.last_success = None
+        self._lock = threading.Lock()
+        self._state_changed = threading.Condition(self._lock)
+        self._flight = None
+        self._trigger = threading.Event()
+        self._input_state = self.scan_input()
+
+    def stop(self):
+        """Stop the service."""
+        self.loop = False
+        self._trigger.set()
+
+    def scan_input(self):
+        """Get the modification times of the watched directories (a cheap way to detect new files)."""
+        state = []
+        for path in self.watch_paths:
+            try:
+                state.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                state.append(None)
+        return tuple(state)
+
+    def _ignore_own_writes(self):
+        """Take the current state of the watched directories written to by the preparation."""
+        state = self.scan_input()
+        self._input_state = tuple(new if os.path.realpath(path) in self.output_paths else old
+                                  for path, old, new in zip(self.watch_paths, self._input_state, state))
+
+    def check_input(self):
+        """Check the input directories and flag the NWP data as outdated if they changed."""
+        state = self.scan_input()
+        if state != self._input_state:
+            LOG.info("New NWP input detected")
+            with self._lock:
+                self._input_state = state
+                self.generation += 1
+            return True
+        return False
+
+    def is_ready(self):
+        """Check if the NWP preparation is up to date with the latest detected input."""
+        with self._lock:
+            return self.prepared_generation == self.generation
+
+    def trigger(self):
+        """Ask the background thread for a preparation run."""
+        self._trigger.set()
+
+    def prepare(self):
+        """Prepare the NWP data, joining the ongoing run if there is one.
+
+        Return True if the preparation (the one run or joined) succeeded.
+        """
+        with self._lock:
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = _Flight()
+                generation = self.generation
+
+        if not leader:
+            LOG.debug("NWP preparation already running, wait for it")
+            flight.done.wait()
+            return flight.success
+
+        try:
+            self.prepare_func()
+            flight.success = True
+        except Exception:
+            LOG.exception("Failed preparing the NWP data")
+        finally:
+            with self._lock:
+                self._flight = None
+                self._ignore_own_writes()
+                if flight.success:
+                    self.prepared_generation = generation
+                    self.last_success = time.time()
+                self._state_changed.notify_all()
+            flight.done.set()
+
+        return flight.success
+
+    def wait_until_ready(self, timeout=DEFAULT_WAIT_TIMEOUT):
+        """Wait until the NWP data are prepared for the latest input.
+
+        Return False if the timeout expired before that.
+        """
+        self.check_input()
+        if self.is_ready():
+            return True
+
+        LOG.info("Wait for the NWP preparation...")
+        self.trigger()
+        with self._lock:
+            ready = self._state_changed.wait_for(lambda: self.prepared_generation == self.generation, timeout)
+        if not ready:
+            LOG.warning("NWP preparation not ready after %s seconds", str(timeout))
+        return ready
+
+    def run(self):
+        while self.loop:
+            triggered = self._trigger.wait(self.scan_interval)
+            self._trigger.clear()
+            if not self.loop:
+                break
+            outdated = self.check_input() or not self.is_ready()
+            too_old = self.last_success is None or time.time() - self.last_success > self.refresh_interval
+            if triggered or outdated or too_old:
+                self.prepare()
+
+
+def create_nwp_service(prepare_func, options):
+    """Create the background NWP preparation service from the runner configuration."""
+    watch_paths = [options.get(name) for name in NWP_INPUT_PATH_OPTIONS]
+    return NwpPreparationService(prepare_func, watch_paths=watch_paths, output_paths=[options.get('nwp_outdir')],
+                                 scan_interval=float(options.get('nwp_scan_interval', DEFAULT_SCAN_INTERVAL)),
+                                 refresh_interval=float(options.get('nwp_refresh_interval',
+                                                                    DEFAULT_REFRESH_INTERVAL)))
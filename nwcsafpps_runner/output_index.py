@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Index of the PPS output files of a directory, by platform and orbit.
+
+The PPS output and statistics directories may hold a very large number of
+files. Instead of globbing the whole directory for every scene, the file names
+are read once and indexed on (platform, orbit number). The directory is read
+again only when its modification time changed, and then only the new names are
+parsed, so that a lookup costs a stat of the directory and of the matching
+files.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+LOG = logging.getLogger(__name__)
+
+#: Seconds during which the modification time of a directory can not be trusted
+#: to change when files are added, as it has a coarse resolution
+MTIME_GRANULARITY = 2.0
+
+#: Pattern of the PPS output file names, like S_NWC_CMA_noaa19_12345_20210101T0100000Z_20210101T0115000Z.nc
+OUTPUT_NAME = re.compile(r'^S_NWC.*_(?P<platform>[^_]+)_(?P<orbit>\d{5,})_(?P<start>.*)\.(?P<ext>h5|nc|xml)$')
+
+OutputFile = namedtuple('OutputFile', ['name', 'start', 'ext'])
+
+
+class OutputFileIndex(object):
+    """Index of the PPS output files in the directory *path*."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._names = {}
+        self._scenes = {}
+
+    def refresh(self):
+        """Read the directory again if it changed since the last time."""
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                LOG.warning("Can not read the output directory %s", self.path)
+                return
+            if mtime == self._mtime:
+                return
+            self._scan()
+            if time.time() - mtime / 1e9 < MTIME_GRANULARITY:
+                # Files added in the same tick would not change the time, read again next time
+                self._mtime = None
+            else:
+                self._mtime = mtime
+
+    def _scan(self):
+        with os.scandir(self.path) as entries:
+            names = set(entry.name for entry in entries)
+        for name in set(self._names) - names:
+            key = self._names.pop(name)
+            if key is not None:
+                self._scenes[key] = [outfile for outfile in self._scenes[key] if outfile.name != name]
+                if not self._scenes[key]:
+                    del self._scenes[key]
+        for name in names.difference(self._names):
+            match = OUTPUT_NAME.match(name)
+            key = None
+            if match is not None:
+                key = (match.group('platform'), int(match.group('orbit')))
+                self._scenes.setdefault(key, []).append(OutputFile(name, match.group('start'), match.group('ext')))
+            self._names[name] = key
+
+    def lookup(self, platform_name, orbit, st_time='', extensions=('h5', 'nc', 'xml')):
+        """Get the names of the files of the scene with the given platform and orbit.
+
+        Only the files with a start time beginning with *st_time* and with one
+        of the *extensions* are returned.
+        """
+        self.refresh()
+        with self._lock:
+            outfiles = list(self._scenes.get((platform_name, int(orbit)), []))
+        return sorted(outfile.name for outfile in outfiles
+                      if outfile.ext in extensions and outfile.start.startswith(st_time))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_output_index(path):
+    """Get the index of the output directory *path*, shared in the process."""
+    path = os.path.abspath(str(path))
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = OutputFileIndex(path)
+        return _indexes[path]
@@ -30,20 +30,25 @@ import sys
 import threading
 from datetime import datetime, timedelta
 from glob import glob
-from subprocess import PIPE, Popen
 
 from six.moves.queue import Empty, Queue
 
+from nwcsafpps_runner.async_runner import AsyncPPSRunner
 from nwcsafpps_runner.config import CONFIG_FILE, CONFIG_PATH, MODE, get_config
+from nwcsafpps_runner.nwp_service import DEFAULT_WAIT_TIMEOUT, create_nwp_service
 from nwcsafpps_runner.prepare_nwp import update_nwp
-from nwcsafpps_runner.publish_and_listen import FileListener, FilePublisher
+from nwcsafpps_runner.process_supervisor import get_process_supervisor
+from nwcsafpps_runner.publish_and_listen import FileListener, FilePublisher, create_message_deduplicator
+from nwcsafpps_runner.scene_log import create_scene_log
+from nwcsafpps_runner.scene_store import create_scene_store, replay_journal
+from nwcsafpps_runner.worker_pool import WorkerPool, create_scheduling_policy
 from nwcsafpps_runner.utils import (METOP_NAME_LETTER, SATELLITE_NAME,
                                     SENSOR_LIST, NwpPrepareError, PpsRunError,
                                     create_pps2018_call_command,
                                     get_outputfiles, get_pps_inputfile,
-                                    get_sceneid, logreader, message_uid,
+                                    get_sceneid, message_uid,
                                     prepare_pps_arguments, publish_pps_files,
-                                    ready2run, terminate_process)
+                                    ready2run)
 
 LOG = logging.getLogger(__name__)
 
@@ -62,32 +67,22 @@ LOG.debug("PYTHONPATH: " + str(sys.path))
 SATNAME = {'Aqua': 'EOS-Aqua'}
 
 
-class ThreadPool(object):
+def create_pps_commands(scene, options):
+    """Create the PPS command lines to run (in sequence) on the scene."""
 
-    def __init__(self, max_nthreads=None):
+    py_exec = options.get('python', '/bin/python')
+    pps_script = options.get('run_all_script')
+    cmd_str = create_pps2018_call_command(py_exec, pps_script, scene, sequence=False)
+    run_cpp = options.get('run_pps_cpp', None)
+    if not run_cpp:
+        cmd_str = cmd_str + ' --no_cpp'
+    commands = [cmd_str]
 
-        self.jobs = set()
-        self.sema = threading.Semaphore(max_nthreads)
-        self.lock = threading.Lock()
+    if options['run_cmask_prob']:
+        pps_script = options.get('run_cmaprob_script')
+        commands.append(create_pps2018_call_command(py_exec, pps_script, scene, sequence=False))
 
-    def new_thread(self, job_id, group=None, target=None, name=None, args=(), kwargs={}):
-
-        def new_target(*args, **kwargs):
-            with self.sema:
-                result = target(*args, **kwargs)
-
-            self.jobs.remove(job_id)
-            return result
-
-        with self.lock:
-            if job_id in self.jobs:
-                LOG.info("Job with id %s already running!", str(job_id))
-                return
-
-            self.jobs.add(job_id)
-
-        thread = threading.Thread(group, new_target, name, args, kwargs)
-        thread.start()
+    return commands
 
 
 def pps_worker(scene, publish_q, input_msg, options):
@@ -114,23 +109,7 @@ def pps_worker(scene, publish_q, input_msg, options):
 
         min_thr = options['maximum_pps_processing_time_in_minutes']
         LOG.debug("Maximum allowed  PPS processing time in minutes: %d", min_thr)
-        # # Run core PPS PGEs in a serial fashion
-        # LOG.info("Run PPS module: pps_run_all_serial")
-        # pps_run_all_serial(**kwargs)
-
-        # # Run the PPS CmaskProb (probabilistic Cloudmask):
-        # if CMA_PROB:
-        #     LOG.info("Run PPS module: pps_cmask_prob")
-        #     pps_cmask_prob(**kwargs)
-        # else:
-        #     LOG.info("Will skip running the PPS module: pps_cmask_prob (probablistic cloud mask)")
-
-        py_exec = options.get('python', '/bin/python')
-        pps_script = options.get('run_all_script')
-        cmd_str = create_pps2018_call_command(py_exec, pps_script, scene, sequence=False)
-        run_cpp = options.get('run_pps_cpp', None)
-        if not run_cpp:
-            cmd_str = cmd_str + ' --no_cpp'
+
         my_env = os.environ.copy()
         for envkey in my_env:
             LOG.debug("ENV: " + str(envkey) + " " + str(my_env[envkey]))
@@ -139,115 +118,96 @@ def pps_worker(scene, publish_q, input_msg, options):
         LOG.debug("PPS_OUTPUT_DIR = " + str(pps_output_dir))
         LOG.debug("...from config file = " + str(options['pps_outdir']))
 
-        LOG.debug("Run command: " + str(cmd_str))
+        scene_log = create_scene_log(options, scene)
+        returncode = 0
         try:
-            pps_all_proc = Popen(cmd_str, shell=True, stderr=PIPE, stdout=PIPE)
-        except PpsRunError:
-            LOG.exception("Failed in PPS...")
-
-        t__ = threading.Timer(min_thr * 60.0, terminate_process, args=(pps_all_proc, scene, ))
-        t__.start()
-
-        out_reader = threading.Thread(
-            target=logreader, args=(pps_all_proc.stdout, LOG.info))
-        err_reader = threading.Thread(
-            target=logreader, args=(pps_all_proc.stderr, LOG.info))
-        out_reader.start()
-        err_reader.start()
-        out_reader.join()
-        err_reader.join()
+            for cmd_str in create_pps_commands(scene, options):
+                LOG.debug("Run command: " + str(cmd_str))
+                try:
+                    pps_proc = get_process_supervisor().launch(
+                        cmd_str, shell=True, timeout=min_thr * 60.0, log_func=LOG.info, scene=scene,
+                        stdout=scene_log.open() if scene_log is not None else None)
+                except PpsRunError:
+                    LOG.exception("Failed in PPS...")
+
+                returncode = pps_proc.result() or returncode
+        finally:
+            if scene_log is not None:
+                scene_log.close(returncode)
 
         LOG.info("Ready with PPS level-2 processing on scene: " + str(scene))
 
-        if options['run_cmask_prob']:
-            pps_script = options.get('run_cmaprob_script')
-            cmdl = create_pps2018_call_command(py_exec, pps_script, scene, sequence=False)
-
-            LOG.debug("Run command: " + str(cmdl))
-            try:
-                pps_cmaprob_proc = Popen(cmdl, shell=True, stderr=PIPE, stdout=PIPE)
-            except PpsRunError:
-                LOG.exception("Failed when trying to run the PPS Cma-prob")
-            timer_cmaprob = threading.Timer(min_thr * 60.0, terminate_process, args=(pps_cmaprob_proc, scene, ))
-            timer_cmaprob.start()
-
-            out_reader2 = threading.Thread(
-                target=logreader, args=(pps_cmaprob_proc.stdout, LOG.info))
-            err_reader2 = threading.Thread(
-                target=logreader, args=(pps_cmaprob_proc.stderr, LOG.info))
-            out_reader2.start()
-            err_reader2.start()
-            out_reader2.join()
-            err_reader2.join()
-
-        # Now try perform some time statistics editing with ppsTimeControl.py from
-        # pps:
-        do_time_control = True
-        try:
-            from pps_time_control import PPSTimeControl
-        except ImportError:
-            LOG.warning("Failed to import the PPSTimeControl from pps")
-            do_time_control = False
-        #: Create the start time (format dateTtime) to be used in file findings
-        if SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) == 'seviri':
-            st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S.%f")
-        elif (SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) in ['viirs', 'modis'] or
-              'avhrr/3' in SENSOR_LIST.get(scene['platform_name'], scene['platform_name'])):
-            st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S")
-        else:
-            st_time = ''
-        pps_control_path = my_env.get('STATISTICS_DIR', options.get('pps_statistics_dir', './'))
-        if do_time_control:
-            LOG.info("Read time control ascii file and generate XML")
-            platform_id = SATELLITE_NAME.get(
-                scene['platform_name'], scene['platform_name'])
-            LOG.info("pps platform_id = " + str(platform_id))
-            txt_time_file = (os.path.join(pps_control_path, 'S_NWC_timectrl_') +
-                             str(METOP_NAME_LETTER.get(platform_id, platform_id)) +
-                             '_' + '%.5d' % scene['orbit_number'] + '_' +
-                             st_time +
-                             '*.txt')
-            LOG.info("glob string = " + str(txt_time_file))
-            infiles = glob(txt_time_file)
-            LOG.info(
-                "Time control ascii file candidates: " + str(infiles))
-            if len(infiles) == 1:
-                infile = str(infiles[0])
-                LOG.info("Time control ascii file: " + str(infile))
-                ppstime_con = PPSTimeControl(infile)
-                ppstime_con.sum_up_processing_times()
-                try:
-                    ppstime_con.write_xml()
-                except Exception as e:  # TypeError as e:
-                    LOG.warning('Not able to write time control xml file')
-                    LOG.warning(e)
-        # The PPS post-hooks takes care of publishing the PPS cloud products
-        # For the XML files we keep the publishing from here:
-        xml_files = get_outputfiles(pps_control_path,
-                                    SATELLITE_NAME[scene['platform_name']],
-                                    scene['orbit_number'],
-                                    st_time=st_time,
-                                    xml_output=True)
-
-        LOG.info("PPS summary statistics files: " + str(xml_files))
-
-        # Now publish:
-        publish_pps_files(input_msg, publish_q, scene, xml_files,
-                          environment=MODE, servername=options['servername'],
-                          station=options['station'])
+        pps_post_processing(scene, publish_q, input_msg, options)
 
         dt_ = datetime.utcnow() - job_start_time
         LOG.info("PPS on scene " + str(scene) + " finished. It took: " + str(dt_))
 
-        t__.cancel()
-        if options['run_cmask_prob']:
-            timer_cmaprob.cancel()
-
     except Exception:
         LOG.exception('Failed in pps_worker...')
         raise
 
 
+def pps_post_processing(scene, publish_q, input_msg, options):
+    """Generate the time control xml file and publish the PPS statistics files."""
+
+    # Now try perform some time statistics editing with ppsTimeControl.py from
+    # pps:
+    do_time_control = True
+    try:
+        from pps_time_control import PPSTimeControl
+    except ImportError:
+        LOG.warning("Failed to import the PPSTimeControl from pps")
+        do_time_control = False
+    #: Create the start time (format dateTtime) to be used in file findings
+    if SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) == 'seviri':
+        st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S.%f")
+    elif (SENSOR_LIST.get(scene['platform_name'], scene['platform_name']) in ['viirs', 'modis'] or
+          'avhrr/3' in SENSOR_LIST.get(scene['platform_name'], scene['platform_name'])):
+        st_time = scene['starttime'].strftime("%Y%m%dT%H%M%S")
+    else:
+        st_time = ''
+    pps_control_path = os.environ.get('STATISTICS_DIR', options.get('pps_statistics_dir', './'))
+    if do_time_control:
+        LOG.info("Read time control ascii file and generate XML")
+        platform_id = SATELLITE_NAME.get(
+            scene['platform_name'], scene['platform_name'])
+        LOG.info("pps platform_id = " + str(platform_id))
+        txt_time_file = (os.path.join(pps_control_path, 'S_NWC_timectrl_') +
+                         str(METOP_NAME_LETTER.get(platform_id, platform_id)) +
+                         '_' + '%.5d' % scene['orbit_number'] + '_' +
+                         st_time +
+                         '*.txt')
+        LOG.info("glob string = " + str(txt_time_file))
+        infiles = glob(txt_time_file)
+        LOG.info(
+            "Time control ascii file candidates: " + str(infiles))
+        if len(infiles) == 1:
+            infile = str(infiles[0])
+            LOG.info("Time control ascii file: " + str(infile))
+            ppstime_con = PPSTimeControl(infile)
+            ppstime_con.sum_up_processing_times()
+            try:
+                ppstime_con.write_xml()
+            except Exception as e:  # TypeError as e:
+                LOG.warning('Not able to write time control xml file')
+                LOG.warning(e)
+    # The PPS post-hooks takes care of publishing the PPS cloud products
+    # For the XML files we keep the publishing from here:
+    xml_files = get_outputfiles(pps_control_path,
+                                SATELLITE_NAME[scene['platform_name']],
+                                scene['orbit_number'],
+                                st_time=st_time,
+                                xml_output=True)
+
+    LOG.info("PPS summary statistics files: " + str(xml_files))
+
+    # Now publish:
+    publish_pps_files(input_msg, publish_q, scene, xml_files,
+                      environment=MODE, servername=options['servername'],
+                      station=options['station'],
+                      dataset=options.get('publish_dataset_message', False))
+
+
 def check_threads(threads):
     """Scan all threads and join those that are finished (dead)."""
 
@@ -262,13 +222,33 @@ def check_threads(threads):
             threads.remove(thread)
 
 
-def run_nwp_and_pps(scene, flens, publish_q, input_msg, options, nwp_handeling_module):
-    """Run first the nwp-preparation and then pps. No parallel running here."""
+def run_nwp_and_pps(scene, flens, publish_q, input_msg, options, nwp_handeling_module, nwp_service=None):
+    """Run first the nwp-preparation and then pps. No parallel running here.
+
+    If the NWP data are prepared by a background *nwp_service* only wait for it
+    to be up to date.
+    """
 
-    prepare_nwp4pps(flens, nwp_handeling_module)
+    if nwp_service is not None:
+        nwp_service.wait_until_ready(float(options.get('nwp_wait_timeout', DEFAULT_WAIT_TIMEOUT)))
+    else:
+        prepare_nwp4pps(flens, nwp_handeling_module)
     pps_worker(scene, publish_q, input_msg, options)
 
 
+def run_scene_job(files4pps, scene, *args, **kwargs):
+    """Run the nwp-preparation and pps on the scene, and record in the scene store when it is done."""
+    try:
+        run_nwp_and_pps(scene, *args, **kwargs)
+    finally:
+        files4pps.scene_done(get_sceneid(scene['platform_name'], scene['orbit_number'], scene['starttime']))
+
+
+def drop_scene_job(files4pps, mda):
+    """Record in the scene store that the scene of the message metadata *mda* will not be processed."""
+    files4pps.scene_dropped(get_sceneid(mda['platform_name'], int(mda['orbit_number']), mda['start_time']))
+
+
 def prepare_nwp4pps(flens, nwp_handeling_module):
     """Prepare NWP data for pps."""
 
@@ -305,6 +285,47 @@ def prepare_nwp4pps(flens, nwp_handeling_module):
     LOG.debug("Leaving prepare_nwp4pps...")
 
 
+def get_scene_if_ready(msg, files4pps, options):
+    """Add the level-1 files of the message to the scene and return the scene if ready to be processed.
+
+    Returns None if more data are needed before PPS can be run on the scene.
+    """
+
+    if 'sensor' in msg.data and isinstance(msg.data['sensor'], list):
+        msg.data['sensor'] = msg.data['sensor'][0]
+    if 'orbit_number' not in msg.data:
+        msg.data.update({'orbit_number': 99999})
+    if 'end_time' not in msg.data:
+        msg.data.update({'end_time': 99999})
+
+    orbit_number = int(msg.data['orbit_number'])
+    platform_name = msg.data['platform_name']
+    starttime = msg.data['start_time']
+    endtime = msg.data['end_time']
+
+    satday = starttime.strftime('%Y%m%d')
+    sathour = starttime.strftime('%H%M')
+    sensors = SENSOR_LIST.get(platform_name, None)
+    scene = {'platform_name': platform_name,
+             'orbit_number': orbit_number,
+             'satday': satday, 'sathour': sathour,
+             'starttime': starttime, 'endtime': endtime,
+             'sensor': sensors
+             }
+
+    status = ready2run(msg, files4pps,
+                       stream_tag_name=options.get('stream_tag_name', 'variant'),
+                       stream_name=options.get('stream_name', 'EARS'),
+                       sdr_granule_processing=options.get('sdr_processing') == 'granules')
+    if not status:
+        return None
+
+    sceneid = get_sceneid(platform_name, orbit_number, starttime)
+    scene['file4pps'] = get_pps_inputfile(platform_name, files4pps.pop(sceneid, []))
+    LOG.debug("Scene store: %s", str(files4pps.stats()))
+    return scene
+
+
 def pps(options):
     """The PPS runner.
 
@@ -316,18 +337,70 @@ def pps(options):
 
     LOG.info("First check if NWP data should be downloaded and prepared")
     nwp_handeling_module = options.get("nwp_handeling_module", None)
-    prepare_nwp4pps(NWP_FLENS, nwp_handeling_module)
+    nwp_service = None
+    if options.get('nwp_background_preparation'):
+        LOG.info("Prepare the NWP data in the background")
+        nwp_service = create_nwp_service(lambda: prepare_nwp4pps(NWP_FLENS, nwp_handeling_module), options)
+        nwp_service.start()
+        if not nwp_service.wait_until_ready(float(options.get('nwp_wait_timeout', DEFAULT_WAIT_TIMEOUT))):
+            LOG.error("No NWP data prepared at start up, keep trying in the background")
+    else:
+        prepare_nwp4pps(NWP_FLENS, nwp_handeling_module)
 
-    files4pps = {}
+    if options.get('runner_mode', 'threads') == 'asyncio':
+        LOG.info("Run all scenes in one event loop")
+        if nwp_service is not None:
+            def prepare_nwp():
+                nwp_service.wait_until_ready(float(options.get('nwp_wait_timeout', DEFAULT_WAIT_TIMEOUT)))
+        else:
+            def prepare_nwp():
+                prepare_nwp4pps(NWP_FLENS, nwp_handeling_module)
+        runner = AsyncPPSRunner(options,
+                                create_scene=get_scene_if_ready,
+                                prepare_nwp=prepare_nwp,
+                                create_commands=create_pps_commands,
+                                post_process=pps_post_processing,
+                                runner_name='pps2018_runner')
+        runner.run()
+        return
+
+    files4pps = create_scene_store(options)
     LOG.info("Number of threads: %d", options['number_of_threads'])
-    thread_pool = ThreadPool(options['number_of_threads'])
+    worker_pool = None
+    if options['number_of_threads'] > 1:
+        worker_pool = WorkerPool(options['number_of_threads'],
+                                 high_water_mark=options.get('pending_jobs_high_water_mark'),
+                                 policy=create_scheduling_policy(options),
+                                 on_drop=lambda job_id, mda: drop_scene_job(files4pps, mda))
 
     listener_q = Queue()
     publisher_q = Queue()
 
     pub_thread = FilePublisher(publisher_q, options['publish_topic'], runner_name='pps2018_runner')
     pub_thread.start()
-    listen_thread = FileListener(listener_q, options['subscribe_topics'])
+
+    def handle_message(msg):
+        scene = get_scene_if_ready(msg, files4pps, options)
+        if scene:
+            if worker_pool is None:
+                LOG.info('Prepare the nwp data and run pps...')
+                run_scene_job(files4pps, scene, NWP_FLENS, publisher_q,
+                              msg, options, nwp_handeling_module, nwp_service=nwp_service)
+            else:
+                LOG.info('Queue a job preparing the nwp data and run pps...')
+                if not worker_pool.submit(message_uid(msg),
+                                          target=run_scene_job, args=(files4pps, scene, NWP_FLENS,
+                                                                      publisher_q,
+                                                                      msg, options,
+                                                                      nwp_handeling_module),
+                                          kwargs={'nwp_service': nwp_service},
+                                          mda=msg.data):
+                    drop_scene_job(files4pps, msg.data)
+                LOG.debug("Worker pool status: %s", str(worker_pool.stats()))
+
+    replay_journal(files4pps, handle_message)
+    listen_thread = FileListener(listener_q, options['subscribe_topics'], backpressure=worker_pool,
+                                 deduplicator=create_message_deduplicator(options))
     listen_thread.start()
 
     while True:
@@ -338,66 +411,15 @@ def pps(options):
 
         LOG.debug(
             "Number of threads currently alive: " + str(threading.active_count()))
-        if 'sensor' in msg.data and isinstance(msg.data['sensor'], list):
-            msg.data['sensor'] = msg.data['sensor'][0]
-        if 'orbit_number' not in msg.data:
-            msg.data.update({'orbit_number': 99999})
-        if 'end_time' not in msg.data:
-            msg.data.update({'end_time': 99999})
-
-        orbit_number = int(msg.data['orbit_number'])
-        platform_name = msg.data['platform_name']
-        starttime = msg.data['start_time']
-        endtime = msg.data['end_time']
-
-        satday = starttime.strftime('%Y%m%d')
-        sathour = starttime.strftime('%H%M')
-        sensors = SENSOR_LIST.get(platform_name, None)
-        scene = {'platform_name': platform_name,
-                 'orbit_number': orbit_number,
-                 'satday': satday, 'sathour': sathour,
-                 'starttime': starttime, 'endtime': endtime,
-                 'sensor': sensors
-                 }
-
-        status = ready2run(msg, files4pps,
-                           stream_tag_name=options.get('stream_tag_name', 'variant'),
-                           stream_name=options.get('stream_name', 'EARS'),
-                           sdr_granule_processing=options.get('sdr_processing') == 'granules')
-        if status:
-            sceneid = get_sceneid(platform_name, orbit_number, starttime)
-            scene['file4pps'] = get_pps_inputfile(platform_name, files4pps[sceneid])
-
-            LOG.info('Start a thread preparing the nwp data and run pps...')
-
-            if options['number_of_threads'] == 1:
-                run_nwp_and_pps(scene, NWP_FLENS, publisher_q,
-                                msg, options, nwp_handeling_module)
-            else:
-                thread_pool.new_thread(message_uid(msg),
-                                       target=run_nwp_and_pps, args=(scene, NWP_FLENS,
-                                                                     publisher_q,
-                                                                     msg, options,
-                                                                     nwp_handeling_module))
-
-            LOG.debug(
-                "Number of threads currently alive: " +
-                str(threading.active_count()))
-
-            # Clean the files4pps dict:
-            LOG.debug("files4pps: " + str(files4pps))
-            try:
-                files4pps.pop(sceneid)
-            except KeyError:
-                LOG.warning("Failed trying to remove key " + str(sceneid) +
-                            " from dictionary files4pps")
-
-            LOG.debug("After cleaning: files4pps = " + str(files4pps))
 
-    # FIXME! Should I clean up the thread_pool (open threads?) here at the end!?
+        handle_message(msg)
 
     pub_thread.stop()
     listen_thread.stop()
+    if worker_pool is not None:
+        worker_pool.shutdown()
+    if nwp_service is not None:
+        nwp_service.stop()
 
 
 if __name__ == "__main__":
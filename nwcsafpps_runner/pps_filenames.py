@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Parse the names of the PPS output files.
+
+The trollsift patterns of the output files are compiled once into regular
+expressions. The registry tries only the patterns whose fixed prefix and
+suffix fit the file name, in order, and returns a PpsFileInfo record.
+"""
+
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from trollsift.parser import get_convert_dict, regex_format
+
+LOG = logging.getLogger(__name__)
+
+PPS_OUT_PATTERN = ("S_NWC_{segment}_{orig_platform_name}_{orbit_number:05d}_" +
+                   "{start_time:%Y%m%dT%H%M%S%f}Z_{end_time:%Y%m%dT%H%M%S%f}Z.{extention}")
+PPS_OUT_PATTERN_MULTIPLE = ("S_NWC_{segment1}_{segment2}_{orig_platform_name}_{orbit_number:05d}_" +
+                            "{start_time:%Y%m%dT%H%M%S%f}Z_{end_time:%Y%m%dT%H%M%S%f}Z.{extention}")
+PPS_STAT_PATTERN = ("S_NWC_{segment}_{orig_platform_name}_{orbit_number:05d}_" +
+                    "{start_time:%Y%m%dT%H%M%S%f}Z_{end_time:%Y%m%dT%H%M%S%f}Z_statistics.xml")
+
+#: Time format of the PPS file names, parsed without strptime when possible
+PPS_TIME_FORMAT = '%Y%m%dT%H%M%S%f'
+
+PpsFileInfo = namedtuple('PpsFileInfo', ['segment', 'platform_name', 'orbit_number',
+                                         'start_time', 'end_time', 'extension'])
+
+
+def _fixed_parts(pattern):
+    """Get the constant text before the first field and after the last field of the *pattern*."""
+    prefix = pattern.split('{', 1)[0]
+    suffix = pattern.rsplit('}', 1)[1]
+    return prefix, suffix
+
+
+def parse_pps_time(text, fmt=PPS_TIME_FORMAT):
+    """Parse a time of a PPS file name, like 20210305T0715000."""
+    if fmt == PPS_TIME_FORMAT and len(text) <= 21 and text[8:9] == 'T' and text[:8].isdigit() and text[9:].isdigit():
+        # %f takes 1 to 6 digits, and is padded on the right
+        return datetime(int(text[0:4]), int(text[4:6]), int(text[6:8]),
+                        int(text[9:11]), int(text[11:13]), int(text[13:15]),
+                        int(text[15:].ljust(6, '0')))
+    return datetime.strptime(text, fmt)
+
+
+class PpsFilenameParser(object):
+    """Parser of the file names matching one trollsift *pattern*."""
+
+    def __init__(self, pattern, extension=None):
+        self.pattern = pattern
+        self.extension = extension
+        self.prefix, self.suffix = _fixed_parts(pattern)
+        self._regex = re.compile('^' + regex_format(pattern) + '$')
+        self._time_formats = dict((key, fmt) for key, fmt in get_convert_dict(pattern).items() if '%' in fmt)
+
+    def fits(self, filename):
+        """Check cheaply if the *filename* may match."""
+        return filename.startswith(self.prefix) and filename.endswith(self.suffix)
+
+    def parse(self, filename):
+        """Parse the *filename*, return a PpsFileInfo record or None if it does not match."""
+        match = self._regex.match(filename)
+        if match is None:
+            return None
+        fields = match.groupdict()
+        for key, fmt in self._time_formats.items():
+            fields[key] = parse_pps_time(fields[key], fmt)
+        if 'segment' in fields:
+            segment = fields['segment']
+        else:
+            segment = '_'.join([fields['segment1'], fields['segment2']])
+        return PpsFileInfo(segment, fields['orig_platform_name'], int(fields['orbit_number']),
+                           fields['start_time'], fields['end_time'], fields.get('extention', self.extension))
+
+
+class PpsFilenameRegistry(object):
+    """Registry of the PPS file name parsers, tried in order."""
+
+    def __init__(self, parsers):
+        self.parsers = list(parsers)
+
+    def parse(self, filename):
+        """Parse the *filename* with the first fitting parser. Raise ValueError if none matches."""
+        for parser in self.parsers:
+            if parser.fits(filename):
+                info = parser.parse(filename)
+                if info is not None:
+                    return info
+        raise ValueError("Unknown PPS file name: %s" % filename)
+
+
+#: The parsers of the PPS output and statistics files
+PPS_FILENAME_REGISTRY = PpsFilenameRegistry([PpsFilenameParser(PPS_STAT_PATTERN, extension='xml'),
+                                             PpsFilenameParser(PPS_OUT_PATTERN),
+                                             PpsFilenameParser(PPS_OUT_PATTERN_MULTIPLE)])
+
+
+def parse_pps_filename(filename):
+    """Parse the name of a PPS output or statistics file."""
+    return PPS_FILENAME_REGISTRY.parse(filename)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A long lived relay publishing the messages from the PPS post-hooks.
+
+The PPS post-hook hands over its (encoded) posttroll message to this relay via
+a unix domain (datagram) socket, and the relay publishes it. This way the
+publisher is registered with the nameserver only once, and not once per PGE.
+
+Optionally the relay coalesces the messages from all PGEs of a scene into one
+single dataset message.
+"""
+
+import os
+import sys
+import socket
+import logging
+import threading
+
+from posttroll.message import Message
+from posttroll.publisher import Publish
+
+from nwcsafpps_runner.pps_posttroll_hook import DEFAULT_AGGREGATION_TIMEOUT, SceneMessageAggregator
+
+LOG = logging.getLogger(__name__)
+
+#: Largest datagram (message) accepted from the hooks
+MAX_DATAGRAM_SIZE = 262144
+#: Seconds between checks of the stop flag when no messages arrive
+SOCKET_TIMEOUT = 1.0
+
+#: Default time format
+_DEFAULT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+#: Default log format
+_DEFAULT_LOG_FORMAT = '[%(levelname)s: %(asctime)s : %(name)s] %(message)s'
+
+
+def bind_relay_socket(socket_path):
+    """Bind a unix domain datagram socket to *socket_path*.
+
+    A socket file left behind by a previous (dead) relay is removed first. If
+    another relay is still listening on *socket_path*, an IOError is raised.
+    """
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            probe.connect(socket_path)
+        except ConnectionRefusedError:
+            LOG.info("Removing old relay socket %s", socket_path)
+            os.remove(socket_path)
+        else:
+            raise IOError("Another relay is listening on %s" % socket_path)
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(socket_path)
+    sock.settimeout(SOCKET_TIMEOUT)
+    return sock
+
+
+class PPSHookRelay(threading.Thread):
+    """Receive messages from the PPS post-hooks and publish them via posttroll."""
+
+    def __init__(self, socket_path, publish_name='PPS', port=0, nameservers=None, aggregator=None):
+        threading.Thread.__init__(self)
+        self.loop = True
+        self.socket_path = socket_path
+        self.publish_name = publish_name
+        self.port = port
+        self.nameservers = nameservers
+        self.aggregator = aggregator
+        self.sock = bind_relay_socket(socket_path)
+
+    def stop(self):
+        """Stop the relay."""
+        self.loop = False
+
+    def run(self):
+        try:
+            with Publish(self.publish_name, self.port, nameservers=self.nameservers) as publisher:
+                LOG.info("Hook relay listening on %s", self.socket_path)
+                while self.loop:
+                    try:
+                        data = self.sock.recv(MAX_DATAGRAM_SIZE)
+                    except socket.timeout:
+                        data = None
+                    if data:
+                        self.handle_datagram(data, publisher)
+                    if self.aggregator is not None:
+                        self.publish_messages(self.aggregator.flush_expired(), publisher)
+                if self.aggregator is not None:
+                    self.publish_messages(self.aggregator.flush_all(), publisher)
+        finally:
+            self.sock.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def handle_datagram(self, data, publisher):
+        """Publish the message received from a hook."""
+        msg = data.decode('utf-8')
+        if self.aggregator is None:
+            LOG.info("Publish the message...")
+            LOG.debug("Message = %s", msg)
+            publisher.send(msg)
+            return
+
+        self.publish_messages(self.aggregator.add(Message(rawstr=msg)), publisher)
+
+    def publish_messages(self, messages, publisher):
+        """Encode and publish the (aggregated) messages."""
+        for msg in messages:
+            encoded = msg.encode()
+            LOG.info("Publish the message...")
+            LOG.debug("Message = %s", encoded)
+            publisher.send(encoded)
+
+
+def run_relay(options):
+    """Run the hook relay as configured in the *options*."""
+
+    socket_path = options['pps_hook_relay_socket']
+    publish_name = options.get('pps_hook_relay_name', 'PPS')
+    nameservers = options.get('pps_hook_relay_nameservers')
+
+    aggregator = None
+    products = options.get('pps_hook_aggregate_products')
+    if products:
+        timeout = float(options.get('pps_hook_aggregate_timeout', DEFAULT_AGGREGATION_TIMEOUT))
+        LOG.info("Coalesce the messages of each scene. Products: %s", str(products))
+        aggregator = SceneMessageAggregator(products, timeout=timeout,
+                                            topic=options.get('pps_hook_aggregate_topic'))
+
+    relay = PPSHookRelay(socket_path, publish_name=publish_name, nameservers=nameservers,
+                         aggregator=aggregator)
+    relay.start()
+    try:
+        while relay.is_alive():
+            relay.join(1.0)
+    except KeyboardInterrupt:
+        LOG.info("Stopping the hook relay")
+        relay.stop()
+        relay.join()
+
+
+if __name__ == "__main__":
+
+    from nwcsafpps_runner.config import CONFIG_FILE, get_config
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(fmt=_DEFAULT_LOG_FORMAT,
+                                  datefmt=_DEFAULT_TIME_FORMAT)
+    handler.setFormatter(formatter)
+    logging.getLogger('').addHandler(handler)
+    logging.getLogger('').setLevel(logging.DEBUG)
+    logging.getLogger('posttroll').setLevel(logging.INFO)
+
+    LOG = logging.getLogger('pps_hook_relay')
+
+    run_relay(get_config(CONFIG_FILE))
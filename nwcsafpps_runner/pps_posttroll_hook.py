@@ -74,6 +74,17 @@ MANDATORY_FIELDS_FROM_YAML = {'level': 'data_processing_level',
 
 VARIANT_TRANSLATE = {'DR': 'direct_readout'}
 
+#: Message keywords describing one single file, and thus not common to all files of a scene
+FILE_SPECIFIC_KEYS = ['uri', 'uid', 'module', 'dataset']
+#: Default number of seconds to wait for the remaining PGEs of a scene before publishing what we have
+DEFAULT_AGGREGATION_TIMEOUT = 120
+
+#: Keywords in the yaml config used to steer the hook, not to be part of the message
+HOOK_CONFIG_KEYS = ['relay_socket']
+
+#: Environment variable with the file where the hook reports the output files to the runner job
+SPOOL_FILE_ENV = 'PPS_HOOK_SPOOL_FILE'
+
 SEC_DURATION_ONE_GRANULE = 1.779
 MIN_VIIRS_GRANULE_LENGTH_SECONDS = timedelta(seconds=60)
 MAX_VIIRS_GRANULE_LENGTH_SECONDS = timedelta(seconds=88)
@@ -118,6 +129,136 @@ class PPSPublisher(threading.Thread):
                     break
 
 
+def send_to_relay(socket_path, msg_to_publish):
+    """Hand over the encoded message to the hook relay listening on *socket_path*.
+
+    Return True if the message was handed over, and False otherwise.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(socket_path)
+        sock.send(msg_to_publish.encode('utf-8'))
+    except OSError as err:
+        LOG.warning("Failed handing over the message to the hook relay %s: %s", socket_path, str(err))
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def report_output_files(filenames, spool_file=None):
+    """Append the *filenames* to the spool file of the runner job that started PPS.
+
+    The spool file is taken from the environment if not given. Each name is
+    written on a line of its own, in one single append, so that the PGEs of a
+    scene may report at the same time.
+    """
+    spool_file = spool_file or os.environ.get(SPOOL_FILE_ENV)
+    if not spool_file:
+        return
+    if not isinstance(filenames, list):
+        filenames = [filenames]
+    lines = ''.join(os.path.abspath(filename) + '\n' for filename in filenames)
+    try:
+        fd = os.open(spool_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError as err:
+        LOG.warning("Failed reporting the output files to %s: %s", spool_file, str(err))
+
+
+class SceneMessageAggregator(object):
+    """Coalesce the messages from the PGEs of one scene into one dataset message.
+
+    The messages are collected per scene (platform, orbit number and start
+    time), and a dataset message is created as soon as all the *products*
+    (e.g. ['CMA', 'CT', 'CTTH']) have been received or when the first message of
+    the scene is older than *timeout* seconds.
+    """
+
+    def __init__(self, products, timeout=DEFAULT_AGGREGATION_TIMEOUT, topic=None):
+        self.products = set(products)
+        self.timeout = timeout
+        self.topic = topic
+        self._scenes = {}
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def add(self, msg):
+        """Add a (decoded) PGE message and return the list of messages ready to be published."""
+
+        if msg.type not in ['file', 'dataset']:
+            return [msg]
+        try:
+            key = (msg.data['platform_name'], msg.data.get('orbit_number'), msg.data['start_time'])
+        except KeyError:
+            LOG.debug("Message can not be related to a scene, publish it as is")
+            return [msg]
+
+        pps_product = PPS_PRODUCT_FILE_ID.get(msg.data.get('module'), 'UNKNOWN')
+        if key not in self._scenes:
+            data = dict((attr, val) for attr, val in msg.data.items() if attr not in FILE_SPECIFIC_KEYS)
+            self._scenes[key] = {'received': time.time(),
+                                 'subject': self._create_topic(msg.subject, pps_product),
+                                 'data': data,
+                                 'dataset': [],
+                                 'products': set()}
+
+        scene = self._scenes[key]
+        if msg.type == 'dataset':
+            files = msg.data['dataset']
+        else:
+            files = [{'uri': msg.data['uri'], 'uid': msg.data.get('uid')}]
+        for item in files:
+            scene['dataset'].append(dict(item, product=pps_product))
+        scene['products'].add(pps_product)
+
+        if self.products.issubset(scene['products']):
+            LOG.info("All products available for scene %s", str(key))
+            return [self._create_dataset_message(self._scenes.pop(key))]
+        return []
+
+    def flush_expired(self, now=None):
+        """Return the dataset messages of the scenes waited for longer than the timeout."""
+
+        now = now or time.time()
+        expired = [key for key, scene in self._scenes.items() if now - scene['received'] > self.timeout]
+        messages = []
+        for key in expired:
+            scene = self._scenes.pop(key)
+            LOG.warning("Timeout waiting for products %s for scene %s",
+                        str(sorted(self.products - scene['products'])), str(key))
+            messages.append(self._create_dataset_message(scene))
+        return messages
+
+    def flush_all(self):
+        """Return the dataset messages of all the scenes still waited for, e.g. at shutdown."""
+
+        messages = []
+        for key, scene in self._scenes.items():
+            LOG.warning("Publish scene %s without products %s",
+                        str(key), str(sorted(self.products - scene['products'])))
+            messages.append(self._create_dataset_message(scene))
+        self._scenes = {}
+        return messages
+
+    def _create_topic(self, subject, pps_product):
+        """Create the topic for the dataset message from the topic of a PGE message."""
+        if self.topic:
+            return self.topic
+        return subject.replace('/' + pps_product + '/', '/', 1)
+
+    @staticmethod
+    def _create_dataset_message(scene):
+        data = dict(scene['data'])
+        data['dataset'] = scene['dataset']
+        return Message(scene['subject'], 'dataset', data)
+
+
 class PPSMessage(object):
 
     """A Posttroll message class to trigger the sending of a notifcation that a PPS PGE is ready
@@ -150,6 +291,8 @@ class PPSMessage(object):
         """Send the message based on the metadata and the fields picked up from the yaml config."""
 
         self._collect_all_metadata(mda)
+        if status == 0 and 'filename' in self.metadata:
+            report_output_files(self.metadata['filename'])
         message = PostTrollMessage(status, self.metadata)
         message.send()
 
@@ -220,6 +363,13 @@ class PostTrollMessage(object):
         posttroll_msg = Message(mymessage['header'], mymessage['type'], mymessage['content'])
         msg_to_publish = posttroll_msg.encode()
 
+        relay_socket = self.metadata.get('relay_socket')
+        if relay_socket:
+            LOG.info("Sending via the hook relay: " + str(msg_to_publish))
+            if send_to_relay(relay_socket, msg_to_publish):
+                return
+            LOG.warning("Will publish the message without the relay")
+
         manager = Manager()
         publisher_q = manager.Queue()
 
@@ -273,7 +423,7 @@ class PostTrollMessage(object):
         msg = {}
         for key in self.metadata:
             # Disregard the PPS keyword "filename". We will use URI/UID instead - see below:
-            if key not in msg and key != 'filename':
+            if key not in msg and key != 'filename' and key not in HOOK_CONFIG_KEYS:
                 msg[key] = self.metadata[key]
 
             if key == 'platform_name':
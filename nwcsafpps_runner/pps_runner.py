@@ -25,7 +25,6 @@
 import os
 import sys
 from glob import glob
-from subprocess import Popen, PIPE
 import threading
 from six.moves.queue import Queue
 from datetime import datetime, timedelta
@@ -35,14 +34,18 @@ from nwcsafpps_runner.config import MODE
 from nwcsafpps_runner.config import CONFIG_FILE
 from nwcsafpps_runner.config import CONFIG_PATH
 from nwcsafpps_runner.utils import ready2run, publish_pps_files
-from nwcsafpps_runner.utils import (terminate_process,
-                                    create_pps_call_command_sequence,
-                                    PpsRunError, logreader, get_outputfiles,
-                                    message_uid)
+from nwcsafpps_runner.utils import (create_pps_call_command_sequence,
+                                    PpsRunError, get_outputfiles,
+                                    message_uid, create_output_spool, read_output_spool,
+                                    get_sceneid)
 from nwcsafpps_runner.utils import (SENSOR_LIST,
                                     SATELLITE_NAME,
                                     METOP_NAME_LETTER)
-from nwcsafpps_runner.publish_and_listen import FileListener, FilePublisher
+from nwcsafpps_runner.publish_and_listen import FileListener, FilePublisher, create_message_deduplicator
+from nwcsafpps_runner.worker_pool import WorkerPool, create_scheduling_policy
+from nwcsafpps_runner.scene_store import create_scene_store
+from nwcsafpps_runner.pps_posttroll_hook import SPOOL_FILE_ENV
+from nwcsafpps_runner.process_supervisor import get_process_supervisor
 
 from nwcsafpps_runner.prepare_nwp import update_nwp
 
@@ -65,34 +68,6 @@ _DEFAULT_LOG_FORMAT = '[%(levelname)s: %(asctime)s : %(name)s] %(message)s'
 LOG.debug("PYTHONPATH: %s", str(sys.path))
 
 
-class ThreadPool(object):
-
-    def __init__(self, max_nthreads=None):
-
-        self.jobs = set()
-        self.sema = threading.Semaphore(max_nthreads)
-        self.lock = threading.Lock()
-
-    def new_thread(self, job_id, group=None, target=None, name=None, args=(), kwargs={}):
-
-        def new_target(*args, **kwargs):
-            with self.sema:
-                result = target(*args, **kwargs)
-
-            self.jobs.remove(job_id)
-            return result
-
-        with self.lock:
-            if job_id in self.jobs:
-                LOG.info("Job with id %s already running!", str(job_id))
-                return
-
-            self.jobs.add(job_id)
-
-        thread = threading.Thread(group, new_target, name, args, kwargs)
-        thread.start()
-
-
 def pps_worker(scene, publish_q, input_msg, options):
     """Start PPS on a scene
 
@@ -122,23 +97,18 @@ def pps_worker(scene, publish_q, input_msg, options):
             raise IOError(
                 "PPS script" + PPS_SCRIPT + " cannot be executed!")
 
+        # The post-hooks report the files they publish in the spool file
+        spool_file = create_output_spool(options.get('pps_hook_spool_dir'), scene)
+        my_env[SPOOL_FILE_ENV] = spool_file
+
+        min_thr = options.get('maximum_pps_processing_time_in_minutes', 20)
         try:
-            pps_proc = Popen(pps_call_args, shell=False, stderr=PIPE, stdout=PIPE)
+            pps_proc = get_process_supervisor().launch(pps_call_args, env=my_env, timeout=min_thr * 60.0,
+                                                       log_func=LOG.info, scene=scene)
         except PpsRunError:
             LOG.exception("Failed in PPS...")
 
-        min_thr = options.get('maximum_pps_processing_time_in_minutes', 20)
-        t__ = threading.Timer(min_thr * 60.0, terminate_process, args=(pps_proc, scene, ))
-        t__.start()
-
-        out_reader = threading.Thread(
-            target=logreader, args=(pps_proc.stdout, LOG.info))
-        err_reader = threading.Thread(
-            target=logreader, args=(pps_proc.stderr, LOG.info))
-        out_reader.start()
-        err_reader.start()
-        out_reader.join()
-        err_reader.join()
+        pps_proc.result()
 
         LOG.info("Ready with PPS level-2 processing on scene: %s", str(scene))
 
@@ -173,12 +143,16 @@ def pps_worker(scene, publish_q, input_msg, options):
 
         # Now check what netCDF/hdf5 output was produced and publish
         # them:
-        pps_path = pps_output_dir
-        result_files = get_outputfiles(pps_path,
-                                       SATELLITE_NAME[scene['platform_name']],
-                                       scene['orbit_number'],
-                                       h5_output=True,
-                                       nc_output=True)
+        result_files = read_output_spool(spool_file)
+        if result_files:
+            LOG.info("Output files reported by the PPS post-hooks")
+        else:
+            LOG.info("No output files reported by the PPS post-hooks, search %s", pps_output_dir)
+            result_files = get_outputfiles(pps_output_dir,
+                                           SATELLITE_NAME[scene['platform_name']],
+                                           scene['orbit_number'],
+                                           h5_output=True,
+                                           nc_output=True)
         LOG.info("PPS Output files: %s", str(result_files))
         xml_files = get_outputfiles(pps_control_path,
                                     SATELLITE_NAME[scene['platform_name']],
@@ -191,13 +165,12 @@ def pps_worker(scene, publish_q, input_msg, options):
                           result_files + xml_files,
                           environment=MODE,
                           servername=options['servername'],
-                          station=options['station'])
+                          station=options['station'],
+                          dataset=options.get('publish_dataset_message', False))
 
         dt_ = datetime.utcnow() - job_start_time
         LOG.info("PPS on scene %s finished. It took: %s", str(scene), str(dt_))
 
-        t__.cancel()
-
     except Exception:
         LOG.exception('Failed in pps_worker...')
         raise
@@ -237,13 +210,16 @@ def pps(options):
     listener_q = Queue.Queue()
     publisher_q = Queue.Queue()
 
+    files4pps = create_scene_store(options, use_journal=False)
+    worker_pool = WorkerPool(options['number_of_threads'],
+                             high_water_mark=options.get('pending_jobs_high_water_mark'),
+                             policy=create_scheduling_policy(options))
+
     pub_thread = FilePublisher(publisher_q, options['publish_topic'], runner_name='pps_runner')
     pub_thread.start()
-    listen_thread = FileListener(listener_q, options['subscribe_topics'])
+    listen_thread = FileListener(listener_q, options['subscribe_topics'], backpressure=worker_pool,
+                                 deduplicator=create_message_deduplicator(options))
     listen_thread.start()
-
-    files4pps = {}
-    thread_pool = ThreadPool(options['number_of_threads'])
     while True:
 
         try:
@@ -270,18 +246,20 @@ def pps(options):
 
         status = ready2run(msg, files4pps)
         if status:
+            files4pps.pop(get_sceneid(platform_name, orbit_number, starttime))
 
-            LOG.info('Start a thread preparing the nwp data and run pps...')
-            thread_pool.new_thread(message_uid(msg),
-                                   target=run_nwp_and_pps, args=(scene, NWP_FLENS,
-                                                                 publisher_q,
-                                                                 msg, options))
+            LOG.info('Queue a job preparing the nwp data and run pps...')
+            worker_pool.submit(message_uid(msg),
+                               target=run_nwp_and_pps, args=(scene, NWP_FLENS,
+                                                             publisher_q,
+                                                             msg, options),
+                               mda=msg.data)
 
-            LOG.debug(
-                "Number of threads currently alive: " + str(threading.active_count()))
+            LOG.debug("Worker pool status: %s", str(worker_pool.stats()))
 
     pub_thread.stop()
     listen_thread.stop()
+    worker_pool.shutdown()
 
 
 if __name__ == "__main__":
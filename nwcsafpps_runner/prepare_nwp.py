@@ -23,20 +23,22 @@
 """Prepare NWP data for PPS
 """
 
-from glob import glob
 import os
 from datetime import datetime
 import time
 import tempfile
 from trollsift import Parser
-import pygrib  # @UnresolvedImport
-from six.moves.configparser import NoOptionError
 
 from nwcsafpps_runner.config import get_config
 from nwcsafpps_runner.config import CONFIG_FILE
 from nwcsafpps_runner.config import CONFIG_PATH  # @UnresolvedImport
-from nwcsafpps_runner.utils import run_command
+from nwcsafpps_runner.utils import run_command, run_jobs
 from nwcsafpps_runner.utils import NwpPrepareError
+from nwcsafpps_runner.nwp_assembly import assemble_nwp_file, ecc, read_grib_index
+from nwcsafpps_runner.nwp_cache import NwpCacheTimeout, content_key, create_nwp_cache
+from nwcsafpps_runner.nwp_inventory import get_inventory, get_inventory_filename
+from nwcsafpps_runner.nwp_inventory import STATUS_DONE, STATUS_FAILED, STATUS_INCOMPLETE, STATUS_NEW
+from nwcsafpps_runner.nwp_requirements import check_fields
 
 import logging
 LOG = logging.getLogger(__name__)
@@ -63,6 +65,9 @@ nwp_outdir = OPTIONS.get('nwp_outdir', None)
 nwp_lsmz_filename = OPTIONS.get('nwp_static_surface', None)
 nwp_output_prefix = OPTIONS.get('nwp_output_prefix', None)
 nwp_req_filename = OPTIONS.get('pps_nwp_requirements', None)
+#: How to assemble the NWP files: eccodes (in-process) or grib_copy (grib_copy and cat)
+nwp_assembly = OPTIONS.get('nwp_assembly', 'grib_copy' if ecc is None else 'eccodes')
+nwp_cache = create_nwp_cache(OPTIONS)
 
 
 def logreader(stream, log_func):
@@ -80,6 +85,48 @@ def make_temp_filename(*args, **kwargs):
     return tmp_filename
 
 
+def parse_nhsf_filename(parser, filename):
+    """Get the analysis time, forecast step (hours) and time info from the name of an nhsf file.
+
+    Return None if the file name does not match the *parser* pattern.
+    """
+    basename = os.path.basename(filename)
+    if not parser.validate(basename):
+        LOG.error("Parser validate on filename: {} failed.".format(filename))
+        return None
+    LOG.info("{}".format(basename))
+    res = parser.parse(basename)
+    LOG.info("{}".format(res))
+    if 'analysis_time' in res:
+        if res['analysis_time'].year == 1900:
+            res['analysis_time'] = res['analysis_time'].replace(year=datetime.utcnow().year)
+
+        analysis_time = res['analysis_time']
+    else:
+        raise NwpPrepareError("Can not parse analysis_time in file name. Check config and filename timestamp")
+
+    if 'forecast_time' in res:
+        if res['forecast_time'].year == 1900:
+            res['forecast_time'] = res['forecast_time'].replace(year=datetime.utcnow().year)
+        forecast_time = res['forecast_time']
+        forecast_step = forecast_time - analysis_time
+        forecast_step = int(forecast_step.days * 24 + forecast_step.seconds / 3600)
+        timeinfo = "{:s}{:s}{:s}".format(analysis_time.strftime(
+            "%m%d%H%M"), forecast_time.strftime("%m%d%H%M"), res['end'])
+    else:
+        LOG.info("Can not parse forecast_time in file name. Try forecast step...")
+        # This needs to be done more solid using the sift pattern! FIXME!
+        timeinfo = filename.rsplit("_", 1)[-1]
+        # Forecast step in hours:
+        if 'forecast_step' in res:
+            forecast_step = res['forecast_step']
+        else:
+            raise NwpPrepareError(
+                'Failed parsing forecast_step in file name. Check config and filename timestamp.')
+
+    return {'analysis_time': analysis_time, 'forecast_step': forecast_step, 'timeinfo': timeinfo}
+
+
 def update_nwp(starttime, nlengths):
     """Prepare NWP grib files for PPS. Consider only analysis times newer than
     *starttime*. And consider only the forecast lead times in hours given by
@@ -93,55 +140,31 @@ def update_nwp(starttime, nlengths):
     LOG.info("Path to nhsp files: %s", str(nhsp_path))
 
     tempfile.tempdir = nwp_outdir
-    filelist = glob(os.path.join(nhsf_path, nhsf_prefix + "*"))
+    if nhsf_file_name_sift is None:
+        raise NwpPrepareError()
+    parser = Parser(nhsf_file_name_sift)
+
+    inventory = get_inventory(get_inventory_filename(OPTIONS))
+    try:
+        _update_nwp(starttime, nlengths, parser, inventory)
+    finally:
+        inventory.save()
+
+
+def _update_nwp(starttime, nlengths, parser, inventory):
+    filelist = inventory.scan(nhsf_path, nhsf_prefix, lambda filename: parse_nhsf_filename(parser, filename))
     if len(filelist) == 0:
         LOG.info("No input files! dir = %s", str(nhsf_path))
         return
 
-    LOG.debug('NHSF NWP files found = %s', str(filelist))
-    nfiles_error = 0
-    for filename in filelist:
-        if nhsf_file_name_sift is None:
-            raise NwpPrepareError()
-
-        try:
-            parser = Parser(nhsf_file_name_sift)
-        except NoOptionError as noe:
-            LOG.error("NoOptionError {}".format(noe))
-            continue
-        if not parser.validate(os.path.basename(filename)):
-            LOG.error("Parser validate on filename: {} failed.".format(filename))
+    LOG.debug('NHSF NWP files found = %s', str([filename for filename, _ in filelist]))
+    jobs = {}
+    for filename, fileinfo in filelist:
+        if fileinfo is None:
             continue
-        LOG.info("{}".format(os.path.basename(filename)))
-        res = parser.parse("{}".format(os.path.basename(filename)))
-        LOG.info("{}".format(res))
-        if 'analysis_time' in res:
-            if res['analysis_time'].year == 1900:
-                res['analysis_time'] = res['analysis_time'].replace(year=datetime.utcnow().year)
-
-            analysis_time = res['analysis_time']
-            timestamp = analysis_time.strftime("%Y%m%d%H%M")
-        else:
-            raise NwpPrepareError("Can not parse analysis_time in file name. Check config and filename timestamp")
-
-        if 'forecast_time' in res:
-            if res['forecast_time'].year == 1900:
-                res['forecast_time'] = res['forecast_time'].replace(year=datetime.utcnow().year)
-            forecast_time = res['forecast_time']
-            forecast_step = forecast_time - analysis_time
-            forecast_step = "{:03d}H{:02d}M".format(forecast_step.days*24 + forecast_step.seconds/3600, 0)
-            timeinfo = "{:s}{:s}{:s}".format(analysis_time.strftime(
-                "%m%d%H%M"), forecast_time.strftime("%m%d%H%M"), res['end'])
-        else:
-            LOG.info("Can not parse forecast_time in file name. Try forecast step...")
-            # This needs to be done more solid using the sift pattern! FIXME!
-            timeinfo = filename.rsplit("_", 1)[-1]
-            # Forecast step in hours:
-            if 'forecast_step' in res:
-                forecast_step = res['forecast_step']
-            else:
-                raise NwpPrepareError(
-                    'Failed parsing forecast_step in file name. Check config and filename timestamp.')
+        analysis_time = fileinfo['analysis_time']
+        forecast_step = fileinfo['forecast_step']
+        timestamp = analysis_time.strftime("%Y%m%d%H%M")
 
         LOG.debug("Analysis time and start time: %s %s", str(analysis_time), str(starttime))
         if analysis_time < starttime:
@@ -154,81 +177,154 @@ def update_nwp(starttime, nlengths):
         result_file = os.path.join(
             nwp_outdir, nwp_output_prefix + timestamp + "+" + '%.3dH00M' % forecast_step)
         if os.path.exists(result_file):
-            LOG.info("File: " + str(result_file) + " already there...")
+            # Done entries are made again only if their result file was removed
+            if inventory.get_status(filename) != STATUS_DONE:
+                LOG.info("File: " + str(result_file) + " already there...")
+                inventory.set_status(filename, STATUS_DONE)
             continue
 
-        tmp_filename = make_temp_filename(suffix="_" + timestamp + "+" +
-                                          '%.3dH00M' % forecast_step, dir=nwp_outdir)
-
-        LOG.info("result and tmp files: " + str(result_file) + " " + str(tmp_filename))
-        nhsp_file = os.path.join(nhsp_path, nhsp_prefix + timeinfo)
-        if not os.path.exists(nhsp_file):
-            LOG.warning("Corresponding nhsp-file not there: " + str(nhsp_file))
-            continue
+        jobs[(fileinfo['timeinfo'], timestamp, forecast_step, result_file)] = filename
 
-        cmd = ("grib_copy -w gridType=regular_ll " + nhsp_file + " " + tmp_filename)
-        retv = run_command(cmd)
-        LOG.debug("Returncode = " + str(retv))
-        if retv != 0:
-            LOG.error(
-                "Failed doing the grib-copy! Will continue with the next file")
+    nworkers = int(OPTIONS.get('nwp_prepare_workers', 1))
+    niceness = int(OPTIONS.get('nwp_prepare_niceness', 0))
+    nfiles_error = 0
+    for job, status in run_jobs(prepare_nwp_file, list(jobs), nworkers, niceness):
+        inventory.set_status(jobs[job], status)
+        # Only the failures of grib_copy (or of the assembly replacing it) count, not the missing fields
+        if status == STATUS_FAILED:
             nfiles_error = nfiles_error + 1
             if nfiles_error > len(filelist) / 2:
                 LOG.error(
                     "More than half of the Grib files failed upon grib_copy!")
                 raise IOError('Failed running grib_copy on many Grib files')
 
-        if not os.path.exists(nwp_lsmz_filename):
-            LOG.error("No static grib file with land-sea mask and " +
-                      "topography available. Can't prepare NWP data")
-            raise IOError('Failed getting static land-sea mask and topography')
-
-        tmp_result_filename = make_temp_filename()
-        cmd = ('cat ' + tmp_filename + " " +
-               os.path.join(nhsf_path, nhsf_prefix + timeinfo) +
-               " " + nwp_lsmz_filename + " > " + tmp_result_filename)
-        LOG.debug("Add topography and land-sea mask to data:")
-        LOG.debug("Command = " + str(cmd))
+
+def prepare_nwp_file(timeinfo, timestamp, forecast_step, result_file):
+    """Prepare one NWP file for PPS, for one analysis time and forecast step.
+
+    The file is written to a temporary file and renamed to *result_file* when
+    ready. Return the processing status of the input file.
+    """
+    nhsp_file = os.path.join(nhsp_path, nhsp_prefix + timeinfo)
+    if not os.path.exists(nhsp_file):
+        LOG.warning("Corresponding nhsp-file not there: " + str(nhsp_file))
+        return STATUS_NEW
+
+    if not os.path.exists(nwp_lsmz_filename):
+        LOG.error("No static grib file with land-sea mask and " +
+                  "topography available. Can't prepare NWP data")
+        raise IOError('Failed getting static land-sea mask and topography')
+
+    if nwp_cache is not None:
+        return _prepare_with_shared_cache(timeinfo, timestamp, forecast_step, nhsp_file, result_file)
+    return _produce_nwp_file(timeinfo, timestamp, forecast_step, nhsp_file, result_file)
+
+
+def _produce_nwp_file(timeinfo, timestamp, forecast_step, nhsp_file, result_file):
+    if nwp_assembly == 'eccodes':
+        return _assemble_nwp_file(timeinfo, nhsp_file, result_file)
+    return _grib_copy_and_cat(timeinfo, timestamp, forecast_step, nhsp_file, result_file)
+
+
+def _prepare_with_shared_cache(timeinfo, timestamp, forecast_step, nhsp_file, result_file):
+    """Get the NWP file from the shared cache, making it if this host is elected to."""
+    statuses = []
+
+    def _produce(path):
+        statuses.append(_produce_nwp_file(timeinfo, timestamp, forecast_step, nhsp_file, path))
+
+    key = content_key([nhsp_file, os.path.join(nhsf_path, nhsf_prefix + timeinfo), nwp_lsmz_filename])
+    try:
+        if nwp_cache.fetch(key, result_file, _produce):
+            return STATUS_DONE
+    except NwpCacheTimeout:
+        LOG.warning("No NWP file from the shared cache, make it here: %s", result_file)
+        return _produce_nwp_file(timeinfo, timestamp, forecast_step, nhsp_file, result_file)
+    return statuses[0] if statuses else STATUS_FAILED
+
+
+def _assemble_nwp_file(timeinfo, nhsp_file, result_file):
+    tmp_result_filename = make_temp_filename(dir=os.path.dirname(result_file))
+    try:
+        fields = assemble_nwp_file(tmp_result_filename,
+                                   [(nhsp_file, 'regular_ll'),
+                                    (os.path.join(nhsf_path, nhsf_prefix + timeinfo), None),
+                                    (nwp_lsmz_filename, None)])
+    except Exception:
+        LOG.exception("Failed assembling the nwp file %s! Will continue with the next file", result_file)
+        os.remove(tmp_result_filename)
+        return STATUS_FAILED
+
+    return _check_and_rename(fields, tmp_result_filename, result_file)
+
+
+def _grib_copy_and_cat(timeinfo, timestamp, forecast_step, nhsp_file, result_file):
+    tmp_filename = make_temp_filename(suffix="_" + timestamp + "+" +
+                                      '%.3dH00M' % forecast_step, dir=nwp_outdir)
+
+    LOG.info("result and tmp files: " + str(result_file) + " " + str(tmp_filename))
+    cmd = ("grib_copy -w gridType=regular_ll " + nhsp_file + " " + tmp_filename)
+    retv = run_command(cmd)
+    LOG.debug("Returncode = " + str(retv))
+    if retv != 0:
+        LOG.error(
+            "Failed doing the grib-copy! Will continue with the next file")
+        os.remove(tmp_filename)
+        return STATUS_FAILED
+
+    tmp_result_filename = make_temp_filename(dir=os.path.dirname(result_file))
+    cmd = ('cat ' + tmp_filename + " " +
+           os.path.join(nhsf_path, nhsf_prefix + timeinfo) +
+           " " + nwp_lsmz_filename + " > " + tmp_result_filename)
+    LOG.debug("Add topography and land-sea mask to data:")
+    LOG.debug("Command = " + str(cmd))
+    _start = time.time()
+    retv = os.system(cmd)
+    _end = time.time()
+    LOG.debug("os.system call took: %f seconds", _end - _start)
+    LOG.debug("Returncode = " + str(retv))
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    else:
+        LOG.warning("tmp file %s gone! Cannot clean it...", tmp_filename)
+    if retv != 0:
+        LOG.warning("Failed generating nwp file %s ...", result_file)
+        if os.path.exists(tmp_result_filename):
+            os.remove(tmp_result_filename)
+        raise IOError("Failed adding topography and land-sea " +
+                      "mask data to grib file")
+
+    return _check_and_rename(get_nwp_fields(tmp_result_filename), tmp_result_filename, result_file)
+
+
+def _check_and_rename(fields, tmp_result_filename, result_file):
+    if check_nwp_fields(fields, tmp_result_filename):
+        LOG.info('A check of the NWP file content has been attempted: %s',
+                 result_file)
         _start = time.time()
-        retv = os.system(cmd)
+        os.rename(tmp_result_filename, result_file)
         _end = time.time()
-        LOG.debug("os.system call took: %f seconds", _end - _start)
-        LOG.debug("Returncode = " + str(retv))
-        if retv != 0:
-            LOG.warning("Failed generating nwp file %s ...", result_file)
-            if os.path.exists(tmp_result_filename):
-                os.remove(tmp_result_filename)
-            raise IOError("Failed adding topography and land-sea " +
-                          "mask data to grib file")
-
-        if os.path.exists(tmp_filename):
-            os.remove(tmp_filename)
-        else:
-            LOG.warning("tmp file %s gone! Cannot clean it...", tmp_filename)
-
-        if check_nwp_content(tmp_result_filename):
-            LOG.info('A check of the NWP file content has been attempted: %s',
-                     result_file)
-            _start = time.time()
-            os.rename(tmp_result_filename, result_file)
-            _end = time.time()
-            LOG.debug("Rename file %s to %s: This took %f seconds",
-                      tmp_result_filename, result_file, _end - _start)
-        else:
-            LOG.warning("Missing important fields. No nwp file %s written to disk",
-                        result_file)
-            if os.path.exists(tmp_result_filename):
-                os.remove(tmp_result_filename)
+        LOG.debug("Rename file %s to %s: This took %f seconds",
+                  tmp_result_filename, result_file, _end - _start)
+        return STATUS_DONE
 
-    return
+    LOG.warning("Missing important fields. No nwp file %s written to disk",
+                result_file)
+    if os.path.exists(tmp_result_filename):
+        os.remove(tmp_result_filename)
+    return STATUS_INCOMPLETE
 
 
-def check_nwp_content(gribfile):
-    """Check the content of the NWP file. If all fields required for PPS is
-    available, then return True
+def get_nwp_fields(gribfile):
+    """Get the fields ("paramId name level typeOfLevel") in the NWP file.
 
+    Only the GRIB headers are read if eccodes is available.
     """
+    if ecc is not None:
+        return [msg.field for msg in read_grib_index(gribfile)]
 
+    # Only loaded without eccodes, the two bundled GRIB libraries do not mix in one process
+    import pygrib  # @UnresolvedImport
     with pygrib.open(gribfile) as grbs:
         entries = []
         for grb in grbs:
@@ -236,30 +332,37 @@ def check_nwp_content(gribfile):
                                             grb['name'],
                                             grb['level'],
                                             grb['typeOfLevel']))
-        entries.sort()
+    return entries
 
-    try:
-        with open(nwp_req_filename, 'r') as fpt:
-            lines = fpt.readlines()
-    except IOError:
-        LOG.exception(
-            "Failed reading nwp-requirements file: %s", nwp_req_filename)
-        LOG.warning("Cannot check if NWP files is ok!")
-        return True
 
-    srplines = [ll.strip('M ').strip('\n')
-                for ll in lines if str(ll).startswith('M')]
+def get_nwp_content_report(gribfile):
+    """Check the content of the NWP file against the fields required for PPS.
+
+    Return a NwpContentReport with the missing fields.
+    """
+    return check_fields(get_nwp_fields(gribfile), nwp_req_filename, gribfile)
+
+
+def check_nwp_content(gribfile):
+    """Check the content of the NWP file. If all fields required for PPS is
+    available, then return True
+
+    """
+    return check_nwp_fields(get_nwp_fields(gribfile), gribfile)
+
 
-    file_ok = True
-    for item in srplines:
-        if item not in entries:
-            LOG.warning("Mandatory field missing in NWP file: %s", str(item))
-            file_ok = False
+def check_nwp_fields(entries, gribfile):
+    """Check that all fields required for PPS are among the *entries* of the NWP file *gribfile*."""
+    report = check_fields(entries, nwp_req_filename, gribfile)
+    if not report.checked:
+        LOG.warning("Cannot check if NWP files is ok!")
+    for item in sorted(report.missing):
+        LOG.warning("Mandatory field missing in NWP file: %s", str(item))
 
-    if file_ok:
+    if report.ok:
         LOG.info("NWP file has all required fields for PPS: %s", gribfile)
 
-    return file_ok
+    return report.ok
 
 
 if __name__ == "__main__":
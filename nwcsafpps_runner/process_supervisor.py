@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Supervisor of the subprocesses of the runner, in one thread.
+
+Instead of two reader threads and a timer thread per process, one thread
+reads the output of all the processes with a selector, kills the processes
+passing their deadline (kept in a heap), and reaps the processes with waitpid
+when their pidfd becomes readable (or by polling where pidfds are not
+available). The callers get a future of the exit code.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from subprocess import PIPE, STDOUT, Popen
+
+LOG = logging.getLogger(__name__)
+
+#: Seconds between the checks for exited processes, when there is no pidfd to wait on
+POLL_INTERVAL = 0.5
+#: Bytes read at once from the pipes of the processes
+READ_SIZE = 65536
+#: Longest output line kept in memory, longer lines are logged in pieces
+MAX_LINE_LENGTH = 65536
+#: Exit code of a process reaped by someone else, whose real exit code is unknown
+UNKNOWN_EXIT_CODE = 255
+
+
+def _exit_code(status):
+    """Get the exit code of a wait status, negative for a signal, like Popen does."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class _Child(object):
+
+    __slots__ = ('proc', 'future', 'scene', 'log_func', 'deadline', 'buffers', 'pidfd', 'killed')
+
+    def __init__(self, proc, scene, log_func, deadline):
+        self.proc = proc
+        self.future = Future()
+        self.scene = scene
+        self.log_func = log_func
+        self.deadline = deadline
+        self.buffers = {}
+        self.pidfd = None
+        self.killed = False
+
+
+class ProcessSupervisor(object):
+    """Run the subprocesses, log their output and kill them at their deadline, from one thread."""
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._children = set()
+        self._polled = set()
+        self._deadlines = []
+        self._finished_deadlines = 0
+        self._counter = itertools.count()
+        self._selector = None
+        self._thread = None
+        self._wakeup = None
+        self._stop = False
+
+    def __len__(self):
+        return len(self._children) + len(self._pending)
+
+    def launch(self, args, shell=False, env=None, timeout=None, stdout=None, log_func=None, scene=None):
+        """Start a process and return a future of its exit code.
+
+        Without *stdout* the output of the process is logged line by line with
+        *log_func*, otherwise stdout and stderr go to the *stdout* file. The
+        process is killed after *timeout* seconds.
+        """
+        if stdout is None:
+            proc = Popen(args, shell=shell, env=env, stdout=PIPE, stderr=PIPE)
+        else:
+            proc = Popen(args, shell=shell, env=env, stdout=stdout, stderr=STDOUT)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        child = _Child(proc, scene, log_func or LOG.info, deadline)
+        with self._lock:
+            self._start()
+            self._pending.append(child)
+            self._wake()
+        return child.future
+
+    def shutdown(self, wait=True):
+        """Stop the supervisor thread. The processes still running are killed."""
+        with self._lock:
+            if self._thread is None:
+                return
+            thread = self._thread
+            self._stop = True
+            self._wake()
+        if wait:
+            thread.join()
+
+    def _wake(self):
+        try:
+            os.write(self._wakeup[1], b'\0')
+        except BlockingIOError:
+            pass
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            os.set_blocking(fd, False)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ, None)
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='ProcessSupervisor', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop:
+            try:
+                self._step()
+            except Exception:
+                LOG.exception("Failed in the process supervisor...")
+        with self._lock:
+            self._add_pending()
+            for child in list(self._children):
+                if child.proc.returncode is None:
+                    os.kill(child.proc.pid, signal.SIGKILL)
+                    child.proc.wait()
+                self._release(child)
+                self._forget(child)
+                child.future.set_exception(RuntimeError("The process supervisor was shut down"))
+            self._selector.close()
+            for fd in self._wakeup:
+                os.close(fd)
+            self._thread = None
+
+    def _step(self):
+        for key, _ in self._selector.select(self._select_timeout()):
+            if key.data is None:
+                try:
+                    while os.read(key.fd, READ_SIZE):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            child, stream = key.data
+            try:
+                if stream is None:
+                    self._reap(child)
+                else:
+                    self._read(child, stream)
+            except Exception as err:
+                self._fail(child, err)
+        with self._lock:
+            self._add_pending()
+        self._kill_overdue()
+        for child in list(self._polled):
+            self._reap(child)
+
+    def _select_timeout(self):
+        while self._deadlines and self._deadlines[0][2] not in self._children:
+            heapq.heappop(self._deadlines)
+            self._finished_deadlines -= 1
+        timeout = None
+        if self._deadlines:
+            timeout = max(self._deadlines[0][0] - time.monotonic(), 0)
+        if self._polled:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        return timeout
+
+    def _add_pending(self):
+        pending, self._pending = self._pending, []
+        for child in pending:
+            self._children.add(child)
+            for stream in (child.proc.stdout, child.proc.stderr):
+                if stream is not None:
+                    os.set_blocking(stream.fileno(), False)
+                    child.buffers[stream] = b''
+                    self._selector.register(stream, selectors.EVENT_READ, (child, stream))
+            try:
+                child.pidfd = os.pidfd_open(child.proc.pid)
+            except (AttributeError, OSError):
+                self._polled.add(child)
+            else:
+                self._selector.register(child.pidfd, selectors.EVENT_READ, (child, None))
+            if child.deadline is not None:
+                heapq.heappush(self._deadlines, (child.deadline, next(self._counter), child))
+
+    def _read(self, child, stream):
+        try:
+            data = os.read(stream.fileno(), READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self._close_stream(child, stream)
+            self._finish(child)
+            return
+        lines = (child.buffers[stream] + data).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            child.log_func(line.decode('utf-8', 'replace').strip())
+        if len(rest) > MAX_LINE_LENGTH:
+            child.log_func(rest.decode('utf-8', 'replace').strip())
+            rest = b''
+        child.buffers[stream] = rest
+
+    def _close_stream(self, child, stream):
+        rest = child.buffers.pop(stream)
+        if rest:
+            child.log_func(rest.decode('utf-8', 'replace').strip())
+        self._selector.unregister(stream)
+        stream.close()
+
+    def _reap(self, child):
+        try:
+            pid, status = os.waitpid(child.proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            LOG.warning("Process %d was reaped by someone else, its exit code is unknown", child.proc.pid)
+            if child.proc.returncode is None:
+                child.proc.returncode = UNKNOWN_EXIT_CODE
+        else:
+            if pid == 0:
+                return
+            child.proc.returncode = _exit_code(status)
+        self._polled.discard(child)
+        if child.pidfd is not None:
+            self._selector.unregister(child.pidfd)
+            os.close(child.pidfd)
+            child.pidfd = None
+        if child.killed:
+            # Processes started by the killed one may keep the pipes open
+            for stream in list(child.buffers):
+                self._close_stream(child, stream)
+        self._finish(child)
+
+    def _finish(self, child):
+        if child.proc.returncode is None or child.buffers or child not in self._children:
+            return
+        self._forget(child)
+        child.future.set_result(child.proc.returncode)
+
+    def _forget(self, child):
+        """Stop tracking the child, and drop the deadlines of the finished children once they are many."""
+        self._children.discard(child)
+        if child.deadline is None:
+            return
+        self._finished_deadlines += 1
+        if self._finished_deadlines * 2 > len(self._deadlines):
+            self._deadlines = [entry for entry in self._deadlines if entry[2] in self._children]
+            heapq.heapify(self._deadlines)
+            self._finished_deadlines = 0
+
+    def _release(self, child):
+        for stream in list(child.buffers):
+            child.buffers.pop(stream)
+            self._selector.unregister(stream)
+            stream.close()
+        if child.pidfd is not None:
+            self._selector.unregister(child.pidfd)
+            os.close(child.pidfd)
+            child.pidfd = None
+        self._polled.discard(child)
+
+    def _fail(self, child, err):
+        LOG.exception("Failed supervising process %d", child.proc.pid)
+        self._release(child)
+        if child in self._children:
+            self._forget(child)
+            child.future.set_exception(err)
+
+    def _kill_overdue(self):
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            child = heapq.heappop(self._deadlines)[2]
+            if child not in self._children:
+                self._finished_deadlines -= 1
+            elif child.proc.returncode is None:
+                # Not reaped yet, so the pid can not have been reused
+                os.kill(child.proc.pid, signal.SIGKILL)
+                child.killed = True
+                LOG.info("Process timed out and pre-maturely terminated. Scene: " + str(child.scene))
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def _forget_supervisor():
+    """Drop the supervisor inherited by a forked process, where its thread is not running."""
+    global _supervisor, _supervisor_lock
+    _supervisor = None
+    _supervisor_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_supervisor)
+
+
+def get_process_supervisor():
+    """Get the process supervisor, shared in the process (a forked process gets its own)."""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = ProcessSupervisor()
+        return _supervisor
@@ -23,23 +23,111 @@
 """Publisher and Listener classes for the PPS runners.
 """
 
+import os
 import posttroll.subscriber
 from posttroll.publisher import Publish
 import threading
+import time
+from collections import OrderedDict
 from nwcsafpps_runner.utils import (SUPPORTED_PPS_SATELLITES,
                                     SUPPORTED_METEOSAT_SATELLITES)
 
 import logging
 LOG = logging.getLogger(__name__)
 
+#: Default number of files remembered to find duplicate messages
+DEFAULT_DEDUP_SIZE = 100000
+#: Default seconds a file is remembered to find duplicate messages
+DEFAULT_DEDUP_TTL = 6 * 3600
+
+
+def get_message_uids(msg):
+    """Get the uids of the files of a file, dataset or collection message.
+
+    The files without uid nor uri are skipped.
+    """
+    if msg.type == 'file':
+        items = [msg.data]
+    elif msg.type == 'dataset':
+        items = msg.data.get('dataset', [])
+    elif msg.type == 'collection':
+        items = [item for collection_item in msg.data.get('collection', [])
+                 for item in collection_item.get('dataset', [collection_item])]
+    else:
+        return []
+    uids = [item.get('uid') or os.path.basename(str(item.get('uri') or '')) for item in items]
+    return [uid for uid in uids if uid]
+
+
+class MessageDeduplicator(object):
+    """Index of the files already received, to drop the duplicate messages.
+
+    The files are keyed by (uid, platform name, start time). A message is a
+    duplicate if all its files were received less than *ttl* seconds ago. At
+    most *max_size* files are remembered, the least recently received are
+    forgotten first.
+    """
+
+    def __init__(self, max_size=DEFAULT_DEDUP_SIZE, ttl=DEFAULT_DEDUP_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen = OrderedDict()
+        self.received = 0
+        self.dropped = 0
+
+    def is_duplicate(self, msg, now=None):
+        """Check if all the files of the message were already received, and remember them."""
+        uids = get_message_uids(msg)
+        if not uids:
+            return False
+        now = time.time() if now is None else now
+        self._expire(now)
+        self.received += 1
+        keys = [(uid, msg.data.get('platform_name'), str(msg.data.get('start_time'))) for uid in uids]
+        duplicate = all(key in self._seen for key in keys)
+        for key in keys:
+            self._seen.pop(key, None)
+            self._seen[key] = now
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        if duplicate:
+            self.dropped += 1
+        return duplicate
+
+    def _expire(self, now):
+        while self._seen:
+            key, received = next(iter(self._seen.items()))
+            if now - received <= self.ttl:
+                break
+            del self._seen[key]
+
+    def stats(self):
+        """Get the counters of the index."""
+        return {'received': self.received, 'dropped': self.dropped, 'files': len(self._seen)}
+
+
+def create_message_deduplicator(options):
+    """Create the duplicate message index from the configuration, or None if not enabled.
+
+    The duplicates are only dropped if *message_dedup_ttl* is set, as a scene
+    may be sent again on purpose, e.g. to process a failed pass again.
+    """
+    ttl = float(options.get('message_dedup_ttl') or 0)
+    if ttl <= 0:
+        return None
+    return MessageDeduplicator(max_size=int(options.get('message_dedup_size', DEFAULT_DEDUP_SIZE)), ttl=ttl)
+
 
 class FileListener(threading.Thread):
 
-    def __init__(self, queue, subscribe_topics):
+    def __init__(self, queue, subscribe_topics, backpressure=None, deduplicator=None):
         threading.Thread.__init__(self)
         self.loop = True
         self.queue = queue
         self.subscribe_topics = subscribe_topics
+        # Object with a wait_for_capacity(timeout) method, e.g. a WorkerPool:
+        self.backpressure = backpressure
+        self.deduplicator = deduplicator
 
     def stop(self):
         """Stops the file listener."""
@@ -57,10 +145,23 @@ class FileListener(threading.Thread):
 
                 # Check if it is a relevant message:
                 if self.check_message(msg):
+                    self.wait_for_capacity()
                     LOG.info("Put the message on the queue...")
                     LOG.debug("Message = " + str(msg))
                     self.queue.put(msg)
 
+    def wait_for_capacity(self):
+        """Hold back the messages while the workers are overloaded."""
+        if self.backpressure is None:
+            return
+        if self.backpressure.wait_for_capacity(timeout=0):
+            return
+
+        LOG.warning("Too many jobs waiting, hold back the incoming messages...")
+        while self.loop and not self.backpressure.wait_for_capacity(timeout=1.0):
+            pass
+        LOG.info("Resume putting messages on the queue")
+
     def check_message(self, msg):
 
         if not msg:
@@ -80,6 +181,11 @@ class FileListener(threading.Thread):
                      "Not a NOAA/Metop/S-NPP/Terra/Aqua scene. Continue...")
             return False
 
+        if self.deduplicator is not None and self.deduplicator.is_duplicate(msg):
+            LOG.info("Duplicate message, all files already received. Dropped: %d",
+                     self.deduplicator.dropped)
+            return False
+
         return True
 
 
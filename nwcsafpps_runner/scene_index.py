@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Index of scenes by platform, orbit number and start time, with a tolerance on the start time.
+
+The start times of the scenes of each platform and orbit are kept sorted, so
+finding a scene starting within some minutes of another one is a binary search.
+"""
+
+import bisect
+from datetime import timedelta
+
+
+class SceneIntervalIndex(object):
+    """Start times of the scenes, per (platform name, orbit number).
+
+    Two scenes match if their start times differ less than *threshold* minutes.
+    """
+
+    def __init__(self, threshold=5):
+        self.threshold = timedelta(minutes=threshold)
+        self._times = {}
+
+    def __len__(self):
+        return sum(len(times) for times in self._times.values())
+
+    def add(self, platform_name, orbit_number, starttime):
+        """Add a scene."""
+        bisect.insort(self._times.setdefault((platform_name, orbit_number), []), starttime)
+
+    def remove(self, platform_name, orbit_number, starttime):
+        """Remove a scene added before. Return False if it is not there."""
+        times = self._times.get((platform_name, orbit_number))
+        if not times:
+            return False
+        idx = bisect.bisect_left(times, starttime)
+        if idx == len(times) or times[idx] != starttime:
+            return False
+        del times[idx]
+        if not times:
+            del self._times[(platform_name, orbit_number)]
+        return True
+
+    def find(self, platform_name, orbit_number, starttime, threshold=None):
+        """Get the start time of the closest matching scene, or None if there is none."""
+        times = self._times.get((platform_name, orbit_number))
+        if not times:
+            return None
+        threshold = self.threshold if threshold is None else timedelta(minutes=threshold)
+        idx = bisect.bisect_left(times, starttime)
+        candidates = times[max(idx - 1, 0):idx + 1]
+        closest = min(candidates, key=lambda other: abs(other - starttime))
+        if abs(closest - starttime) < threshold:
+            return closest
+        return None
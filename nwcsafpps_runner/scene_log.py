@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Log file of the output of the PPS processes of one scene.
+
+The stdout and stderr of the PPS processes are given the log file itself, so
+the output is written by the processes without going through the runner. The
+runner log only gets where the output is, and the last lines of it if PPS
+failed.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+
+LOG = logging.getLogger(__name__)
+
+#: Default number of lines of the output logged when PPS fails
+DEFAULT_TAIL_LINES = 20
+#: Bytes read from the end of the log file to find the last lines
+TAIL_BLOCK_SIZE = 8192
+
+
+def read_tail(filename, nlines):
+    """Read the last *nlines* lines of the file."""
+    with open(filename, 'rb') as fpt:
+        size = fpt.seek(0, os.SEEK_END)
+        data = b''
+        while size > 0 and data.count(b'\n') <= nlines:
+            block = min(TAIL_BLOCK_SIZE, size)
+            size -= block
+            fpt.seek(size)
+            data = fpt.read(block) + data
+    lines = data.decode('utf-8', 'replace').splitlines()
+    return lines[-nlines:] if nlines > 0 else []
+
+
+class SceneLog(object):
+    """Log file in *log_dir* of the output of the PPS processes of the *scene*."""
+
+    def __init__(self, log_dir, scene, compress=False, tail_lines=DEFAULT_TAIL_LINES):
+        self.compress = compress
+        self.tail_lines = tail_lines
+        starttime = scene.get('starttime')
+        name = "pps_{}_{:05d}_{}.log".format(str(scene.get('platform_name')).replace(' ', '-'),
+                                             int(scene.get('orbit_number', 0)),
+                                             starttime.strftime('%Y%m%dT%H%M%S') if starttime else 'unknown')
+        self.filename = os.path.join(log_dir, name)
+        self._fpt = None
+
+    def open(self):
+        """Open the log file, and return the file object to give to the processes as stdout and stderr."""
+        if self._fpt is None:
+            self._fpt = open(self.filename, 'ab')
+            LOG.info("PPS output written to %s", self.filename)
+        return self._fpt
+
+    def close(self, returncode=0):
+        """Close the log file, log the end of the output if PPS failed, and compress the file if asked.
+
+        Return the name of the log file.
+        """
+        if self._fpt is None:
+            return self.filename
+        self._fpt.close()
+        self._fpt = None
+
+        if returncode != 0:
+            LOG.error("PPS failed with exit code %s. Last lines of %s:\n%s", str(returncode), self.filename,
+                      '\n'.join(read_tail(self.filename, self.tail_lines)))
+        else:
+            LOG.info("PPS output of %s complete", self.filename)
+        if self.compress:
+            with open(self.filename, 'rb') as fin, gzip.open(self.filename + '.gz', 'ab') as fout:
+                shutil.copyfileobj(fin, fout)
+            os.remove(self.filename)
+            return self.filename + '.gz'
+        return self.filename
+
+
+def create_scene_log(options, scene):
+    """Create the log of the PPS output of the scene, or None if the output should go to the runner log."""
+    log_dir = options.get('pps_scene_log_dir')
+    if not log_dir:
+        return None
+    os.makedirs(log_dir, exist_ok=True)
+    return SceneLog(log_dir, scene, compress=bool(options.get('pps_scene_log_compress', False)),
+                    tail_lines=int(options.get('pps_scene_log_tail_lines', DEFAULT_TAIL_LINES)))
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Store of the level-1 files of the scenes waiting for all their data.
+
+A scene that never gets all its files (e.g. a NOAA/Metop scene whose MW data
+never arrive) is evicted when it is older than the time to live, or when the
+store is full, the oldest scene first.
+
+The messages adding files to the scenes, and the start and end of the
+processing of the scenes, can be appended to a journal. After a restart the
+messages of the scenes not processed to the end are replayed, so that the
+scenes are assembled again and the complete ones are processed. The journal is
+compacted to the scenes still pending every few hundred finished scenes.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from posttroll.message import Message
+
+LOG = logging.getLogger(__name__)
+
+#: Default seconds a scene waits for its files before being evicted
+DEFAULT_SCENE_TTL = 3 * 3600
+#: Default maximum number of scenes in the store
+DEFAULT_MAX_SCENES = 1000
+#: Default maximum number of files of all scenes in the store
+DEFAULT_MAX_FILES = 100000
+#: Default number of scenes done or dropped before the journal is compacted
+DEFAULT_COMPACT_AFTER = 500
+
+#: Journal operations
+JOURNAL_MESSAGE = 'message'
+JOURNAL_START = 'start'
+JOURNAL_DONE = 'done'
+JOURNAL_DROP = 'drop'
+
+
+class SceneJournal(object):
+    """Append only journal of the scenes in the store, in the file *filename* (JSON lines).
+
+    The lines are appended with single writes, so a crash leaves at most a
+    truncated last line, which is ignored when reading. With *fsync* each line
+    is also synced to disk. After *compact_after* scenes are done or dropped,
+    the journal is rewritten with the records of the pending scenes only.
+
+    The end of the processing of a scene only clears the messages journaled
+    before its (last) start: the messages coming afterwards belong to the
+    scene assembled again, which is still pending.
+    """
+
+    def __init__(self, filename, fsync=False, compact_after=DEFAULT_COMPACT_AFTER):
+        self.filename = filename
+        self.fsync = fsync
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._fd = None
+        self._finished = 0
+
+    def _append(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._fd, line)
+            if self.fsync:
+                os.fsync(self._fd)
+            if record['op'] in (JOURNAL_DONE, JOURNAL_DROP):
+                self._finished += 1
+                if self.compact_after and self._finished >= self.compact_after:
+                    self._compact()
+
+    def _close_file(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _compact(self):
+        self._close_file()
+        pending = OrderedDict()
+        self._read(self.filename, pending)
+        self._write(self.filename, pending)
+        self._finished = 0
+        LOG.debug("Scene journal %s compacted to %d scenes", self.filename, len(pending))
+
+    def message_added(self, sceneid, msg):
+        """Record the message adding files to the scene."""
+        self._append({'op': JOURNAL_MESSAGE, 'scene': sceneid, 'msg': msg.encode()})
+
+    def scene_started(self, sceneid):
+        """Record that the processing of the scene started."""
+        self._append({'op': JOURNAL_START, 'scene': sceneid})
+
+    def scene_done(self, sceneid):
+        """Record that the processing of the scene is finished."""
+        self._append({'op': JOURNAL_DONE, 'scene': sceneid})
+
+    def scene_dropped(self, sceneid, started=False):
+        """Record that the scene was evicted from the store, or if *started* that it will not be processed."""
+        record = {'op': JOURNAL_DROP, 'scene': sceneid}
+        if started:
+            record['started'] = True
+        self._append(record)
+
+    @staticmethod
+    def _read(filename, pending):
+        try:
+            fpt = open(filename, 'rb')
+        except IOError:
+            return
+        with fpt:
+            for line in fpt:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                    op, sceneid = record['op'], record['scene']
+                except (ValueError, KeyError, TypeError):
+                    LOG.warning("Skipping a damaged line of the scene journal %s", filename)
+                    continue
+                if op == JOURNAL_MESSAGE:
+                    pending.setdefault(sceneid, []).append(record)
+                elif op == JOURNAL_START:
+                    if sceneid in pending:
+                        pending[sceneid].append(record)
+                elif op == JOURNAL_DONE or (op == JOURNAL_DROP and record.get('started')):
+                    SceneJournal._finish(pending, sceneid)
+                elif op == JOURNAL_DROP:
+                    pending.pop(sceneid, None)
+
+    @staticmethod
+    def _finish(pending, sceneid):
+        """Remove the records of the scene up to its last start."""
+        records = pending.get(sceneid, [])
+        starts = [index for index, record in enumerate(records) if record['op'] == JOURNAL_START]
+        rest = records[starts[-1] + 1:] if starts else []
+        if rest:
+            pending[sceneid] = rest
+        else:
+            pending.pop(sceneid, None)
+
+    @staticmethod
+    def _write(filename, pending):
+        with open(filename + '.tmp', 'wb') as fpt:
+            for records in pending.values():
+                for record in records:
+                    fpt.write((json.dumps(record) + '\n').encode('utf-8'))
+        os.rename(filename + '.tmp', filename)
+
+    def replay(self):
+        """Get the messages of the scenes not processed to the end, in the order they came.
+
+        The journal is emptied, as the messages are journaled again when
+        handled. Until this is confirmed with *replay_done*, the old journal is
+        kept aside and read again at the next replay.
+        """
+        with self._lock:
+            self._close_file()
+            old_filename = self.filename + '.replay'
+            pending = OrderedDict()
+            self._read(old_filename, pending)
+            self._read(self.filename, pending)
+            self._write(old_filename, pending)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+        messages = [Message(rawstr=record['msg']) for records in pending.values() for record in records
+                    if record['op'] == JOURNAL_MESSAGE]
+        LOG.info("Replaying %d messages of %d scenes from the journal", len(messages), len(pending))
+        return messages
+
+    def replay_done(self):
+        """Remove the old journal, once the replayed messages are journaled again."""
+        old_filename = self.filename + '.replay'
+        if os.path.exists(old_filename):
+            os.remove(old_filename)
+
+    def close(self):
+        """Close the journal file."""
+        with self._lock:
+            self._close_file()
+
+
+class _Scene(object):
+
+    __slots__ = ('created', 'files', 'members')
+
+    def __init__(self, created):
+        self.created = created
+        self.files = []
+        self.members = set()
+
+
+class SceneStore(object):
+    """Level-1 files of the scenes being assembled, by scene id.
+
+    The *on_evict* callback is called with the scene id and the list of files
+    of each evicted scene. The changes are recorded in the *journal*, if any.
+
+    A scene may be popped again while it is being processed (e.g. a duplicate
+    that is then not run), so the end of a scene is only journaled when all
+    its pops are done or dropped.
+    """
+
+    def __init__(self, ttl=DEFAULT_SCENE_TTL, max_scenes=DEFAULT_MAX_SCENES, max_files=DEFAULT_MAX_FILES,
+                 on_evict=None, journal=None):
+        self.ttl = ttl
+        self.max_scenes = max_scenes
+        self.max_files = max_files
+        self.on_evict = on_evict
+        self.journal = journal
+        self._scenes = OrderedDict()
+        self._nfiles = 0
+        self._started = {}
+        self._started_lock = threading.Lock()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def __contains__(self, sceneid):
+        return sceneid in self._scenes
+
+    def __str__(self):
+        return "<SceneStore: %d scenes, %d files>" % (len(self._scenes), self._nfiles)
+
+    def add_files(self, sceneid, filenames, now=None, msg=None):
+        """Add the *filenames* to the scene, return the number of files not already there.
+
+        The message *msg* bringing the files is journaled if some of them are new.
+        """
+        now = time.time() if now is None else now
+        self.expire(now)
+        scene = self._scenes.get(sceneid)
+        if scene is None:
+            scene = self._scenes[sceneid] = _Scene(now)
+        added = 0
+        for filename in filenames:
+            if filename not in scene.members:
+                scene.members.add(filename)
+                scene.files.append(filename)
+                added += 1
+        self._nfiles += added
+        if added and msg is not None and self.journal is not None:
+            self.journal.message_added(sceneid, msg)
+        self._evict_overflow(keep=sceneid)
+        return added
+
+    def get_files(self, sceneid):
+        """Get the files of the scene, in the order they were added."""
+        scene = self._scenes.get(sceneid)
+        return list(scene.files) if scene is not None else []
+
+    def num_files(self, sceneid):
+        """Get the number of files of the scene."""
+        scene = self._scenes.get(sceneid)
+        return len(scene.files) if scene is not None else 0
+
+    def pop(self, sceneid, default=None):
+        """Remove the scene, to be processed, and return its files."""
+        files = self._remove(sceneid)
+        if files is None:
+            return default
+        if self.journal is not None:
+            with self._started_lock:
+                self._started[sceneid] = self._started.get(sceneid, 0) + 1
+            self.journal.scene_started(sceneid)
+        return files
+
+    def _remove(self, sceneid):
+        scene = self._scenes.pop(sceneid, None)
+        if scene is None:
+            return None
+        self._nfiles -= len(scene.files)
+        return scene.files
+
+    def scene_done(self, sceneid):
+        """Record that the processing of the scene is finished."""
+        if self._finish_started(sceneid):
+            self.journal.scene_done(sceneid)
+
+    def scene_dropped(self, sceneid):
+        """Record that the scene popped to be processed will not be processed."""
+        if self._finish_started(sceneid):
+            self.journal.scene_dropped(sceneid, started=True)
+
+    def _finish_started(self, sceneid):
+        """Count the end of one pop of the scene, return True if none is left (and there is a journal)."""
+        if self.journal is None:
+            return False
+        with self._started_lock:
+            count = self._started.pop(sceneid, 1) - 1
+            if count > 0:
+                self._started[sceneid] = count
+                return False
+        return True
+
+    def expire(self, now=None):
+        """Evict the scenes older than the time to live."""
+        if self.ttl is None:
+            return
+        now = time.time() if now is None else now
+        while self._scenes:
+            sceneid, scene = next(iter(self._scenes.items()))
+            if now - scene.created <= self.ttl:
+                break
+            self._evict(sceneid, "older than %d seconds" % self.ttl)
+
+    def _evict_overflow(self, keep):
+        while len(self._scenes) > 1 and ((self.max_scenes is not None and len(self._scenes) > self.max_scenes) or
+                                         (self.max_files is not None and self._nfiles > self.max_files)):
+            sceneid = next(sceneid for sceneid in self._scenes if sceneid != keep)
+            self._evict(sceneid, "the store is full")
+
+    def _evict(self, sceneid, reason):
+        files = self._remove(sceneid)
+        if self.journal is not None:
+            self.journal.scene_dropped(sceneid)
+        self.evicted += 1
+        LOG.warning("Evict scene %s with %d files, %s", str(sceneid), len(files), reason)
+        if self.on_evict is not None:
+            self.on_evict(sceneid, files)
+
+    def stats(self):
+        """Get the size metrics of the store."""
+        return {'scenes': len(self._scenes), 'files': self._nfiles, 'evicted': self.evicted}
+
+
+def create_scene_store(options, on_evict=None, use_journal=True):
+    """Create the scene store from the configuration, with a journal if configured and *use_journal*."""
+    journal = None
+    if use_journal and options.get('scene_journal_file'):
+        journal = SceneJournal(options['scene_journal_file'], fsync=bool(options.get('scene_journal_fsync', False)),
+                               compact_after=int(options.get('scene_journal_compact_after', DEFAULT_COMPACT_AFTER)))
+    return SceneStore(ttl=options.get('scene_store_ttl', DEFAULT_SCENE_TTL),
+                      max_scenes=options.get('scene_store_max_scenes', DEFAULT_MAX_SCENES),
+                      max_files=options.get('scene_store_max_files', DEFAULT_MAX_FILES),
+                      on_evict=on_evict, journal=journal)
+
+
+def replay_journal(files4pps, handle_message):
+    """Replay the journaled messages of the store with *handle_message*, after a restart."""
+    if files4pps.journal is None:
+        return
+    start = time.monotonic()
+    for msg in files4pps.journal.replay():
+        handle_message(msg)
+    files4pps.journal.replay_done()
+    LOG.info("Journal replayed in %.3f seconds", time.monotonic() - start)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the event loop based runner core."""
+
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+
+from posttroll.message import Message
+
+from nwcsafpps_runner.async_runner import AsyncPPSRunner, use_pidfd_child_watcher
+
+OPTIONS = {'number_of_threads': 2, 'maximum_pps_processing_time_in_minutes': 20}
+
+
+def _create_message(orbit_number):
+    data = {'platform_name': 'NOAA-19', 'orbit_number': orbit_number,
+            'start_time': datetime(2021, 5, 7, 12, 0) + timedelta(minutes=orbit_number)}
+    return Message('/my/topic', 'file', data)
+
+
+def _create_scene(msg, files4pps, options):
+    return {'orbit_number': msg.data['orbit_number']}
+
+
+async def _feed_and_process(runner, messages):
+    listener_q = asyncio.Queue()
+    for msg in messages:
+        listener_q.put_nowait(msg)
+    listener_q.put_nowait(None)
+    await runner.process_messages(listener_q)
+
+
+def test_all_scenes_processed_with_constant_number_of_threads():
+    """Test that all scenes are processed and that no threads are started per scene."""
+    post_process = MagicMock()
+    max_threads = []
+
+    def _post_process(*args):
+        max_threads.append(threading.active_count())
+        post_process(*args)
+
+    runner = AsyncPPSRunner(OPTIONS, create_scene=_create_scene, prepare_nwp=lambda: None,
+                            create_commands=lambda scene, options: ['sleep 0.1', 'true'],
+                            post_process=_post_process)
+    runner.publish_q = MagicMock()
+    if not use_pidfd_child_watcher():
+        pytest.skip("asyncio reaps each subprocess in a thread of its own")
+    threads_before = threading.active_count()
+
+    asyncio.run(_feed_and_process(runner, [_create_message(orbit) for orbit in range(8)]))
+
+    assert post_process.call_count == 8
+    orbits = sorted(call[0][0]['orbit_number'] for call in post_process.call_args_list)
+    assert orbits == list(range(8))
+    # One nwp thread and at most number_of_threads post processing threads:
+    assert max(max_threads) <= threads_before + 1 + OPTIONS['number_of_threads']
+    assert runner.jobs == set()
+
+
+def test_duplicate_scene_is_not_started_twice():
+    """Test that a scene already being processed is not started again."""
+    post_process = MagicMock()
+    runner = AsyncPPSRunner(OPTIONS, create_scene=_create_scene, prepare_nwp=lambda: None,
+                            create_commands=lambda scene, options: ['sleep 0.1'],
+                            post_process=post_process)
+
+    asyncio.run(_feed_and_process(runner, [_create_message(1), _create_message(1)]))
+
+    assert post_process.call_count == 1
+
+
+def test_command_is_killed_at_timeout():
+    """Test that a PPS process taking too long is killed."""
+    runner = AsyncPPSRunner(OPTIONS, create_scene=_create_scene, prepare_nwp=lambda: None,
+                            create_commands=None, post_process=None)
+    runner.timeout = 0.2
+
+    start = time.time()
+    returncode = asyncio.run(runner.run_command('sleep 10', {}))
+
+    assert time.time() - start < 5
+    assert returncode != 0
+    assert asyncio.run(runner.run_command(['true'], {})) == 0
+
+
+def test_command_is_run_in_a_shell():
+    """Test that the command is run by a shell, like in the threaded runner."""
+    runner = AsyncPPSRunner(OPTIONS, create_scene=_create_scene, prepare_nwp=lambda: None,
+                            create_commands=None, post_process=None)
+
+    assert asyncio.run(runner.run_command('true && exit 3', {})) == 3
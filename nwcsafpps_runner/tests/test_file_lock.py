@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the lock between processes."""
+
+import multiprocessing
+import os
+import threading
+import time
+
+from nwcsafpps_runner.file_lock import FileLock
+
+
+def test_waiter_wakes_up_when_output_is_ready(tmp_path):
+    """Test that a waiting process gets the lock as soon as it is released, and sees the output."""
+    lock_file = str(tmp_path / '.nwp.lock')
+    output = tmp_path / 'nwp'
+    holder = FileLock(lock_file)
+    assert holder.acquire(timeout=0)
+    result = {}
+
+    def _wait():
+        waiter = FileLock(lock_file)
+        result['locked'] = waiter.acquire(timeout=10)
+        result['time'] = time.monotonic()
+        result['output_ready'] = output.exists()
+        result['lock_file_exists'] = os.path.exists(lock_file)
+        waiter.release()
+
+    thread = threading.Thread(target=_wait)
+    thread.start()
+    time.sleep(0.2)
+    output.write_text('nwp')
+    released = time.monotonic()
+    holder.release()
+    thread.join()
+
+    assert result['locked']
+    assert result['output_ready']
+    assert result['lock_file_exists']
+    assert result['time'] - released < 0.5
+    assert not os.path.exists(lock_file)
+
+
+def test_acquire_times_out(tmp_path):
+    """Test that the waiting for the lock times out, and that the lock is not kept when it comes too late."""
+    lock_file = str(tmp_path / '.nwp.lock')
+    holder = FileLock(lock_file)
+    holder.acquire()
+
+    threads = threading.active_count()
+    start = time.monotonic()
+    assert not FileLock(lock_file).acquire(timeout=0.2)
+    assert 0.2 <= time.monotonic() - start < 2
+    assert threading.active_count() == threads
+    holder.release(remove=False)
+    time.sleep(0.1)
+
+    with FileLock(lock_file) as lock:
+        assert lock.locked
+
+
+def _crash_holding_lock(lock_file):
+    FileLock(lock_file).acquire()
+    os._exit(1)
+
+
+def test_stale_lock_of_crashed_process_is_taken_over(tmp_path, caplog):
+    """Test that the lock file left by a crashed process does not block."""
+    lock_file = str(tmp_path / '.nwp.lock')
+    process = multiprocessing.Process(target=_crash_holding_lock, args=(lock_file,))
+    process.start()
+    process.join()
+    assert os.path.exists(lock_file)
+
+    lock = FileLock(lock_file)
+    assert lock.acquire(timeout=1)
+    assert 'Stale lock file' in caplog.text
+    assert str(process.pid) in caplog.text
+    lock.release()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the metno preparation of the ECMWF data."""
+
+import numpy as np
+import pytest
+
+ecc = pytest.importorskip('eccodes')
+
+from nwcsafpps_runner.metno_update_nwp import (DEFAULT_ECMWF_PARAMETERS, FieldCropper,  # noqa: E402
+                                               IndexQueryPlanner,
+                                               create_field_cropper, create_query_planner,
+                                               read_needed_fields)
+
+
+def _create_field():
+    """Create a field on a grid from 60N to 0N and 0E to 30E, with a step of 2 degrees."""
+    gid = ecc.codes_grib_new_from_samples('regular_ll_sfc_grib2')
+    values = np.arange(31 * 16, dtype=np.float64).reshape((31, 16))
+    ecc.codes_set_values(gid, values.ravel())
+    return gid, values
+
+
+def _get_field(gid):
+    keys = ['Ni', 'Nj', 'latitudeOfFirstGridPointInDegrees', 'latitudeOfLastGridPointInDegrees',
+            'longitudeOfFirstGridPointInDegrees', 'longitudeOfLastGridPointInDegrees']
+    return ({key: ecc.codes_get(gid, key) for key in keys},
+            ecc.codes_get_values(gid).reshape((ecc.codes_get(gid, 'Nj'), ecc.codes_get(gid, 'Ni'))))
+
+
+@pytest.mark.parametrize('float32', [False, True])
+def test_crop_to_bounding_box(float32):
+    """Test cropping a field to a bounding box."""
+    gid, values = _create_field()
+    cropper = FieldCropper(north=50, south=20, west=4, east=20, float32=float32)
+
+    cropper.crop(gid)
+    keys, new_values = _get_field(gid)
+    ecc.codes_release(gid)
+
+    assert keys == {'Ni': 9, 'Nj': 16,
+                    'latitudeOfFirstGridPointInDegrees': 50, 'latitudeOfLastGridPointInDegrees': 20,
+                    'longitudeOfFirstGridPointInDegrees': 4, 'longitudeOfLastGridPointInDegrees': 20}
+    np.testing.assert_allclose(new_values, values[5:21, 2:11], atol=0.1)
+
+
+def test_crop_window_computed_once_per_geometry():
+    """Test that the default crop keeps the whole grid, and that the window is computed once."""
+    cropper = create_field_cropper({'ecmwf_crop_south': None})
+    for _ in range(3):
+        gid, values = _create_field()
+        cropper.crop(gid)
+        keys, new_values = _get_field(gid)
+        ecc.codes_release(gid)
+        assert keys['Nj'] == 31
+        np.testing.assert_allclose(new_values, values, atol=0.1)
+    assert len(cropper._windows) == 1
+
+
+def test_crop_messages_in_worker_pool():
+    """Test that the messages cropped in a pool of processes are the same and in the same order."""
+    messages = []
+    for offset in range(4):
+        gid, _ = _create_field()
+        ecc.codes_set(gid, 'paramId', 130 + offset)
+        messages.append(ecc.codes_get_message(gid))
+        ecc.codes_release(gid)
+    cropper = FieldCropper(north=40, south=10)
+
+    serial = list(cropper.crop_messages(messages))
+    assert list(cropper.crop_messages(iter(messages), nworkers=2)) == serial
+    assert len(serial[0]) < len(messages[0])
+
+
+def _create_index(filename, fields):
+    with open(filename, 'wb') as fpt:
+        for param, level in fields:
+            gid = ecc.codes_grib_new_from_samples('regular_ll_pl_grib2' if level else 'regular_ll_sfc_grib2')
+            ecc.codes_set(gid, 'paramId', param)
+            if level:
+                ecc.codes_set(gid, 'level', level)
+            ecc.codes_write(gid, fpt)
+            ecc.codes_release(gid)
+    return ecc.codes_index_new_from_file(str(filename), ['paramId', 'level'])
+
+
+def _read_fields(iid, planner):
+    return [(ecc.codes_get(gid, 'paramId'), ecc.codes_get(gid, 'level')) for gid in read_needed_fields(iid, planner)]
+
+
+def test_query_planner_selects_only_wanted_fields(tmp_path, caplog):
+    """Test that only the configured parameters, or the required fields, are read from the index."""
+    iid = _create_index(tmp_path / 'nwp', [(130, 1000), (130, 850), (131, 1000), (157, 1000), (172, 0)])
+
+    assert _read_fields(iid, IndexQueryPlanner(parameters=[130, 172, 133])) == [(130, 850), (130, 1000), (172, 0)]
+    assert '133' in caplog.text
+
+    req_file = tmp_path / 'pps_nwp_list_of_required_fields.txt'
+    req_file.write_text("M 130 Temperature 1000 isobaricInhPa\n"
+                        "M 131 U component of wind 850 isobaricInhPa\n"
+                        "M 172 Land-sea mask 0 surface\n"
+                        "O 157 Relative humidity 1000 isobaricInhPa\n")
+    planner = create_query_planner({'ecmwf_fields_from_requirements': True, 'pps_nwp_requirements': str(req_file)})
+    caplog.clear()
+    assert _read_fields(iid, planner) == [(130, 1000), (172, 0)]
+    assert '(131, 850)' in caplog.text
+    ecc.codes_index_release(iid)
+
+    assert create_query_planner({}).parameters == set(DEFAULT_ECMWF_PARAMETERS)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the in-process assembly of the NWP files."""
+
+import errno
+import os
+from unittest import mock
+
+import pytest
+
+from nwcsafpps_runner.nwp_assembly import assemble_nwp_file, copy_range, read_grib_index
+
+ecc = pytest.importorskip('eccodes')
+
+
+def _write_grib(filename, fields):
+    """Write GRIB messages with the (sample name, paramId) in *fields*, and return the messages."""
+    messages = []
+    with open(filename, 'wb') as fpt:
+        for sample, param_id in fields:
+            gid = ecc.codes_grib_new_from_samples(sample)
+            ecc.codes_set(gid, 'paramId', param_id)
+            messages.append(ecc.codes_get_message(gid))
+            ecc.codes_write(gid, fpt)
+            ecc.codes_release(gid)
+    return messages
+
+
+def test_assemble_nwp_file(tmp_path):
+    """Test that the filtered and whole input files are written to the output with the list of fields."""
+    nhsp = _write_grib(tmp_path / 'nhsp', [('regular_ll_sfc_grib2', 167), ('reduced_gg_pl_32_grib2', 130),
+                                           ('regular_ll_sfc_grib2', 168)])
+    nhsf = _write_grib(tmp_path / 'nhsf', [('reduced_gg_pl_32_grib2', 235)])
+    lsm = _write_grib(tmp_path / 'lsm', [('regular_ll_sfc_grib2', 172), ('regular_ll_sfc_grib2', 129)])
+    output = str(tmp_path / 'output')
+
+    fields = assemble_nwp_file(output, [(str(tmp_path / 'nhsp'), 'regular_ll'),
+                                        (str(tmp_path / 'nhsf'), None),
+                                        (str(tmp_path / 'lsm'), None)])
+
+    with open(output, 'rb') as fpt:
+        assert fpt.read() == b''.join([nhsp[0], nhsp[2]] + nhsf + lsm)
+    assert fields == [msg.field for msg in read_grib_index(output)]
+    assert fields[0] == '167 2 metre temperature 2 heightAboveGround'
+    assert [field.split()[0] for field in fields] == ['167', '168', '235', '172', '129']
+
+
+def test_copy_range_without_kernel_copy(tmp_path):
+    """Test copying when neither copy_file_range nor sendfile can be used."""
+    (tmp_path / 'input').write_bytes(b'0123456789')
+
+    fd_in = os.open(str(tmp_path / 'input'), os.O_RDONLY)
+    fd_out = os.open(str(tmp_path / 'output'), os.O_WRONLY | os.O_CREAT)
+    try:
+        with mock.patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, 'cross device'), create=True), \
+                mock.patch('os.sendfile', side_effect=OSError(errno.EINVAL, 'not supported')):
+            copy_range(fd_in, fd_out, 2, 5)
+        copy_range(fd_in, fd_out, 0, 2)
+        with pytest.raises(IOError):
+            copy_range(fd_in, fd_out, 8, 5)
+    finally:
+        os.close(fd_in)
+        os.close(fd_out)
+
+    assert (tmp_path / 'output').read_bytes() == b'2345601' + b'89'
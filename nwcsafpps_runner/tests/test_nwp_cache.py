@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the NWP cache shared by several hosts."""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from nwcsafpps_runner.nwp_cache import NwpCacheTimeout, SharedNwpCache, content_key, create_nwp_cache
+
+
+def _produce(path, log_file):
+    with open(log_file, 'a') as fpt:
+        fpt.write('{:d}\n'.format(os.getpid()))
+    time.sleep(0.3)
+    with open(path, 'w') as fpt:
+        fpt.write('prepared nwp')
+
+
+def _fetch(cache_dir, key, dest, log_file):
+    cache = SharedNwpCache(cache_dir, poll_interval=0.05)
+    assert cache.fetch(key, dest, lambda path: _produce(path, log_file))
+
+
+def test_one_producer_among_several_hosts(tmp_path):
+    """Test that one of several processes makes the file, and that all of them get it."""
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    log_file = str(tmp_path / 'producers.log')
+    (tmp_path / 'nhsp').write_bytes(b'GRIB' * 1000)
+    key = content_key([str(tmp_path / 'nhsp')])
+
+    processes = []
+    for idx in range(4):
+        host_dir = tmp_path / 'host{:d}'.format(idx)
+        host_dir.mkdir()
+        processes.append(multiprocessing.Process(target=_fetch,
+                                                 args=(str(cache_dir), key, str(host_dir / 'nwp'), log_file)))
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0] * 4
+    with open(log_file) as fpt:
+        assert len(fpt.readlines()) == 1
+    inodes = set(os.stat(str(tmp_path / 'host{:d}'.format(idx) / 'nwp')).st_ino for idx in range(4))
+    assert inodes == {os.stat(SharedNwpCache(str(cache_dir)).path(key)).st_ino}
+    assert sorted(os.listdir(str(cache_dir))) == [key + '.grib']
+
+
+def test_content_key(tmp_path):
+    """Test that the key depends on the content of the files and on the settings."""
+    (tmp_path / 'nhsp').write_bytes(b'GRIB' * 1000)
+    key = content_key([str(tmp_path / 'nhsp')])
+    assert content_key([str(tmp_path / 'nhsp')], 'crop') != key
+
+    (tmp_path / 'nhsp').write_bytes(b'GRIB' * 999 + b'BIRG')
+    assert content_key([str(tmp_path / 'nhsp')]) != key
+
+    # A correction in the middle of a file of the same size
+    (tmp_path / 'nhsp').write_bytes(b'GRIB' * 500 + b'BIRG' + b'GRIB' * 499)
+    assert content_key([str(tmp_path / 'nhsp')]) != key
+
+
+def test_stale_lease_is_taken_over(tmp_path, caplog):
+    """Test that a lease left by a crashed host is taken over, and that the waiting times out."""
+    cache = create_nwp_cache({'nwp_shared_cache_dir': str(tmp_path), 'nwp_shared_cache_lease_timeout': 10,
+                              'nwp_shared_cache_poll_interval': 0.05, 'nwp_shared_cache_wait_timeout': 0.2})
+    lease = tmp_path / 'key1.lease'
+    lease.write_text('crashed-host 1234\n')
+
+    with pytest.raises(NwpCacheTimeout):
+        cache.fetch('key1', str(tmp_path / 'nwp'), lambda path: None)
+
+    os.utime(str(lease), (time.time() - 20, time.time() - 20))
+    assert not cache.fetch('key1', str(tmp_path / 'nwp'), lambda path: None)
+    assert 'crashed-host 1234' in caplog.text
+    assert not lease.exists()
+
+
+def test_lease_renewed_while_producing(tmp_path):
+    """Test that the lease of a production taking longer than the lease timeout is not taken over."""
+    cache = SharedNwpCache(str(tmp_path), lease_timeout=0.3, poll_interval=0.05)
+    other_host = SharedNwpCache(str(tmp_path), lease_timeout=0.3, poll_interval=0.05, wait_timeout=0.1)
+
+    def _produce_slowly(path):
+        for _ in range(8):
+            time.sleep(0.1)
+            assert not other_host._try_lease('key1')
+        with open(path, 'w') as fpt:
+            fpt.write('prepared nwp')
+
+    assert cache.fetch('key1', str(tmp_path / 'nwp'), _produce_slowly)
+    assert not (tmp_path / 'key1.lease').exists()
+
+
+def test_lease_taken_over_is_not_removed(tmp_path):
+    """Test that the producer does not remove the lease another host took over in the meantime."""
+    cache = SharedNwpCache(str(tmp_path), lease_timeout=10, poll_interval=0.05)
+    lease = tmp_path / 'key1.lease'
+
+    def _produce_taken_over(path):
+        lease.write_text('other-host 4321\n')
+        with open(path, 'w') as fpt:
+            fpt.write('prepared nwp')
+
+    assert cache.fetch('key1', str(tmp_path / 'nwp'), _produce_taken_over)
+    assert lease.read_text() == 'other-host 4321\n'
+
+    def _produce_lease_removed(path):
+        lease.unlink()
+        with open(path, 'w') as fpt:
+            fpt.write('prepared nwp')
+
+    assert cache.fetch('key2', str(tmp_path / 'nwp2'), _produce_lease_removed)
+
+
+def test_old_files_removed(tmp_path):
+    """Test that the files older than the maximum age are removed from the cache."""
+    cache = create_nwp_cache({'nwp_shared_cache_dir': str(tmp_path / 'cache'), 'nwp_shared_cache_max_age': 3600})
+    (tmp_path / 'cache').mkdir()
+    old_file = tmp_path / 'cache' / 'old.grib'
+    old_file.write_text('old nwp')
+    os.utime(str(old_file), (time.time() - 7200, time.time() - 7200))
+
+    assert cache.fetch('new', str(tmp_path / 'nwp'), lambda path: open(path, 'w').close())
+
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['new.grib']
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the persistent inventory of the NWP input files."""
+
+import os
+from datetime import datetime
+
+from trollsift import Parser
+
+from nwcsafpps_runner.metno_update_nwp import parse_ecmwf_filename
+from nwcsafpps_runner.nwp_inventory import (STATUS_DONE, STATUS_INVALID, STATUS_NEW, NwpInventory,
+                                            get_inventory_filename)
+
+ECMWF_SIFT = '{ecmwf_prefix:3s}{analysis_time:%m%d%H%M}{forecast_time:%m%d%H%M}{end:1s}'
+
+
+def _parse(calls):
+    def parse(filename):
+        calls.append(os.path.basename(filename))
+        if 'bad' in filename:
+            return None
+        return {'analysis_time': datetime(2021, 5, 7, 0, 0), 'forecast_step': 3}
+    return parse
+
+
+def test_only_new_and_changed_files_are_parsed(tmp_path):
+    """Test that the files are only parsed again when new or changed."""
+    (tmp_path / 'LL02_NHSF_1').write_text('nwp')
+    (tmp_path / 'LL02_NHSF_bad').write_text('nwp')
+    (tmp_path / 'other_file').write_text('nwp')
+    calls = []
+    inventory = NwpInventory()
+
+    files = inventory.scan(str(tmp_path), 'LL02_NHSF_', _parse(calls))
+    assert sorted(calls) == ['LL02_NHSF_1', 'LL02_NHSF_bad']
+    assert files[0] == (str(tmp_path / 'LL02_NHSF_1'), {'analysis_time': datetime(2021, 5, 7, 0, 0),
+                                                        'forecast_step': 3})
+    assert files[1] == (str(tmp_path / 'LL02_NHSF_bad'), None)
+    assert inventory.get_status(str(tmp_path / 'LL02_NHSF_1')) == STATUS_NEW
+    assert inventory.get_status(str(tmp_path / 'LL02_NHSF_bad')) == STATUS_INVALID
+
+    calls.clear()
+    inventory.scan(str(tmp_path), 'LL02_NHSF_', _parse(calls))
+    assert calls == []
+
+    (tmp_path / 'LL02_NHSF_1').write_text('new nwp content')
+    (tmp_path / 'LL02_NHSF_bad').unlink()
+    files = inventory.scan(str(tmp_path), 'LL02_NHSF_', _parse(calls))
+    assert calls == ['LL02_NHSF_1']
+    assert len(files) == 1
+    assert str(tmp_path / 'LL02_NHSF_bad') not in inventory.entries
+
+
+def test_inventory_is_persistent(tmp_path):
+    """Test that the inventory and the processing status is kept on disk between runs."""
+    (tmp_path / 'LL02_NHSF_1').write_text('nwp')
+    inventory_file = get_inventory_filename({'nwp_outdir': str(tmp_path)})
+    inventory = NwpInventory(inventory_file)
+    inventory.scan(str(tmp_path), 'LL02_NHSF_', _parse([]))
+    inventory.set_status(str(tmp_path / 'LL02_NHSF_1'), STATUS_DONE)
+    inventory.save()
+
+    calls = []
+    inventory = NwpInventory(inventory_file)
+    files = inventory.scan(str(tmp_path), 'LL02_NHSF_', _parse(calls))
+    assert calls == []
+    assert files[0][1]['analysis_time'] == datetime(2021, 5, 7, 0, 0)
+    assert inventory.get_status(str(tmp_path / 'LL02_NHSF_1')) == STATUS_DONE
+
+    with open(inventory_file, 'w') as fpt:
+        fpt.write('not json')
+    assert NwpInventory(inventory_file).entries == {}
+
+
+def test_parse_ecmwf_filename():
+    """Test parsing the analysis and forecast times from an ECMWF file name without year."""
+    parser = Parser(ECMWF_SIFT)
+    res = parse_ecmwf_filename(parser, '/path/to/N2D05070000050703001')
+    assert res['forecast_time'] - res['analysis_time'] == datetime(2021, 5, 7, 3) - datetime(2021, 5, 7, 0)
+    assert res['analysis_time'].year != 1900
+    assert parse_ecmwf_filename(parser, '/path/to/something_else') is None
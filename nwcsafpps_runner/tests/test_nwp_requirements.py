@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the checking of the NWP fields required by PPS."""
+
+import os
+from unittest import mock
+
+from nwcsafpps_runner import nwp_requirements
+from nwcsafpps_runner.nwp_requirements import check_fields, get_requirements
+
+REQUIREMENTS = """M 235 Skin temperature 0 surface
+O 172 Land-sea mask 0 surface
+M 130 Temperature 1000 isobaricInhPa
+"""
+
+
+def test_requirements_are_read_only_when_changed(tmp_path):
+    """Test that the requirements file is only read again after it has been modified."""
+    req_file = tmp_path / 'pps_nwp_list_of_required_fields.txt'
+    req_file.write_text(REQUIREMENTS)
+
+    with mock.patch.object(nwp_requirements, 'read_requirements',
+                           wraps=nwp_requirements.read_requirements) as read_requirements:
+        assert get_requirements(str(req_file)) == {'235 Skin temperature 0 surface',
+                                                   '130 Temperature 1000 isobaricInhPa'}
+        get_requirements(str(req_file))
+        assert read_requirements.call_count == 1
+
+        req_file.write_text("M 235 Skin temperature 0 surface\n")
+        os.utime(req_file, ns=(0, 1))
+        assert get_requirements(str(req_file)) == {'235 Skin temperature 0 surface'}
+        assert read_requirements.call_count == 2
+
+
+def test_check_fields_report(tmp_path):
+    """Test the report of missing fields."""
+    req_file = tmp_path / 'pps_nwp_list_of_required_fields.txt'
+    req_file.write_text(REQUIREMENTS)
+
+    report = check_fields(['235 Skin temperature 0 surface', '172 Land-sea mask 0 surface'], str(req_file), 'nwp')
+    assert not report.ok
+    assert report.checked
+    assert report.missing == {'130 Temperature 1000 isobaricInhPa'}
+    assert report.gribfile == 'nwp'
+
+    report = check_fields(['235 Skin temperature 0 surface', '130 Temperature 1000 isobaricInhPa'], str(req_file))
+    assert report.ok
+
+    report = check_fields([], str(tmp_path / 'missing_file.txt'))
+    assert report.ok
+    assert not report.checked
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the background NWP preparation service."""
+
+import os
+import threading
+import time
+
+from nwcsafpps_runner.nwp_service import NwpPreparationService, create_nwp_service
+
+
+def test_concurrent_requests_share_one_preparation():
+    """Test that concurrent requests for preparation are served by one single run."""
+    calls = []
+    release = threading.Event()
+
+    def prepare():
+        calls.append(1)
+        release.wait()
+
+    service = NwpPreparationService(prepare)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.prepare())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [True] * 5
+    assert service.is_ready()
+
+
+def test_new_input_is_detected_and_prepared(tmp_path):
+    """Test that new NWP input triggers a new preparation before the scene jobs continue."""
+    calls = []
+    service = NwpPreparationService(lambda: calls.append(1), watch_paths=[str(tmp_path)], scan_interval=0.05)
+    service.start()
+    try:
+        assert service.wait_until_ready(timeout=5)
+        assert len(calls) == 1
+        assert service.wait_until_ready(timeout=5)
+        assert len(calls) == 1
+
+        (tmp_path / 'LL02_NHSF_202105070000+003H00M').write_text('nwp')
+        os.utime(tmp_path, ns=(0, 1))
+        assert service.wait_until_ready(timeout=5)
+        assert len(calls) == 2
+    finally:
+        service.stop()
+        service.join()
+
+
+def test_failed_preparation_is_not_ready():
+    """Test that a failing preparation does not mark the NWP data as ready."""
+    def prepare():
+        raise IOError('Failed running grib_copy')
+
+    service = create_nwp_service(prepare, {'nhsf_path': None})
+    assert not service.prepare()
+    assert not service.is_ready()
+    assert not service.wait_until_ready(timeout=0.1)
+
+
+def test_own_writes_do_not_trigger_preparation(tmp_path):
+    """Test that the files written by the preparation to a watched directory are not new input."""
+    input_dir = tmp_path / 'input'
+    input_dir.mkdir()
+    calls = []
+
+    def prepare():
+        calls.append(1)
+        (tmp_path / ('nwp_inventory_%d.json' % len(calls))).write_text('{}')
+        os.utime(tmp_path, ns=(0, len(calls)))
+
+    service = create_nwp_service(prepare, {'nhsp_path': str(tmp_path), 'nhsf_path': str(input_dir),
+                                           'nwp_outdir': str(tmp_path)})
+    assert service.prepare()
+    assert not service.check_input()
+    assert service.is_ready()
+
+    os.utime(input_dir, ns=(0, 1))
+    assert service.check_input()
+    assert service.prepare()
+    assert len(calls) == 2
+    assert not service.check_input()
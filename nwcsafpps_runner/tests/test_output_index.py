@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the index of the PPS output files."""
+
+import os
+import time
+
+from nwcsafpps_runner import output_index
+from nwcsafpps_runner.output_index import OutputFileIndex, get_output_index
+from nwcsafpps_runner.utils import get_xml_outputfiles
+
+CMA_NAME = "S_NWC_CMA_{}_{:05d}_20210305T0715000Z_20210305T0730000Z.{}"
+
+
+def _set_old_mtime(path):
+    os.utime(str(path), (time.time() - 60, time.time() - 60))
+
+
+def test_index_follows_the_directory(tmp_path, monkeypatch):
+    """Test that the index picks up added and removed files, and reads the directory only when it changed."""
+    (tmp_path / CMA_NAME.format('noaa19', 12345, 'nc')).write_text('cma')
+    (tmp_path / CMA_NAME.format('metopb', 12345, 'nc')).write_text('cma')
+    (tmp_path / 'README').write_text('not pps')
+    _set_old_mtime(tmp_path)
+    index = OutputFileIndex(tmp_path)
+    scans = []
+    original_scan = index._scan
+    monkeypatch.setattr(index, '_scan', lambda: scans.append(1) or original_scan())
+
+    assert index.lookup('noaa19', 12345) == [CMA_NAME.format('noaa19', 12345, 'nc')]
+    assert index.lookup('noaa19', 12345, st_time='20210305T0745') == []
+    assert index.lookup('noaa19', 12346) == []
+    assert len(scans) == 1
+
+    os.remove(str(tmp_path / CMA_NAME.format('noaa19', 12345, 'nc')))
+    (tmp_path / CMA_NAME.format('noaa19', 12345, 'xml')).write_text('statistics')
+    assert index.lookup('noaa19', 12345, extensions=('nc',)) == []
+    assert index.lookup('noaa19', 12345) == [CMA_NAME.format('noaa19', 12345, 'xml')]
+    assert len(scans) == 3
+
+    _set_old_mtime(tmp_path)
+    index.lookup('noaa19', 12345)
+    index.lookup('metopb', 12345)
+    assert len(scans) == 4
+    assert index._names['README'] is None
+
+
+def test_xml_orbit_mismatch(tmp_path):
+    """Test that the statistics files are found with a slightly different orbit number."""
+    (tmp_path / CMA_NAME.format('noaa19', 12348, 'xml')).write_text('statistics')
+    (tmp_path / CMA_NAME.format('noaa19', 12352, 'xml')).write_text('statistics')
+
+    assert get_xml_outputfiles(str(tmp_path), 'noaa19', 12345) == [
+        os.path.join(str(tmp_path), CMA_NAME.format('noaa19', 12348, 'xml'))]
+    assert get_xml_outputfiles(str(tmp_path), 'noaa19', 12340) == []
+    assert get_output_index(str(tmp_path)) is output_index._indexes[str(tmp_path)]
+
+
+def test_orbit_numbers_of_six_digits(tmp_path):
+    """Test that the files of orbit numbers from 100000 are found."""
+    (tmp_path / CMA_NAME.format('noaa19', 123456, 'nc')).write_text('cma')
+    (tmp_path / CMA_NAME.format('noaa19', 12345, 'nc')).write_text('cma')
+
+    index = OutputFileIndex(tmp_path)
+    assert index.lookup('noaa19', 123456) == [CMA_NAME.format('noaa19', 123456, 'nc')]
+    assert index.lookup('noaa19', 12345) == [CMA_NAME.format('noaa19', 12345, 'nc')]
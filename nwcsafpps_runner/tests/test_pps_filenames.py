@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the parsing of the PPS file names."""
+
+from datetime import datetime
+
+import pytest
+from trollsift.parser import parse
+
+from nwcsafpps_runner.pps_filenames import (PPS_OUT_PATTERN, PPS_STAT_PATTERN, PpsFileInfo, parse_pps_filename,
+                                            parse_pps_time)
+
+
+def test_parse_pps_filenames():
+    """Test that the output and statistics file names are parsed into records."""
+    assert parse_pps_filename("S_NWC_CMA_noaa19_12345_20210305T0715123Z_20210305T0730000Z.nc") == PpsFileInfo(
+        'CMA', 'noaa19', 12345, datetime(2021, 3, 5, 7, 15, 12, 300000), datetime(2021, 3, 5, 7, 30), 'nc')
+    assert parse_pps_filename("S_NWC_CMA_metopb_01234_20210305T0715000Z_20210305T0730000Z_statistics.xml") == \
+        PpsFileInfo('CMA', 'metopb', 1234, datetime(2021, 3, 5, 7, 15), datetime(2021, 3, 5, 7, 30), 'xml')
+    with pytest.raises(ValueError):
+        parse_pps_filename("S_NWC_timectrl_noaa19_12345_20210305T0715000Z.txt")
+
+
+@pytest.mark.parametrize('filename', ["S_NWC_CMA_PRE_npp_51234_20210305T0715000Z_20210305T0716325Z.h5",
+                                      "S_NWC_CTTH_noaa19_12345_20210305T0715000Z_20210305T0730000Z_statistics.xml"])
+def test_same_times_as_trollsift(filename):
+    """Test that the times are the same as parsed by trollsift."""
+    pattern = PPS_STAT_PATTERN if filename.endswith('statistics.xml') else PPS_OUT_PATTERN
+    expected = parse(pattern, filename)
+    info = parse_pps_filename(filename)
+    assert (info.start_time, info.end_time, info.orbit_number) == (expected['start_time'], expected['end_time'],
+                                                                   expected['orbit_number'])
+    assert parse_pps_time('20210305T0715000123') == datetime.strptime('20210305T0715000123', '%Y%m%dT%H%M%S%f')
@@ -518,3 +518,90 @@ class TestPostTrollMessage(unittest.TestCase):
                     'format': 'CF',
                     'station': 'norrkoping'}
         self.assertDictEqual(posttroll_message._to_send, expected)
+
+    @patch('nwcsafpps_runner.pps_posttroll_hook.PPSPublisher')
+    @patch('nwcsafpps_runner.pps_posttroll_hook.send_to_relay')
+    @patch('nwcsafpps_runner.pps_posttroll_hook.PostTrollMessage.check_metadata_contains_filename')
+    @patch('nwcsafpps_runner.pps_posttroll_hook.PostTrollMessage.check_metadata_contains_mandatory_parameters')
+    def test_publish_message_via_relay(self, mandatory_param, filename, send_to_relay, pps_publisher):
+        """Test that the message is handed over to the hook relay if one is configured."""
+        from nwcsafpps_runner.pps_posttroll_hook import PostTrollMessage
+
+        metadata = dict(self.metadata_with_platform_name, relay_socket='/tmp/relay.sock')
+        mymessage = {'header': '/my/topic', 'type': 'file', 'content': {'uid': 'xxx'}}
+
+        send_to_relay.return_value = True
+        posttroll_message = PostTrollMessage(0, metadata)
+        posttroll_message.publish_message(mymessage)
+        send_to_relay.assert_called_once()
+        self.assertEqual(send_to_relay.call_args[0][0], '/tmp/relay.sock')
+        pps_publisher.assert_not_called()
+
+        msg_content = posttroll_message.create_message_content_from_metadata()
+        self.assertNotIn('relay_socket', msg_content)
+
+
+def _create_pge_message(module, filename, start_time=START_TIME1):
+    """Create a message as sent from the hook of one PGE."""
+    from posttroll.message import Message
+    from nwcsafpps_runner.pps_posttroll_hook import PPS_PRODUCT_FILE_ID
+
+    topic = '/polar/direct_readout/CF/2/' + PPS_PRODUCT_FILE_ID[module] + '/NWCSAF-PPSv2018/'
+    data = {'module': module, 'platform_name': 'Suomi-NPP', 'orbit_number': 47000,
+            'start_time': start_time, 'end_time': END_TIME1, 'status': 'OK',
+            'uri': 'ssh://TEST_SERVERNAME/tmp/' + filename, 'uid': filename}
+    return Message(topic, 'file', data)
+
+
+def test_aggregator_publishes_one_dataset_message_per_scene():
+    """Test coalescing the PGE messages of one scene into one dataset message."""
+    from nwcsafpps_runner.pps_posttroll_hook import SceneMessageAggregator
+
+    aggregator = SceneMessageAggregator(['CMA', 'CT'])
+
+    assert aggregator.add(_create_pge_message('ppsCmask', 'cma.nc')) == []
+    assert aggregator.add(_create_pge_message('ppsCmask', 'cma.nc', START_TIME2)) == []
+    assert len(aggregator) == 2
+
+    messages = aggregator.add(_create_pge_message('ppsCtype', 'ct.nc'))
+    assert len(messages) == 1
+    msg = messages[0]
+    assert msg.type == 'dataset'
+    assert msg.subject == '/polar/direct_readout/CF/2/NWCSAF-PPSv2018/'
+    assert msg.data['dataset'] == [{'uri': 'ssh://TEST_SERVERNAME/tmp/cma.nc', 'uid': 'cma.nc', 'product': 'CMA'},
+                                   {'uri': 'ssh://TEST_SERVERNAME/tmp/ct.nc', 'uid': 'ct.nc', 'product': 'CT'}]
+    assert 'uri' not in msg.data
+    assert 'module' not in msg.data
+    assert msg.data['start_time'] == START_TIME1
+    assert len(aggregator) == 1
+
+
+def test_aggregator_flushes_incomplete_scenes_after_timeout():
+    """Test that an incomplete scene is published when the deadline has passed."""
+    import time
+    from nwcsafpps_runner.pps_posttroll_hook import SceneMessageAggregator
+
+    aggregator = SceneMessageAggregator(['CMA', 'CT'], timeout=10, topic='/my/dataset/topic/')
+    aggregator.add(_create_pge_message('ppsCmask', 'cma.nc'))
+
+    assert aggregator.flush_expired() == []
+    messages = aggregator.flush_expired(time.time() + 11)
+    assert len(messages) == 1
+    assert messages[0].subject == '/my/dataset/topic/'
+    assert messages[0].data['dataset'][0]['product'] == 'CMA'
+    assert len(aggregator) == 0
+
+
+def test_aggregator_flushes_all_scenes():
+    """Test that all the incomplete scenes can be published at once."""
+    from nwcsafpps_runner.pps_posttroll_hook import SceneMessageAggregator
+
+    aggregator = SceneMessageAggregator(['CMA', 'CT'])
+    aggregator.add(_create_pge_message('ppsCmask', 'cma.nc'))
+    aggregator.add(_create_pge_message('ppsCmask', 'cma.nc', START_TIME2))
+
+    messages = aggregator.flush_all()
+    assert len(messages) == 2
+    assert all(msg.type == 'dataset' for msg in messages)
+    assert len(aggregator) == 0
+    assert aggregator.flush_all() == []
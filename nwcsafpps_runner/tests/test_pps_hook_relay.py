@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the relay publishing the messages from the PPS post-hooks."""
+
+import socket
+import sys
+import time
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from nwcsafpps_runner.pps_hook_relay import PPSHookRelay, bind_relay_socket
+from nwcsafpps_runner.pps_posttroll_hook import send_to_relay
+
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="Unix domain sockets are needed")
+
+
+def _wait_for(condition, timeout=5.0):
+    start = time.time()
+    while not condition() and time.time() - start < timeout:
+        time.sleep(0.01)
+
+
+def test_relay_publishes_messages_from_hooks(tmp_path):
+    """Test that the messages handed over by the hooks are published by the relay."""
+    socket_path = str(tmp_path / 'relay.sock')
+    publisher = MagicMock()
+    with patch('nwcsafpps_runner.pps_hook_relay.Publish') as publish:
+        publish.return_value.__enter__.return_value = publisher
+        relay = PPSHookRelay(socket_path)
+        relay.start()
+        try:
+            assert send_to_relay(socket_path, 'pytroll://my/topic file a@b 2021 v1.01 application/json {}')
+            assert send_to_relay(socket_path, 'pytroll://my/other/topic file a@b 2021 v1.01 application/json {}')
+            _wait_for(lambda: publisher.send.call_count == 2)
+        finally:
+            relay.stop()
+            relay.join()
+
+    publish.assert_called_once()
+    assert publisher.send.call_count == 2
+    assert publisher.send.call_args_list[0][0][0].startswith('pytroll://my/topic')
+    assert not (tmp_path / 'relay.sock').exists()
+
+
+def test_relay_publishes_pending_scenes_at_stop(tmp_path):
+    """Test that the scenes still waited for are published when the relay is stopped."""
+    from nwcsafpps_runner.pps_posttroll_hook import SceneMessageAggregator
+
+    socket_path = str(tmp_path / 'relay.sock')
+    publisher = MagicMock()
+    msg = ('pytroll://my/CMA/topic file a@b 2021-05-13T12:00:00 v1.01 application/json '
+           '{"module": "ppsCmask", "platform_name": "NOAA-19", "orbit_number": 1, '
+           '"start_time": "2021-05-13T11:00:00", "uri": "/tmp/cma.nc", "uid": "cma.nc"}')
+    with patch('nwcsafpps_runner.pps_hook_relay.Publish') as publish:
+        publish.return_value.__enter__.return_value = publisher
+        aggregator = SceneMessageAggregator(['CMA', 'CT'], timeout=3600)
+        relay = PPSHookRelay(socket_path, aggregator=aggregator)
+        relay.start()
+        try:
+            assert send_to_relay(socket_path, msg)
+            _wait_for(lambda: len(aggregator) == 1)
+            assert publisher.send.call_count == 0
+        finally:
+            relay.stop()
+            relay.join()
+
+    assert publisher.send.call_count == 1
+    assert ' dataset ' in publisher.send.call_args[0][0]
+    assert len(aggregator) == 0
+
+
+def test_send_to_relay_without_relay(tmp_path):
+    """Test that handing over a message fails gracefully if no relay is running."""
+    assert not send_to_relay(str(tmp_path / 'no_relay.sock'), 'some message')
+
+
+def test_stale_relay_socket_is_replaced(tmp_path):
+    """Test that a socket file left behind by a dead relay is replaced."""
+    socket_path = str(tmp_path / 'relay.sock')
+    old = bind_relay_socket(socket_path)
+    old.close()
+
+    sock = bind_relay_socket(socket_path)
+    sock.close()
+
+
+def test_live_relay_socket_is_not_replaced(tmp_path):
+    """Test that the socket of a relay still running is not removed."""
+    socket_path = str(tmp_path / 'relay.sock')
+    live = bind_relay_socket(socket_path)
+    try:
+        with pytest.raises(IOError):
+            bind_relay_socket(socket_path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        probe.connect(socket_path)
+        probe.close()
+    finally:
+        live.close()
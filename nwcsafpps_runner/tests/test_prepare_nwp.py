@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the preparation of the NWP data for PPS."""
+
+import multiprocessing
+import os
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from trollsift import Parser
+
+from nwcsafpps_runner.nwp_inventory import STATUS_DONE, STATUS_FAILED, STATUS_INCOMPLETE, NwpInventory
+
+NHSF_SIFT = '{ecmwf_prefix:9s}_{analysis_time:%Y%m%d%H%M}+{forecast_step:d}H00M'
+
+
+@pytest.fixture
+def prepare_nwp():
+    """Get the prepare_nwp module, without reading a runner configuration at import."""
+    with patch('nwcsafpps_runner.config.get_config', return_value={'nhsp_path': '', 'nhsp_prefix': ''}):
+        from nwcsafpps_runner import prepare_nwp
+    return prepare_nwp
+
+
+def _produce_nwp_file(timeinfo, timestamp, forecast_step, nhsp_file, result_file):
+    with open(result_file, 'w') as fpt:
+        fpt.write('%d %d' % (os.getpid(), os.nice(0)))
+    return STATUS_DONE
+
+
+def _create_input(tmp_path, steps):
+    for dirname in ('nhsf', 'nhsp', 'out'):
+        (tmp_path / dirname).mkdir()
+    for step in steps:
+        (tmp_path / 'nhsf' / ('LL02_NHSF_202103050000+%03dH00M' % step)).write_text('nhsf')
+        (tmp_path / 'nhsp' / ('LL02_NHSP_202103050000+%03dH00M' % step)).write_text('nhsp')
+    (tmp_path / 'lsm_z.grib1').write_text('static')
+
+
+def _patch_config(prepare_nwp, tmp_path, nworkers=1):
+    return patch.multiple(prepare_nwp, nhsf_path=str(tmp_path / 'nhsf'), nhsf_prefix='LL02_NHSF_',
+                          nhsp_path=str(tmp_path / 'nhsp'), nhsp_prefix='LL02_NHSP_',
+                          nwp_outdir=str(tmp_path / 'out'), nwp_output_prefix='LL02_NHSPSF_',
+                          nwp_lsmz_filename=str(tmp_path / 'lsm_z.grib1'), nwp_cache=None,
+                          _produce_nwp_file=_produce_nwp_file,
+                          OPTIONS={'nwp_prepare_workers': nworkers, 'nwp_prepare_niceness': 1})
+
+
+def _result_file(tmp_path, step):
+    return tmp_path / 'out' / ('LL02_NHSPSF_202103050000+%03dH00M' % step)
+
+
+def test_done_input_files_are_skipped(tmp_path, prepare_nwp):
+    """Test that the input files already prepared are skipped, unless their result file is removed."""
+    _create_input(tmp_path, [3, 6])
+    inventory = NwpInventory()
+
+    with _patch_config(prepare_nwp, tmp_path):
+        prepare_nwp._update_nwp(datetime(2021, 3, 1), [3, 6], Parser(NHSF_SIFT), inventory)
+        assert _result_file(tmp_path, 3).exists() and _result_file(tmp_path, 6).exists()
+        _result_file(tmp_path, 3).write_text('done before')
+        _result_file(tmp_path, 6).unlink()
+
+        prepare_nwp._update_nwp(datetime(2021, 3, 1), [3, 6], Parser(NHSF_SIFT), inventory)
+        assert _result_file(tmp_path, 3).read_text() == 'done before'
+        assert _result_file(tmp_path, 6).exists()
+        nhsf_file = str(tmp_path / 'nhsf' / 'LL02_NHSF_202103050000+006H00M')
+        assert inventory.get_status(nhsf_file) == STATUS_DONE
+
+
+def test_only_grib_copy_failures_are_counted(tmp_path, prepare_nwp):
+    """Test that files missing some fields do not count as failures of grib_copy."""
+    _create_input(tmp_path, [3, 6])
+    inventory = NwpInventory()
+
+    with _patch_config(prepare_nwp, tmp_path):
+        with patch.object(prepare_nwp, '_produce_nwp_file', return_value=STATUS_INCOMPLETE):
+            prepare_nwp._update_nwp(datetime(2021, 3, 1), [3, 6], Parser(NHSF_SIFT), inventory)
+        nhsf_file = str(tmp_path / 'nhsf' / 'LL02_NHSF_202103050000+003H00M')
+        assert inventory.get_status(nhsf_file) == STATUS_INCOMPLETE
+
+        with patch.object(prepare_nwp, '_produce_nwp_file', return_value=STATUS_FAILED):
+            with pytest.raises(IOError):
+                prepare_nwp._update_nwp(datetime(2021, 3, 1), [3, 6], Parser(NHSF_SIFT), inventory)
+
+
+def test_files_prepared_in_worker_processes(tmp_path, prepare_nwp):
+    """Test that the NWP files are prepared in niced worker processes, and their status recorded."""
+    if multiprocessing.get_start_method() != 'fork':
+        pytest.skip("The patched configuration only reaches forked worker processes")
+    _create_input(tmp_path, [3, 6, 9])
+    inventory = NwpInventory()
+
+    with _patch_config(prepare_nwp, tmp_path, nworkers=2):
+        prepare_nwp._update_nwp(datetime(2021, 3, 1), [3, 6, 9], Parser(NHSF_SIFT), inventory)
+
+    for step in (3, 6, 9):
+        pid, niceness = _result_file(tmp_path, step).read_text().split()
+        assert int(pid) != os.getpid()
+        assert int(niceness) == min(os.nice(0) + 1, 19)
+        assert inventory.get_status(str(tmp_path / 'nhsf' / ('LL02_NHSF_202103050000+%03dH00M' % step))) == STATUS_DONE
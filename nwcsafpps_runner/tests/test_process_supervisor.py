@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the supervisor of the subprocesses."""
+
+import logging
+import multiprocessing
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from nwcsafpps_runner.process_supervisor import UNKNOWN_EXIT_CODE, ProcessSupervisor, get_process_supervisor
+from nwcsafpps_runner.utils import run_command, run_jobs
+
+
+@pytest.fixture
+def create_supervisor():
+    """Create supervisors, shut down at the end of the test."""
+    supervisors = []
+
+    def _create(**kwargs):
+        supervisors.append(ProcessSupervisor(**kwargs))
+        return supervisors[-1]
+
+    yield _create
+    for supervisor in supervisors:
+        supervisor.shutdown()
+
+
+def test_output_is_logged_line_by_line(create_supervisor):
+    """Test that the output of stdout and stderr is logged, also without a last newline."""
+    supervisor = create_supervisor()
+    lines = []
+
+    future = supervisor.launch("echo out; echo err >&2; printf last; exit 2", shell=True, log_func=lines.append)
+
+    assert future.result(timeout=10) == 2
+    assert sorted(lines) == ['err', 'last', 'out']
+    assert len(supervisor) == 0
+
+
+def test_many_processes_in_one_thread(create_supervisor):
+    """Test that many processes are supervised without a thread per process."""
+    supervisor = create_supervisor()
+    nthreads = threading.active_count()
+
+    futures = [supervisor.launch(['sh', '-c', 'sleep 0.2; exit %d' % (i % 3)], log_func=None) for i in range(20)]
+
+    assert threading.active_count() <= nthreads + 1
+    assert [future.result(timeout=10) for future in futures] == [i % 3 for i in range(20)]
+
+
+def test_process_is_killed_at_deadline(caplog, create_supervisor):
+    """Test that a process is killed at its deadline, while a process without deadline goes on."""
+    supervisor = create_supervisor()
+    start = time.monotonic()
+
+    with caplog.at_level(logging.INFO):
+        slow = supervisor.launch(['sleep', '10'], timeout=0.2, scene='scene1')
+        quick = supervisor.launch(['sleep', '0.5'])
+        assert slow.result(timeout=10) == -9
+        assert quick.result(timeout=10) == 0
+
+    assert time.monotonic() - start < 5
+    assert "Scene: scene1" in caplog.text
+
+
+def test_processes_are_polled_without_pidfd(create_supervisor):
+    """Test that the exits are found by polling when there is no pidfd."""
+    supervisor = create_supervisor(poll_interval=0.05)
+
+    with patch('os.pidfd_open', side_effect=OSError, create=True):
+        future = supervisor.launch(['true'])
+        assert future.result(timeout=10) == 0
+
+
+def test_output_to_file(tmp_path, create_supervisor):
+    """Test that the output goes to the given file."""
+    supervisor = create_supervisor()
+    with open(tmp_path / 'out.log', 'wb') as fpt:
+        future = supervisor.launch("echo out; echo err >&2", shell=True, stdout=fpt)
+        assert future.result(timeout=10) == 0
+
+    assert (tmp_path / 'out.log').read_text() == 'out\nerr\n'
+
+
+def test_run_command():
+    """Test running a command with the shared supervisor."""
+    assert run_command('sh -c "exit 3"') == 3
+
+
+def test_run_command_in_forked_workers():
+    """Test that the forked worker processes do not use the supervisor of the parent."""
+    if multiprocessing.get_start_method() != 'fork':
+        pytest.skip("Only forked processes inherit the supervisor")
+    assert get_process_supervisor().launch(['true']).result(timeout=10) == 0
+
+    jobs = [('true',), ('sh -c "exit 3"',)]
+    results = dict(run_jobs(run_command, jobs, nworkers=2))
+
+    assert results == {('true',): 0, ('sh -c "exit 3"',): 3}
+
+
+def test_process_reaped_by_someone_else(create_supervisor, caplog):
+    """Test that a process reaped outside the supervisor does not look successful."""
+    supervisor = create_supervisor(poll_interval=0.05)
+
+    with patch('os.pidfd_open', side_effect=OSError, create=True):
+        with patch('os.waitpid', side_effect=ChildProcessError):
+            future = supervisor.launch(['true'])
+            assert future.result(timeout=10) == UNKNOWN_EXIT_CODE
+    assert 'reaped by someone else' in caplog.text
+
+
+def test_finished_deadlines_released(create_supervisor):
+    """Test that the deadlines of the finished processes are not kept."""
+    supervisor = create_supervisor()
+
+    futures = [supervisor.launch(['true'], timeout=600) for _ in range(10)]
+
+    assert [future.result(timeout=10) for future in futures] == [0] * 10
+    assert supervisor._deadlines == []
+
+
+def test_shutdown(create_supervisor):
+    """Test that the supervisor thread stops at shutdown, and that the running processes are killed."""
+    supervisor = create_supervisor()
+    nthreads = threading.active_count()
+    future = supervisor.launch(['sleep', '10'])
+
+    assert threading.active_count() == nthreads + 1
+    supervisor.shutdown()
+
+    assert threading.active_count() == nthreads
+    with pytest.raises(RuntimeError):
+        future.result(timeout=1)
+    assert supervisor.launch(['true']).result(timeout=10) == 0
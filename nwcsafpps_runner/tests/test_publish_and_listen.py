@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the listener of the level-1 messages."""
+
+from datetime import datetime
+from queue import Queue
+
+from posttroll.message import Message
+
+from nwcsafpps_runner.publish_and_listen import FileListener, MessageDeduplicator, create_message_deduplicator
+
+START_TIME = datetime(2021, 5, 7, 12, 0)
+
+
+def _file_message(uid, platform_name='NOAA-19'):
+    return Message('/my/topic', 'file', {'platform_name': platform_name, 'orbit_number': 12345,
+                                         'start_time': START_TIME, 'uid': uid, 'uri': '/data/' + uid})
+
+
+def test_duplicate_messages_dropped():
+    """Test that a message is dropped when all its files were already received."""
+    listener = FileListener(Queue(), ['/my/topic'],
+                            deduplicator=create_message_deduplicator({'message_dedup_ttl': 3600}))
+    assert listener.check_message(_file_message('hrpt_noaa19.l1b'))
+    assert not listener.check_message(_file_message('hrpt_noaa19.l1b'))
+    assert listener.check_message(_file_message('hrpt_noaa19.l1b', platform_name='NOAA-18'))
+
+    collection = Message('/my/topic', 'collection', {
+        'platform_name': 'NOAA-19', 'orbit_number': 12345, 'start_time': START_TIME,
+        'collection': [{'dataset': [{'uid': 'hrpt_noaa19.l1b'}, {'uid': 'amsua_noaa19.l1c'}]}]})
+    assert listener.check_message(collection)
+    assert not listener.check_message(collection)
+    assert listener.deduplicator.stats() == {'received': 5, 'dropped': 2, 'files': 3}
+
+    assert create_message_deduplicator({'message_dedup_ttl': 0}) is None
+    assert create_message_deduplicator({}) is None
+
+
+def test_files_without_identifier_not_deduplicated():
+    """Test that the files without uid nor uri are not taken as duplicates of each other."""
+    dedup = MessageDeduplicator()
+    msg = Message('/my/topic', 'file', {'platform_name': 'NOAA-19', 'start_time': START_TIME})
+    assert not dedup.is_duplicate(msg)
+    assert not dedup.is_duplicate(msg)
+    assert dedup.stats()['files'] == 0
+
+
+def test_duplicates_forgotten_after_ttl_and_when_full():
+    """Test that the files are forgotten after the time to live, and the least recent ones when full."""
+    dedup = MessageDeduplicator(max_size=2, ttl=100)
+    assert not dedup.is_duplicate(_file_message('a'), now=0)
+    assert dedup.is_duplicate(_file_message('a'), now=50)
+    assert not dedup.is_duplicate(_file_message('a'), now=151)
+
+    assert not dedup.is_duplicate(_file_message('b'), now=160)
+    assert not dedup.is_duplicate(_file_message('c'), now=170)
+    assert not dedup.is_duplicate(_file_message('a'), now=180)
+    assert dedup.is_duplicate(_file_message('c'), now=190)
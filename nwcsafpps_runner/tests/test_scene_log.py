@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the log files of the PPS output of the scenes."""
+
+import asyncio
+import gzip
+import logging
+import subprocess
+from datetime import datetime
+
+from nwcsafpps_runner.async_runner import AsyncPPSRunner
+from nwcsafpps_runner.scene_log import SceneLog, create_scene_log, read_tail
+
+SCENE = {'platform_name': 'NOAA-19', 'orbit_number': 12345, 'starttime': datetime(2021, 3, 5, 7, 15)}
+
+
+def test_scene_log_name(tmp_path):
+    """Test the name of the log file of a scene."""
+    scene_log = SceneLog(str(tmp_path), SCENE)
+
+    assert scene_log.filename == str(tmp_path / 'pps_NOAA-19_12345_20210305T071500.log')
+    assert create_scene_log({}, SCENE) is None
+
+
+def test_log_dir_created(tmp_path):
+    """Test that a missing log directory is created."""
+    scene_log = create_scene_log({'pps_scene_log_dir': str(tmp_path / 'scenes' / 'logs')}, SCENE)
+    scene_log.open().write(b'PPS output\n')
+
+    assert scene_log.close() == str(tmp_path / 'scenes' / 'logs' / 'pps_NOAA-19_12345_20210305T071500.log')
+
+
+def test_read_tail(tmp_path):
+    """Test reading the last lines of a file longer than one block."""
+    filename = tmp_path / 'out.log'
+    filename.write_text(''.join('line %d\n' % i for i in range(5000)))
+
+    assert read_tail(str(filename), 3) == ['line 4997', 'line 4998', 'line 4999']
+    assert read_tail(str(filename), 0) == []
+
+
+def test_process_writes_to_the_log(tmp_path, caplog):
+    """Test that the process output goes to the log file, and its end to the runner log on failure."""
+    scene_log = create_scene_log({'pps_scene_log_dir': str(tmp_path), 'pps_scene_log_tail_lines': 2}, SCENE)
+    returncode = subprocess.call("seq 1 10; echo error >&2; exit 3", shell=True,
+                                 stdout=scene_log.open(), stderr=subprocess.STDOUT)
+
+    with caplog.at_level(logging.INFO):
+        filename = scene_log.close(returncode)
+
+    with open(filename) as fpt:
+        assert fpt.read().split() == [str(i) for i in range(1, 11)] + ['error']
+    assert '10\nerror' in caplog.text
+    assert '\n9\n' not in caplog.text
+
+
+def test_log_compressed_at_close(tmp_path):
+    """Test that the log file is compressed when closed."""
+    scene_log = SceneLog(str(tmp_path), SCENE, compress=True)
+    scene_log.open().write(b'PPS output\n')
+
+    filename = scene_log.close()
+
+    assert filename.endswith('.log.gz')
+    assert not (tmp_path / 'pps_NOAA-19_12345_20210305T071500.log').exists()
+    with gzip.open(filename) as fpt:
+        assert fpt.read() == b'PPS output\n'
+
+
+def test_async_command_writes_to_the_log(tmp_path):
+    """Test that the commands of the event loop based runner write to the log file."""
+    runner = AsyncPPSRunner({}, create_scene=None, prepare_nwp=None, create_commands=None, post_process=None)
+    scene_log = SceneLog(str(tmp_path), SCENE)
+
+    assert asyncio.run(runner.run_command(['echo', 'hello'], SCENE, scene_log)) == 0
+    scene_log.close()
+
+    assert (tmp_path / 'pps_NOAA-19_12345_20210305T071500.log').read_text() == 'hello\n'
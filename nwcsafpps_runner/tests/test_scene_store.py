@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the store of the scenes being assembled."""
+
+import json
+import time
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from posttroll.message import Message
+
+from nwcsafpps_runner.scene_store import SceneStore, create_scene_store, replay_journal
+
+
+def test_files_added_once():
+    """Test that duplicate files are not added again, and that popping a scene removes its files."""
+    store = create_scene_store({})
+    assert store.add_files('noaa19_12345', ['/data/hrpt.l1b', '/data/amsua.l1c']) == 2
+    assert store.add_files('noaa19_12345', ['/data/amsua.l1c', '/data/mhs.l1c']) == 1
+    assert store.get_files('noaa19_12345') == ['/data/hrpt.l1b', '/data/amsua.l1c', '/data/mhs.l1c']
+    assert store.num_files('noaa19_12345') == 3
+    assert store.stats() == {'scenes': 1, 'files': 3, 'evicted': 0}
+
+    assert store.pop('noaa19_12345') == ['/data/hrpt.l1b', '/data/amsua.l1c', '/data/mhs.l1c']
+    assert store.pop('noaa19_12345', []) == []
+    assert store.stats() == {'scenes': 0, 'files': 0, 'evicted': 0}
+
+
+def test_old_scenes_and_overflow_evicted():
+    """Test that the scenes older than the time to live are evicted, and the oldest ones when full."""
+    on_evict = MagicMock()
+    store = SceneStore(ttl=100, max_scenes=3, max_files=5, on_evict=on_evict)
+    store.add_files('scene1', ['a'], now=0)
+    store.add_files('scene2', ['b'], now=50)
+    store.add_files('scene3', ['c'], now=120)
+    on_evict.assert_called_once_with('scene1', ['a'])
+    assert 'scene1' not in store
+
+    store.add_files('scene4', ['d'], now=130)
+    store.add_files('scene5', ['e'], now=140)
+    assert list(store._scenes) == ['scene3', 'scene4', 'scene5']
+
+    store.add_files('scene3', ['f', 'g', 'h'], now=150)
+    assert list(store._scenes) == ['scene3', 'scene5']
+    assert store.stats() == {'scenes': 2, 'files': 5, 'evicted': 3}
+
+
+def _message(sensor, orbit_number=12345):
+    return Message('/my/topic', 'file', {'platform_name': 'NOAA-19', 'orbit_number': orbit_number, 'sensor': sensor,
+                                         'uri': '/data/%s_%d' % (sensor, orbit_number),
+                                         'start_time': datetime(2021, 5, 7, 12, 0)})
+
+
+def _add(store, msg):
+    sceneid = 'NOAA-19_%d' % msg.data['orbit_number']
+    store.add_files(sceneid, [msg.data['uri']], msg=msg)
+    return sceneid
+
+
+def test_journal_replayed_after_restart(tmp_path):
+    """Test that the scenes not processed to the end are assembled again after a restart."""
+    options = {'scene_journal_file': str(tmp_path / 'scenes.journal')}
+    store = create_scene_store(options)
+    _add(store, _message('avhrr/3', 1))
+    _add(store, _message('amsu-a', 1))
+    _add(store, _message('avhrr/3', 2))
+    store.pop(_add(store, _message('amsu-a', 2)))
+    store.pop(_add(store, _message('avhrr/3', 3)))
+    store.scene_done('NOAA-19_3')
+    store.journal.close()
+    with open(options['scene_journal_file'], 'ab') as fpt:
+        fpt.write(b'{"op": "mess')
+
+    restarted = create_scene_store(options)
+    replayed = []
+    replay_journal(restarted, lambda msg: replayed.append(_add(restarted, msg)))
+    assert replayed == ['NOAA-19_1', 'NOAA-19_1', 'NOAA-19_2', 'NOAA-19_2']
+    assert restarted.get_files('NOAA-19_1') == ['/data/avhrr/3_1', '/data/amsu-a_1']
+    assert restarted.get_files('NOAA-19_2') == ['/data/avhrr/3_2', '/data/amsu-a_2']
+    assert restarted.get_files('NOAA-19_3') == []
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['scenes.journal']
+
+
+def test_journal_replay_is_fast(tmp_path):
+    """Test that a journal of some thousand messages is replayed well under a second."""
+    options = {'scene_journal_file': str(tmp_path / 'scenes.journal')}
+    store = create_scene_store(options)
+    for orbit_number in range(1000):
+        for sensor in ['avhrr/3', 'amsu-a', 'mhs']:
+            _add(store, _message(sensor, orbit_number))
+    store.journal.close()
+
+    restarted = create_scene_store(options)
+    start = time.monotonic()
+    replay_journal(restarted, lambda msg: _add(restarted, msg))
+    assert time.monotonic() - start < 1
+    assert restarted.stats() == {'scenes': 1000, 'files': 3000, 'evicted': 0}
+
+
+def test_scene_popped_but_not_run(tmp_path):
+    """Test that a dropped scene is not replayed, unless it is popped again and still running."""
+    options = {'scene_journal_file': str(tmp_path / 'scenes.journal')}
+    store = create_scene_store(options)
+    store.pop(_add(store, _message('avhrr/3', 1)))
+    store.scene_dropped('NOAA-19_1')
+    store.pop(_add(store, _message('avhrr/3', 2)))
+    # A duplicate of the scene being processed, not run
+    store.pop(_add(store, _message('avhrr/3', 2)))
+    store.scene_dropped('NOAA-19_2')
+    store.journal.close()
+
+    restarted = create_scene_store(options)
+    replayed = []
+    replay_journal(restarted, lambda msg: replayed.append(_add(restarted, msg)))
+    assert replayed == ['NOAA-19_2', 'NOAA-19_2']
+
+    restarted.pop('NOAA-19_2')
+    restarted.scene_done('NOAA-19_2')
+    assert restarted.journal.replay() == []
+
+
+def test_messages_after_start_kept_when_done(tmp_path):
+    """Test that the end of a scene does not clear the messages of the scene assembled again meanwhile."""
+    options = {'scene_journal_file': str(tmp_path / 'scenes.journal'), 'scene_journal_compact_after': 1}
+    store = create_scene_store(options)
+    store.pop(_add(store, _message('avhrr/3', 1)))
+    _add(store, _message('amsu-a', 1))
+    store.pop(_add(store, _message('avhrr/3', 2)))
+    store.scene_dropped('NOAA-19_2')
+    store.pop('NOAA-19_1')
+    _add(store, _message('mhs', 1))
+    store.scene_done('NOAA-19_1')
+    store.scene_done('NOAA-19_1')
+    store.journal.close()
+
+    restarted = create_scene_store(options)
+    replayed = []
+    replay_journal(restarted, lambda msg: replayed.append(_add(restarted, msg)))
+    assert replayed == ['NOAA-19_1']
+    assert restarted.get_files('NOAA-19_1') == ['/data/mhs_1']
+
+
+def test_journal_compacted(tmp_path):
+    """Test that the journal is rewritten with the pending scenes only, after some finished scenes."""
+    options = {'scene_journal_file': str(tmp_path / 'scenes.journal'), 'scene_journal_compact_after': 3}
+    store = create_scene_store(options)
+    _add(store, _message('avhrr/3', 0))
+    for orbit_number in range(1, 4):
+        store.pop(_add(store, _message('avhrr/3', orbit_number)))
+        store.scene_done('NOAA-19_%d' % orbit_number)
+
+    with open(options['scene_journal_file']) as fpt:
+        assert [json.loads(line)['scene'] for line in fpt] == ['NOAA-19_0']
+    assert create_scene_store(options, use_journal=False).journal is None
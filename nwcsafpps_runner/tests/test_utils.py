@@ -21,8 +21,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Test utility functions."""
-from nwcsafpps_runner.utils import get_outputfiles
+from nwcsafpps_runner.pps_posttroll_hook import PPSMessage, SPOOL_FILE_ENV
+from nwcsafpps_runner.utils import (HostResolver, check_uri, create_output_spool, get_outputfiles, publish_pps_files,
+                                    read_output_spool, run_jobs)
+from posttroll.message import Message
+from datetime import datetime
+from queue import Queue
+import socket
+from unittest.mock import patch
 import os
+import pytest
 
 
 def test_outputfiles(tmp_path):
@@ -94,5 +102,93 @@ def test_outputfiles(tmp_path):
     assert set(res) == set(expected)
 
 
+@pytest.mark.parametrize('nworkers', [1, 3])
+def test_run_jobs(nworkers):
+    """Test running jobs serially and in a process pool."""
+    jobs = [(2, 3), (3, 2), (4, 1)]
+    results = dict(run_jobs(pow, jobs, nworkers=nworkers, niceness=1))
+    assert results == {(2, 3): 8, (3, 2): 9, (4, 1): 4}
+
+    with pytest.raises(ZeroDivisionError):
+        list(run_jobs(pow, [(2, 3), (0, -1)], nworkers=nworkers))
+
+
+def test_output_files_reported_by_hooks(tmp_path, monkeypatch):
+    """Test that the files reported by the post-hooks of the PGEs are read back by the runner."""
+    spool_file = create_output_spool(str(tmp_path), {'platform_name': 'NOAA-19', 'orbit_number': 12345})
+    monkeypatch.setenv(SPOOL_FILE_ENV, spool_file)
+    cma = str(tmp_path / "S_NWC_CMA_noaa19_12345_20210305T0715000Z_20210305T0730000Z.nc")
+    ct = str(tmp_path / "S_NWC_CT_noaa19_12345_20210305T0715000Z_20210305T0730000Z.nc")
+
+    hook = PPSMessage.__new__(PPSMessage)
+    hook.metadata = {}
+    with patch('nwcsafpps_runner.pps_posttroll_hook.PostTrollMessage'):
+        hook(0, {'filename': cma})
+        hook(0, {'filename': [ct, str(tmp_path / "S_NWC_viirs_npp_12345_20210305T0715000Z.txt")]})
+        hook(1, {'filename': str(tmp_path / "S_NWC_CTTH_noaa19_12345_20210305T0715000Z_20210305T0730000Z.nc")})
+        hook(0, {'filename': cma})
+
+    assert read_output_spool(spool_file) == [cma, ct]
+    assert not os.path.exists(spool_file)
+
+
+@pytest.mark.parametrize('dataset', [False, True])
+def test_publish_pps_files(dataset):
+    """Test publishing the result files of a scene one by one, or in one dataset message."""
+    input_msg = Message('/my/topic', 'collection', {'platform_name': 'Suomi-NPP', 'sensor': 'viirs',
+                                                    'collection': [{'uri': '/data/granule%d' % idx}
+                                                                   for idx in range(10)]})
+    scene = {'platform_name': 'Suomi-NPP', 'orbit_number': 51234, 'sensor': 'viirs'}
+    result_files = ['/pps/S_NWC_CMA_npp_51234_20210305T0715000Z_20210305T0716325Z.nc',
+                    '/pps/S_NWC_CT_npp_51234_20210305T0716000Z_20210305T0717325Z.nc']
+    publish_q = Queue()
+
+    publish_pps_files(input_msg, publish_q, scene, result_files, environment='test',
+                      servername='pps-host', station='norrkoping', dataset=dataset)
+
+    messages = [Message(rawstr=publish_q.get()) for _ in range(publish_q.qsize())]
+    assert all('collection' not in msg.data for msg in messages)
+    if not dataset:
+        assert [msg.type for msg in messages] == ['file', 'file']
+        assert messages[1].data['uid'] == 'S_NWC_CT_npp_51234_20210305T0716000Z_20210305T0717325Z.nc'
+        assert messages[1].data['start_time'] == datetime(2021, 3, 5, 7, 16)
+        return
+    assert len(messages) == 1
+    msg = messages[0]
+    assert (msg.subject, msg.type) == ('/CF/2/norrkoping/test/polar/direct_readout/', 'dataset')
+    assert (msg.data['start_time'], msg.data['end_time']) == (datetime(2021, 3, 5, 7, 15),
+                                                              datetime(2021, 3, 5, 7, 17, 32, 500000))
+    assert msg.data['dataset'] == [{'uri': 'ssh://pps-host//pps/' + os.path.basename(filename),
+                                    'uid': os.path.basename(filename), 'format': 'CF', 'type': 'netCDF4'}
+                                   for filename in result_files]
+    assert (msg.data['orbit_number'], msg.data['sensor']) == (51234, 'viirs')
+
+
+def test_host_names_resolved_once(tmp_path):
+    """Test that each host name of the uris is resolved once, and that the local addresses are cached."""
+    resolver = HostResolver(local_ips_min_refresh=60)
+    addresses = {'localhost': '127.0.0.1', 'otherhost': '10.0.0.2'}
+
+    def _gethostbyname(hostname):
+        if hostname not in addresses:
+            raise socket.gaierror(hostname)
+        return addresses[hostname]
+
+    existing = tmp_path / 'granule'
+    existing.write_text('sdr')
+    uris = ['ssh://localhost/data/granule%d' % idx for idx in range(100)]
+    uris += ['ssh://otherhost' + str(existing), 'ssh://unknownhost/data/granule']
+    with patch('nwcsafpps_runner.utils.HOST_RESOLVER', resolver), \
+            patch('socket.gethostbyname', side_effect=_gethostbyname) as gethostbyname, \
+            patch('nwcsafpps_runner.utils.get_local_ips', return_value=['127.0.0.1']) as get_local_ips:
+        assert check_uri(uris)[-2:] == [str(existing), '/data/granule']
+        assert check_uri(uris[:1]) == ['/data/granule0']
+        assert gethostbyname.call_count == 3
+        assert get_local_ips.call_count == 1
+
+        with pytest.raises(IOError):
+            check_uri('ssh://otherhost/data/granule')
+
+
 if __name__ == "__main__":
     pass
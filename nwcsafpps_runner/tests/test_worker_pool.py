@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll developers
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Test the worker pool with a pending-job queue."""
+
+import threading
+from datetime import datetime, timedelta
+
+from nwcsafpps_runner.scene_index import SceneIntervalIndex
+from nwcsafpps_runner.utils import SceneId
+from nwcsafpps_runner.worker_pool import FreshnessPolicy, WorkerPool, create_scheduling_policy
+
+
+def test_fixed_number_of_workers_process_all_jobs():
+    """Test that the jobs are queued and processed by a fixed number of workers."""
+    release = threading.Event()
+    done = []
+    threads_before = threading.active_count()
+
+    pool = WorkerPool(2)
+    assert threading.active_count() == threads_before + 2
+    for idx in range(6):
+        assert pool.submit(idx, target=lambda idx: (release.wait(), done.append(idx)), args=(idx,))
+    assert threading.active_count() == threads_before + 2
+    assert not pool.submit(5, target=done.append, args=(5,))
+
+    release.set()
+    pool.shutdown()
+
+    assert sorted(done) == list(range(6))
+    assert pool.queue_depth() == 0
+    assert pool.jobs == set()
+
+
+def test_queue_stats_and_cancel():
+    """Test the queue depth, wait time statistics and cancelling of a pending job."""
+    release = threading.Event()
+    done = []
+
+    pool = WorkerPool(1)
+    pool.submit('a', target=release.wait)
+    pool.submit('b', target=done.append, args=('b', ))
+    pool.submit('c', target=done.append, args=('c', ))
+
+    stats = pool.stats()
+    assert stats['pending'] + stats['running'] == 3
+    assert stats['oldest_wait_time'] >= 0.0
+
+    assert pool.cancel('b')
+    assert not pool.cancel('b')
+
+    release.set()
+    pool.shutdown()
+    assert done == ['c']
+
+
+def test_backpressure_at_high_water_mark():
+    """Test that waiting for capacity blocks when too many jobs are pending."""
+    release = threading.Event()
+
+    pool = WorkerPool(1, high_water_mark=2)
+    pool.submit('running', target=release.wait)
+    assert pool.wait_for_capacity(timeout=1.0)
+    pool.submit('pending1', target=lambda: None)
+    pool.submit('pending2', target=lambda: None)
+    assert not pool.wait_for_capacity(timeout=0.1)
+
+    release.set()
+    assert pool.wait_for_capacity(timeout=5.0)
+    pool.shutdown()
+
+
+def _mda(minutes_old, platform_name='NOAA-19', variant='DR'):
+    end_time = datetime.utcnow() - timedelta(minutes=minutes_old)
+    return {'platform_name': platform_name, 'variant': variant,
+            'start_time': end_time - timedelta(minutes=15), 'end_time': end_time}
+
+
+def test_freshness_policy_max_age():
+    """Test the maximum age per stream, per platform and the default."""
+    policy = FreshnessPolicy(max_age_minutes=120,
+                             max_age_per_platform={'Metop-B': 60},
+                             max_age_per_stream={'EARS': 30})
+
+    assert not policy.is_stale(_mda(100))
+    assert policy.is_stale(_mda(130))
+    assert policy.is_stale(_mda(70, platform_name='Metop-B'))
+    assert policy.is_stale(_mda(40, platform_name='Metop-B', variant='EARS'))
+    assert not policy.is_stale({'start_time': datetime.utcnow(), 'end_time': 99999})
+    assert not FreshnessPolicy().is_stale(_mda(100000))
+
+
+def test_freshest_scenes_first_and_stale_scenes_dropped():
+    """Test that the pending scenes are run newest first and the stale ones are skipped."""
+    release = threading.Event()
+    done = []
+    policy = create_scheduling_policy({'scheduling_policy': 'freshest_first',
+                                       'max_scene_age_minutes': 120})
+
+    started = threading.Event()
+    pool = WorkerPool(1, policy=policy)
+    pool.submit('blocker', target=lambda: (started.set(), release.wait()))
+    started.wait(5.0)
+    assert pool.submit('old', target=done.append, args=('old',), mda=_mda(90))
+    assert pool.submit('new', target=done.append, args=('new',), mda=_mda(5))
+    assert pool.submit('middle', target=done.append, args=('middle',), mda=_mda(30))
+    assert not pool.submit('stale', target=done.append, args=('stale',), mda=_mda(200))
+
+    release.set()
+    pool.shutdown()
+
+    assert done == ['new', 'middle', 'old']
+    assert pool.stats()['dropped_stale'] == 1
+
+
+def test_scene_interval_index():
+    """Test finding the scenes starting within the threshold of a start time."""
+    index = SceneIntervalIndex(threshold=5)
+    start = datetime(2021, 5, 7, 12, 0)
+    for minutes in [0, 20, 40]:
+        index.add('NOAA-19', 12345, start + timedelta(minutes=minutes))
+
+    assert index.find('NOAA-19', 12345, start + timedelta(minutes=23)) == start + timedelta(minutes=20)
+    assert index.find('NOAA-19', 12345, start - timedelta(minutes=4)) == start
+    assert index.find('NOAA-19', 12345, start + timedelta(minutes=30)) is None
+    assert index.find('NOAA-19', 12345, start + timedelta(minutes=30), threshold=11) is not None
+    assert index.find('NOAA-18', 12345, start) is None
+
+    assert index.remove('NOAA-19', 12345, start + timedelta(minutes=20))
+    assert not index.remove('NOAA-19', 12345, start + timedelta(minutes=20))
+    assert index.find('NOAA-19', 12345, start + timedelta(minutes=23)) is None
+    assert len(index) == 2
+
+
+def test_scenes_starting_close_in_time_are_one_job():
+    """Test that a job is not queued when one for the same scene, a minute apart, is pending or running."""
+    release = threading.Event()
+    done = []
+    start = datetime(2021, 5, 7, 12, 0, 59)
+
+    pool = WorkerPool(1)
+    assert pool.submit(SceneId('NOAA-19', 12345, start), target=release.wait)
+    assert not pool.submit(SceneId('NOAA-19', 12345, start + timedelta(seconds=2)), target=done.append, args=(1,))
+    assert pool.submit(SceneId('NOAA-19', 12345, start + timedelta(minutes=30)), target=done.append, args=(2,))
+    assert len(set([SceneId('NOAA-19', 12345, start), SceneId('NOAA-19', 12345, start + timedelta(minutes=1))])) == 1
+
+    release.set()
+    pool.shutdown()
+    assert done == [2]
+    assert len(pool.scenes) == 0
+
+
+class _FlagPolicy(object):
+
+    @staticmethod
+    def priority(mda, seq):
+        return (seq, )
+
+    @staticmethod
+    def is_stale(mda):
+        return mda['stale']
+
+
+def test_dropped_jobs_reported():
+    """Test that the jobs dropped from the queue without being run are reported."""
+    release = threading.Event()
+    started = threading.Event()
+    dropped = []
+    pool = WorkerPool(1, policy=_FlagPolicy(), on_drop=lambda job_id, mda: dropped.append(job_id))
+    pool.submit('blocker', target=lambda: (started.set(), release.wait()), mda={'stale': False})
+    started.wait(5.0)
+    stale = {'stale': False}
+    pool.submit('stale', target=lambda: None, mda=stale)
+    pool.submit('cancelled', target=lambda: None, mda={'stale': False})
+
+    assert pool.cancel('cancelled')
+    stale['stale'] = True
+    release.set()
+    pool.shutdown()
+
+    assert dropped == ['cancelled', 'stale']
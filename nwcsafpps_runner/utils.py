@@ -24,19 +24,22 @@
 """
 
 import threading
-from trollsift.parser import parse  # @UnresolvedImport
 from posttroll.message import Message  # @UnresolvedImport
-from subprocess import Popen, PIPE
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
 import stat
 import netifaces
 import shlex
-from glob import glob
+import tempfile
 import socket
+import time
 from datetime import datetime, timedelta
 #: Python 2/3 differences
 from six.moves.urllib.parse import urlparse  # @UnresolvedImport
-
+from nwcsafpps_runner.output_index import OUTPUT_NAME, get_output_index
+from nwcsafpps_runner.process_supervisor import get_process_supervisor
+from nwcsafpps_runner.pps_filenames import (PPS_OUT_PATTERN, PPS_OUT_PATTERN_MULTIPLE,  # noqa: F401
+                                            PPS_STAT_PATTERN, parse_pps_filename)
 
 import logging
 LOG = logging.getLogger(__name__)
@@ -46,13 +49,6 @@ class NwpPrepareError(Exception):
     pass
 
 
-PPS_OUT_PATTERN = ("S_NWC_{segment}_{orig_platform_name}_{orbit_number:05d}_" +
-                   "{start_time:%Y%m%dT%H%M%S%f}Z_{end_time:%Y%m%dT%H%M%S%f}Z.{extention}")
-PPS_OUT_PATTERN_MULTIPLE = ("S_NWC_{segment1}_{segment2}_{orig_platform_name}_{orbit_number:05d}_" +
-                            "{start_time:%Y%m%dT%H%M%S%f}Z_{end_time:%Y%m%dT%H%M%S%f}Z.{extention}")
-PPS_STAT_PATTERN = ("S_NWC_{segment}_{orig_platform_name}_{orbit_number:05d}_" +
-                    "{start_time:%Y%m%dT%H%M%S%f}Z_{end_time:%Y%m%dT%H%M%S%f}Z_statistics.xml")
-
 SUPPORTED_NOAA_SATELLITES = ['NOAA-15', 'NOAA-18', 'NOAA-19']
 SUPPORTED_METOP_SATELLITES = ['Metop-B', 'Metop-A', 'Metop-C']
 SUPPORTED_EOS_SATELLITES = ['EOS-Terra', 'EOS-Aqua']
@@ -117,44 +113,143 @@ def run_command(cmdstr):
     LOG.debug('Command sequence= ' + str(myargs))
     #: TODO: What is this
     try:
-        proc = Popen(myargs, shell=False, stderr=PIPE, stdout=PIPE)
+        future = get_process_supervisor().launch(myargs, log_func=LOG.info)
     except NwpPrepareError:
         LOG.exception("Failed when preparing NWP data for PPS...")
 
-    out_reader = threading.Thread(
-        target=logreader, args=(proc.stdout, LOG.info))
-    err_reader = threading.Thread(
-        target=logreader, args=(proc.stderr, LOG.info))
-    out_reader.start()
-    err_reader.start()
-    out_reader.join()
-    err_reader.join()
+    return future.result()
+
+
+def _lower_priority(niceness):
+    if niceness:
+        os.nice(niceness)
+
+
+def run_jobs(func, jobs, nworkers=1, niceness=0):
+    """Call *func* with the arguments in each item of *jobs*, using up to *nworkers* processes.
+
+    The worker processes get their priority lowered by *niceness*. Yield
+    (job, result) tuples as the jobs complete. An exception raised by *func*
+    is raised again here, and the jobs not yet started are cancelled.
+    """
+    if nworkers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield job, func(*job)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(nworkers, len(jobs)), initializer=_lower_priority,
+                             initargs=(niceness, )) as executor:
+        futures = {executor.submit(func, *job): job for job in jobs}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+#: Seconds a resolved host name is kept
+HOST_CACHE_TTL = 300
+#: Seconds a failed host name resolution is kept
+HOST_CACHE_NEGATIVE_TTL = 30
+#: Seconds the local addresses are kept
+LOCAL_IPS_TTL = 300
+#: Minimum seconds between readings of the local addresses, when an address is not found
+LOCAL_IPS_MIN_REFRESH = 5
+
+
+class HostResolver(object):
+    """Resolve host names and check if they are local, with cached results.
 
-    return proc.wait()
+    The local addresses are read again when they are older than *local_ips_ttl*,
+    or when an unknown address is checked and they are older than
+    *local_ips_min_refresh* seconds, so that new interfaces are seen quickly.
+    """
+
+    def __init__(self, ttl=HOST_CACHE_TTL, negative_ttl=HOST_CACHE_NEGATIVE_TTL,
+                 local_ips_ttl=LOCAL_IPS_TTL, local_ips_min_refresh=LOCAL_IPS_MIN_REFRESH):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local_ips_ttl = local_ips_ttl
+        self.local_ips_min_refresh = local_ips_min_refresh
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._local_ips = frozenset()
+        self._local_ips_time = None
+
+    def resolve(self, hostname):
+        """Get the address of *hostname*. Raise socket.gaierror if it can not be resolved."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._hosts.get(hostname)
+        if cached is None or cached[1] < now:
+            try:
+                cached = (socket.gethostbyname(hostname), now + self.ttl)
+            except socket.gaierror as err:
+                cached = (err, now + self.negative_ttl)
+            with self._lock:
+                self._hosts[hostname] = cached
+        if isinstance(cached[0], socket.gaierror):
+            raise cached[0]
+        return cached[0]
+
+    def local_ips(self, max_age=None):
+        """Get the set of local addresses, read again if older than *max_age* seconds."""
+        max_age = self.local_ips_ttl if max_age is None else max_age
+        now = time.monotonic()
+        if self._local_ips_time is None or now - self._local_ips_time > max_age:
+            local_ips = frozenset(get_local_ips())
+            with self._lock:
+                self._local_ips, self._local_ips_time = local_ips, now
+        return self._local_ips
+
+    def is_local_ip(self, ip_address):
+        """Check if the *ip_address* belongs to this host."""
+        return (ip_address in self.local_ips() or
+                ip_address in self.local_ips(max_age=self.local_ips_min_refresh))
+
+    def is_local(self, hostname):
+        """Check if the *hostname* is this host. Raise socket.gaierror if it can not be resolved."""
+        return self.is_local_ip(self.resolve(hostname))
+
+
+#: The resolver shared by the checks of the messages
+HOST_RESOLVER = HostResolver()
 
 
 def check_uri(uri):
     """Check that the provided *uri* is on the local host and return the
     file path.
+
+    A list of uris is checked resolving each distinct host name once.
     """
     if isinstance(uri, (list, set, tuple)):
-        paths = [check_uri(ressource) for ressource in uri]
-        return paths
+        urls = [urlparse(ressource) for ressource in uri]
+        local_hosts = {}
+        for url in urls:
+            if url.hostname and url.hostname not in local_hosts:
+                local_hosts[url.hostname] = _is_local_host(url.hostname)
+        return [_check_url(url, local_hosts.get(url.hostname, True)) for url in urls]
     url = urlparse(uri)
-    try:
-        if url.hostname:
-            url_ip = socket.gethostbyname(url.hostname)
+    return _check_url(url, _is_local_host(url.hostname) if url.hostname else True)
 
-            if url_ip not in get_local_ips():
-                try:
-                    os.stat(url.path)
-                except OSError:
-                    raise IOError(
-                        "Data file %s unaccessible from this host" % uri)
 
+def _is_local_host(hostname):
+    """Check if *hostname* is this host, assuming it is if it can not be resolved."""
+    try:
+        return HOST_RESOLVER.is_local(hostname)
     except socket.gaierror:
         LOG.warning("Couldn't check file location, running anyway")
+        return True
 
+
+def _check_url(url, local):
+    if not local:
+        try:
+            os.stat(url.path)
+        except OSError:
+            raise IOError(
+                "Data file %s unaccessible from this host" % url.geturl())
     return url.path
 
 
@@ -177,9 +272,8 @@ class SceneId(object):
                 str(self.starttime.strftime('%Y%m%d%H%M')))
 
     def __hash__(self):
-        return hash(str(self.platform_name) + '_' +
-                    str(self.orbit_number) + '_' +
-                    str(self.starttime.strftime('%Y%m%d%H%M')))
+        # Scenes starting within the threshold are equal, so the start time can not be part of the hash
+        return hash((str(self.platform_name), self.orbit_number))
 
     def __eq__(self, other):
 
@@ -224,7 +318,11 @@ def get_sceneid(platform_name, orbit_number, starttime):
 
 
 def ready2run(msg, files4pps, **kwargs):
-    """Check whether pps is ready to run or not."""
+    """Check whether pps is ready to run or not.
+
+    The level-1 files of the message are added to the scene in the *files4pps*
+    SceneStore.
+    """
     # """Start the PPS processing on a NOAA/Metop/S-NPP/EOS scene"""
     # LOG.debug("Received message: " + str(msg))
 
@@ -278,8 +376,8 @@ def ready2run(msg, files4pps, **kwargs):
         return False
 
     try:
-        url_ip = socket.gethostbyname(msg.host)
-        if url_ip not in get_local_ips():
+        url_ip = HOST_RESOLVER.resolve(msg.host)
+        if not HOST_RESOLVER.is_local_ip(url_ip):
             LOG.warning("Server %s not the current one: %s", str(url_ip), socket.gethostname())
             return False
     except (AttributeError, socket.gaierror) as err:
@@ -343,42 +441,35 @@ def ready2run(msg, files4pps, **kwargs):
     starttime = msg.data.get('start_time')
     sceneid = get_sceneid(platform_name, orbit_number, starttime)
 
-    if sceneid not in files4pps:
-        files4pps[sceneid] = []
-
     LOG.debug("level1_files = %s", level1_files)
     if platform_name in SUPPORTED_EOS_SATELLITES:
-        for item in level1_files:
-            fname = os.path.basename(item)
-            LOG.debug("EOS level-1 file: %s", item)
-            if (fname.startswith(GEOLOC_PREFIX[platform_name]) or
-                    fname.startswith(DATA1KM_PREFIX[platform_name])):
-                files4pps[sceneid].append(item)
-    else:
-        for item in level1_files:
-            # fname = os.path.basename(item)
-            files4pps[sceneid].append(item)
-
-    LOG.debug("files4pps: %s", str(files4pps[sceneid]))
+        level1_files = [item for item in level1_files
+                        if (os.path.basename(item).startswith(GEOLOC_PREFIX[platform_name]) or
+                            os.path.basename(item).startswith(DATA1KM_PREFIX[platform_name]))]
+    if files4pps.add_files(sceneid, level1_files, msg=msg) < len(level1_files):
+        LOG.info("Some level-1 files of scene %s were already received", sceneid)
+
+    nfiles = files4pps.num_files(sceneid)
+    LOG.debug("Number of level-1 files of scene %s: %d", sceneid, nfiles)
     if (stream_tag_name in msg.data and msg.data[stream_tag_name] in [stream_name, ] and
             platform_name in SUPPORTED_METOP_SATELLITES):
         LOG.info("EARS Metop data. Only require the HRPT/AVHRR level-1b file to be ready!")
     elif (platform_name in SUPPORTED_METOP_SATELLITES or
           platform_name in SUPPORTED_NOAA_SATELLITES):
-        if len(files4pps[sceneid]) < len(REQUIRED_MW_SENSORS[platform_name]) + 1:
+        if nfiles < len(REQUIRED_MW_SENSORS[platform_name]) + 1:
             LOG.info("Not enough NOAA/Metop sensor data available yet...")
             return False
     elif platform_name in SUPPORTED_EOS_SATELLITES:
-        if len(files4pps[sceneid]) < 2:
+        if nfiles < 2:
             LOG.info("Not enough MODIS level 1 files available yet...")
             return False
 
-    if len(files4pps[sceneid]) > 10:
+    if nfiles > 10:
         LOG.info(
-            "Number of level 1 files ready = " + str(len(files4pps[sceneid])))
+            "Number of level 1 files ready = " + str(nfiles))
         LOG.info("Scene = " + str(sceneid))
     else:
-        LOG.info("Level 1 files ready: " + str(files4pps[sceneid]))
+        LOG.info("Level 1 files ready: " + str(files4pps.get_files(sceneid)))
 
     if msg.data['platform_name'] in SUPPORTED_PPS_SATELLITES:
         LOG.info(
@@ -512,24 +603,13 @@ def get_outputfiles(path, platform_name, orb, st_time='', **kwargs):
     start time can be used, just add st_time=start-time
     """
 
+    extensions = [ext for ext in ('h5', 'nc') if kwargs.get(ext + '_output')]
     filelist = []
-    h5_output = kwargs.get('h5_output')
-    if h5_output:
-        h5_output = (os.path.join(path, 'S_NWC') + '*' +
-                     str(METOP_NAME_LETTER.get(platform_name, platform_name)) +
-                     '_' + '%.5d' % int(orb) + '_%s*.h5' % st_time)
-        LOG.info(
-            "Match string to do a file globbing on hdf5 output files: " + str(h5_output))
-        filelist = filelist + glob(h5_output)
-
-    nc_output = kwargs.get('nc_output')
-    if nc_output:
-        nc_output = (os.path.join(path, 'S_NWC') + '*' +
-                     str(METOP_NAME_LETTER.get(platform_name, platform_name)) +
-                     '_' + '%.5d' % int(orb) + '_%s*.nc' % st_time)
-        LOG.info(
-            "Match string to do a file globbing on netcdf output files: " + str(nc_output))
-        filelist = filelist + glob(nc_output)
+    if extensions:
+        sat_name = str(METOP_NAME_LETTER.get(platform_name, platform_name))
+        LOG.info("Look up %s output files of %s orbit %s in %s", '/'.join(extensions), sat_name, orb, path)
+        names = get_output_index(path).lookup(sat_name, orb, st_time, extensions)
+        filelist = [os.path.join(path, name) for name in names]
 
     xml_output = kwargs.get('xml_output')
     if xml_output:
@@ -559,94 +639,138 @@ def get_xml_outputfiles(path, platform_name, orb, st_time=''):
     filename and the message.
     """
 
-    xml_output = (os.path.join(path, 'S_NWC') + '*' +
-                  str(METOP_NAME_LETTER.get(platform_name, platform_name)) +
-                  '_' + '%.5d' % int(orb) + '_%s*.xml' % st_time)
-    LOG.info(
-        "Match string to do a file globbing on xml output files: " + str(xml_output))
-    filelist = glob(xml_output)
+    sat_name = str(METOP_NAME_LETTER.get(platform_name, platform_name))
+    index = get_output_index(path)
+    LOG.info("Look up xml output files of %s orbit %s in %s", sat_name, orb, path)
+    names = index.lookup(sat_name, orb, st_time, ('xml',))
 
-    if len(filelist) == 0:
+    if len(names) == 0:
         # Perhaps there is an orbit number mismatch?
-        nxmlfiles = 0
         for idx in [1, -1, 2, -2, 3, -3, 4, -4, 5, -5]:
             tmp_orbit = int(orb) + idx
             LOG.debug('Try with an orbitnumber of %d instead', tmp_orbit)
-            xml_output = (os.path.join(path, 'S_NWC') + '*' +
-                          str(METOP_NAME_LETTER.get(platform_name, platform_name)) +
-                          '_' + '%.5d' % int(tmp_orbit) + '_%s*.xml' % st_time)
-
-            filelist = glob(xml_output)
-            nxmlfiles = len(filelist)
-            if nxmlfiles > 0:
+            names = index.lookup(sat_name, tmp_orbit, st_time, ('xml',))
+            if len(names) > 0:
                 break
 
-    return filelist
+    return [os.path.join(path, name) for name in names]
+
+
+def create_output_spool(spool_dir, scene):
+    """Create an empty spool file, where the PPS post-hooks report the output files of the *scene*."""
+    prefix = "pps_output_{}_{:05d}_".format(scene['platform_name'], int(scene['orbit_number']))
+    fd, spool_file = tempfile.mkstemp(prefix=prefix, suffix='.txt', dir=spool_dir)
+    os.close(fd)
+    return spool_file
+
+
+def read_output_spool(spool_file, remove=True):
+    """Read the PPS output files (netCDF and hdf5) reported by the post-hooks in the *spool_file*.
+
+    The files are returned once each, in the order they were reported.
+    """
+    try:
+        with open(spool_file) as fpt:
+            filenames = [line.strip() for line in fpt]
+    except IOError:
+        LOG.warning("No spool file %s", spool_file)
+        return []
+    if remove:
+        os.remove(spool_file)
+
+    result_files = []
+    seen = set()
+    for filename in filenames:
+        match = OUTPUT_NAME.match(os.path.basename(filename))
+        if match and match.group('ext') in ('h5', 'nc') and filename not in seen:
+            seen.add(filename)
+            result_files.append(filename)
+    return result_files
+
+
+#: Message format and type of the PPS result files, per file extension
+RESULT_FILE_FORMATS = {'xml': ('PPS-XML', 'XML'),
+                       'nc': ('CF', 'netCDF4'),
+                       'h5': ('PPS', 'HDF5')}
+
+
+def create_message_template(input_msg, scene):
+    """Create the message content common to all the result files of the *scene*."""
+    template = dict((key, val) for key, val in input_msg.data.items() if key not in ('dataset', 'collection'))
+    template['sensor'] = scene.get('instrument', None)
+    if not template['sensor']:
+        template['sensor'] = scene.get('sensor', None)
+    template['platform_name'] = scene['platform_name']
+    template['orbit_number'] = scene['orbit_number']
+    template['data_processing_level'] = '2'
+    return template
+
+
+def _create_topic(msg_format, station, environment):
+    return '/' + msg_format + '/2/' + station + '/' + environment + '/polar/direct_readout/'
+
+
+def _put_message(publish_q, pubmsg):
+    LOG.info("Sending: %s", str(pubmsg))
+    try:
+        publish_q.put(pubmsg)
+    except Exception:
+        LOG.warning("Failed putting message on the queue, will send it now...")
+        publish_q.send(pubmsg)
 
 
 def publish_pps_files(input_msg, publish_q, scene, result_files, **kwargs):
     """
     Publish messages for the files provided.
+
+    One file message is sent per file, or one dataset message listing all the
+    files if *dataset* is True.
     """
 
     environment = kwargs.get('environment')
     servername = kwargs.get('servername')
     station = kwargs.get('station', 'unknown')
 
+    template = create_message_template(input_msg, scene)
+    files = []
     for result_file in result_files:
         # Get true start and end time from filenames and adjust the end time in
         # the publish message:
         filename = os.path.basename(result_file)
         LOG.info("file to publish = " + str(filename))
-        try:
-            try:
-                metadata = parse(PPS_OUT_PATTERN, filename)
-            except ValueError:
-                metadata = parse(PPS_OUT_PATTERN_MULTIPLE, filename)
-                metadata['segment'] = '_'.join([metadata['segment1'],
-                                                metadata['segment2']])
-                del metadata['segment1'], metadata['segment2']
-        except ValueError:
-            metadata = parse(PPS_STAT_PATTERN, filename)
-
-        endtime = metadata['end_time']
-        starttime = metadata['start_time']
-
-        to_send = input_msg.data.copy()
-        to_send.pop('dataset', None)
-        to_send.pop('collection', None)
-        to_send['uri'] = (
-            'ssh://%s/%s' % (servername, result_file))
-        to_send['uid'] = filename
-        to_send['sensor'] = scene.get('instrument', None)
-        if not to_send['sensor']:
-            to_send['sensor'] = scene.get('sensor', None)
-
-        to_send['platform_name'] = scene['platform_name']
-        to_send['orbit_number'] = scene['orbit_number']
-        if result_file.endswith("xml"):
-            to_send['format'] = 'PPS-XML'
-            to_send['type'] = 'XML'
-        if result_file.endswith("nc"):
-            to_send['format'] = 'CF'
-            to_send['type'] = 'netCDF4'
-        if result_file.endswith("h5"):
-            to_send['format'] = 'PPS'
-            to_send['type'] = 'HDF5'
-        to_send['data_processing_level'] = '2'
-
-        to_send['start_time'], to_send['end_time'] = starttime, endtime
-        pubmsg = Message('/' + to_send['format'] + '/' +
-                         to_send['data_processing_level'] +
-                         '/' + station + '/' + environment +
-                         '/polar/direct_readout/',
+        metadata = parse_pps_filename(filename)
+
+        item = {'uri': 'ssh://%s/%s' % (servername, result_file),
+                'uid': filename,
+                'start_time': metadata.start_time,
+                'end_time': metadata.end_time}
+        extension = os.path.splitext(result_file)[1][1:]
+        if extension in RESULT_FILE_FORMATS:
+            item['format'], item['type'] = RESULT_FILE_FORMATS[extension]
+        files.append(item)
+
+    if kwargs.get('dataset'):
+        if not files:
+            return
+        to_send = dict((key, val) for key, val in template.items() if key not in ('uri', 'uid', 'format', 'type'))
+        formats = set(item.get('format') for item in files)
+        if len(formats) == 1 and None not in formats:
+            to_send['format'] = formats.pop()
+        to_send['start_time'] = min(item['start_time'] for item in files)
+        to_send['end_time'] = max(item['end_time'] for item in files)
+        to_send['dataset'] = [dict((key, val) for key, val in item.items() if key not in ('start_time', 'end_time'))
+                              for item in files]
+        pubmsg = Message(_create_topic(to_send.get('format', 'PPS-dataset'), station, environment),
+                         "dataset", to_send).encode()
+        _put_message(publish_q, pubmsg)
+        return
+
+    for item in files:
+        to_send = dict(template)
+        to_send.update(item)
+        pubmsg = Message(_create_topic(to_send['format'], station, environment),
                          "file", to_send).encode()
-        LOG.info("Sending: %s", str(pubmsg))
-        try:
-            publish_q.put(pubmsg)
-        except Exception:
-            LOG.warning("Failed putting message on the queue, will send it now...")
-            publish_q.send(pubmsg)
+        _put_message(publish_q, pubmsg)
 
 
 def logreader(stream, log_func):
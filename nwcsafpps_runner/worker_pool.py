@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2021 Pytroll
+
+# Author(s):
+
+#   Adam.Dybbroe <adam.dybbroe@smhi.se>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A fixed set of workers fed from an explicit queue of pending jobs.
+
+The order of the pending jobs is given by a scheduling policy. By default the
+jobs are run in arrival order (FIFO). With the :class:`FreshnessPolicy` the
+most recent scenes are run first and scenes too old to be of any use are
+dropped.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from nwcsafpps_runner.scene_index import SceneIntervalIndex
+
+LOG = logging.getLogger(__name__)
+
+
+class FreshnessPolicy(object):
+    """Order the scenes by freshness (newest first) and drop the stale ones.
+
+    The age of a scene is the time since its end time (or start time). The
+    maximum age can be given per stream (e.g. EARS) and per platform, and else
+    the default *max_age_minutes* is used. No scene is dropped if the maximum
+    age is None.
+    """
+
+    def __init__(self, max_age_minutes=None, max_age_per_platform=None, max_age_per_stream=None,
+                 stream_tag_name='variant'):
+        self.max_age_minutes = max_age_minutes
+        self.max_age_per_platform = max_age_per_platform or {}
+        self.max_age_per_stream = max_age_per_stream or {}
+        self.stream_tag_name = stream_tag_name
+
+    @staticmethod
+    def get_scene_time(mda):
+        """Get the (end) time of the scene from the message metadata, or None if not available."""
+        for key in ['end_time', 'start_time']:
+            if isinstance(mda.get(key), datetime):
+                return mda[key]
+        return None
+
+    def get_max_age(self, mda):
+        """Get the maximum allowed age of the scene as a timedelta, or None if unlimited."""
+        max_age = self.max_age_per_stream.get(mda.get(self.stream_tag_name),
+                                              self.max_age_per_platform.get(mda.get('platform_name'),
+                                                                            self.max_age_minutes))
+        if max_age is None:
+            return None
+        return timedelta(minutes=float(max_age))
+
+    def priority(self, mda, seq):
+        """Return the sort key of the job, lowest first."""
+        scene_time = self.get_scene_time(mda or {})
+        if scene_time is None:
+            return (0, seq)
+        return (-(scene_time - datetime(1970, 1, 1)).total_seconds(), seq)
+
+    def is_stale(self, mda, now=None):
+        """Check if the scene is too old to be processed."""
+        scene_time = self.get_scene_time(mda or {})
+        max_age = self.get_max_age(mda or {})
+        if scene_time is None or max_age is None:
+            return False
+        return (now or datetime.utcnow()) - scene_time > max_age
+
+
+def create_scheduling_policy(options):
+    """Create the scheduling policy from the runner configuration, None meaning arrival order."""
+    if options.get('scheduling_policy', 'fifo') != 'freshest_first':
+        return None
+    return FreshnessPolicy(max_age_minutes=options.get('max_scene_age_minutes'),
+                           max_age_per_platform=options.get('max_scene_age_minutes_per_platform'),
+                           max_age_per_stream=options.get('max_scene_age_minutes_per_stream'),
+                           stream_tag_name=options.get('stream_tag_name', 'variant'))
+
+
+class PendingJob(object):
+    """A job waiting in the queue."""
+
+    def __init__(self, job_id, target, args=(), kwargs=None, mda=None):
+        self.job_id = job_id
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.mda = mda
+        self.queued_time = time.time()
+
+    def wait_time(self, now=None):
+        """Seconds the job has been waiting in the queue."""
+        return (now or time.time()) - self.queued_time
+
+
+class WorkerPool(object):
+    """A fixed number of worker threads processing the jobs of a pending-job queue.
+
+    If a *high_water_mark* is given, :meth:`wait_for_capacity` blocks as long
+    as there are that many jobs (or more) waiting in the queue. This is used to
+    apply backpressure on the message listener.
+
+    The pending jobs are run in the order given by the *policy*, or in arrival
+    order if no policy is given.
+
+    Job ids describing a scene (with platform_name, orbit_number and starttime,
+    like a SceneId) are also kept in an interval index, so that a job is not
+    queued when one for the same scene, starting within the threshold of the
+    job id, is pending or running.
+
+    The *on_drop* callback is called with the job id and the message metadata
+    of each queued job that is dropped without being run. It may be called
+    with the lock of the pool held, so it must not use the pool.
+    """
+
+    def __init__(self, nworkers, high_water_mark=None, policy=None, on_drop=None):
+        self.nworkers = nworkers
+        self.high_water_mark = high_water_mark
+        self.policy = policy
+        self.on_drop = on_drop
+        self.jobs = set()
+        self.scenes = SceneIntervalIndex()
+        self.pending = []
+        self.running = {}
+        self.last_wait_time = 0.0
+        self.dropped_stale = 0
+        self._counter = itertools.count()
+        self.lock = threading.Lock()
+        self._job_available = threading.Condition(self.lock)
+        self._capacity_available = threading.Condition(self.lock)
+        self._stop = False
+        self.workers = []
+        for idx in range(nworkers):
+            worker = threading.Thread(target=self._work, name="PPSWorker-%d" % idx)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job_id, target, args=(), kwargs=None, mda=None):
+        """Put a job in the queue, unless a job with the same id is already pending or running.
+
+        The message metadata *mda* of the scene is used by the scheduling policy.
+        Return True if the job was queued.
+        """
+        if self.policy is not None and self.policy.is_stale(mda):
+            LOG.warning("Scene too old, skip job %s", str(job_id))
+            self.dropped_stale += 1
+            return False
+
+        with self.lock:
+            if self._is_known(job_id):
+                LOG.info("Job with id %s already running!", str(job_id))
+                return False
+
+            self._add_job(job_id)
+            seq = next(self._counter)
+            key = (seq, ) if self.policy is None else self.policy.priority(mda, seq)
+            heapq.heappush(self.pending, (key, PendingJob(job_id, target, args, kwargs, mda)))
+            self._job_available.notify()
+            LOG.debug("Job %s queued. Number of pending jobs: %d", str(job_id), len(self.pending))
+        return True
+
+    @staticmethod
+    def _scene_of(job_id):
+        try:
+            return job_id.platform_name, job_id.orbit_number, job_id.starttime
+        except AttributeError:
+            return None
+
+    def _is_known(self, job_id):
+        scene = self._scene_of(job_id)
+        if scene is None:
+            return job_id in self.jobs
+        return self.scenes.find(*scene, threshold=getattr(job_id, 'threshold', None)) is not None
+
+    def _add_job(self, job_id):
+        self.jobs.add(job_id)
+        scene = self._scene_of(job_id)
+        if scene is not None:
+            self.scenes.add(*scene)
+
+    def _discard_job(self, job_id):
+        self.jobs.discard(job_id)
+        scene = self._scene_of(job_id)
+        if scene is not None:
+            self.scenes.remove(*scene)
+
+    def cancel(self, job_id):
+        """Remove a pending job from the queue. Return True if the job was removed."""
+        with self.lock:
+            for item in self.pending:
+                if item[1].job_id == job_id:
+                    self.pending.remove(item)
+                    heapq.heapify(self.pending)
+                    self._discard_job(item[1].job_id)
+                    self._capacity_available.notify_all()
+                    LOG.info("Job %s cancelled", str(job_id))
+                    self._dropped(item[1])
+                    return True
+        return False
+
+    def _dropped(self, job):
+        if self.on_drop is not None:
+            try:
+                self.on_drop(job.job_id, job.mda)
+            except Exception:
+                LOG.exception("Failed handling the drop of job %s", str(job.job_id))
+
+    def queue_depth(self):
+        """Return the number of jobs waiting for a worker."""
+        with self.lock:
+            return len(self.pending)
+
+    def stats(self):
+        """Return the queue depth, the number of running jobs and the wait times (seconds) of the jobs."""
+        now = time.time()
+        with self.lock:
+            return {'pending': len(self.pending),
+                    'running': len(self.running),
+                    'oldest_wait_time': max([job.wait_time(now) for _, job in self.pending] or [0.0]),
+                    'last_wait_time': self.last_wait_time,
+                    'dropped_stale': self.dropped_stale}
+
+    def wait_for_capacity(self, timeout=None):
+        """Wait until the number of pending jobs is below the high water mark.
+
+        Return False if the timeout expired before that.
+        """
+        if self.high_water_mark is None:
+            return True
+        with self.lock:
+            return self._capacity_available.wait_for(lambda: len(self.pending) < self.high_water_mark or self._stop,
+                                                     timeout)
+
+    def shutdown(self, wait=True):
+        """Stop the workers once the pending jobs are done."""
+        with self.lock:
+            self._stop = True
+            self._job_available.notify_all()
+            self._capacity_available.notify_all()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def _next_job(self):
+        """Get the next job from the queue, or None when stopping."""
+        with self.lock:
+            while True:
+                self._job_available.wait_for(lambda: self.pending or self._stop)
+                if not self.pending:
+                    return None
+                _, job = heapq.heappop(self.pending)
+                if self.policy is None or not self.policy.is_stale(job.mda):
+                    break
+                LOG.warning("Scene got too old while waiting in the queue, skip job %s", str(job.job_id))
+                self.dropped_stale += 1
+                self._discard_job(job.job_id)
+                self._dropped(job)
+                self._capacity_available.notify_all()
+            wait_time = self.last_wait_time = job.wait_time()
+            npending = len(self.pending)
+            self.running[job.job_id] = job
+            self._capacity_available.notify_all()
+        LOG.info("Start job %s after %.1f seconds in the queue. Jobs left in the queue: %d",
+                 str(job.job_id), wait_time, npending)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            try:
+                job.target(*job.args, **job.kwargs)
+            except Exception:
+                LOG.exception("Job %s failed", str(job.job_id))
+            finally:
+                with self.lock:
+                    self.running.pop(job.job_id, None)
+                    self._discard_job(job.job_id)
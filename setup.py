@@ -60,6 +60,7 @@ setup(name=NAME,
       packages=find_packages(),
       scripts=['nwcsafpps_runner/pps_runner.py',
                'nwcsafpps_runner/pps2018_runner.py',
+               'nwcsafpps_runner/pps_hook_relay.py',
                'bin/pps_run.sh', ],
       data_files=[],
       install_requires=['posttroll', 'trollsift', 'pygrib', ],